@@ -1,4 +1,5 @@
 #!/bin/sh
-# Create the bundle for upload to ankiweb addons site
-zip -r pinyintoolkit.zip pinyin/ Pinyin\ Toolkit.py Pinyin\ Toolkit.txt -x \*.pyc
-
+# Create the bundle for upload to ankiweb addons site. NB: leave out the caches the Toolkit generates
+# next to its databases and dictionaries (see .gitignore), which are specific to whoever ran it
+zip -r pinyintoolkit.zip pinyin/ Pinyin\ Toolkit.py Pinyin\ Toolkit.txt -x \*.pyc \
+    pinyin/db/\*.ptkd pinyin/dictionaries/\*.index pinyin/ptkmediacatalog.p pinyin/ptkhanzistats-\*.p pinyin/ptktranslations.db\*
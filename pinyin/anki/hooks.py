@@ -7,6 +7,8 @@ from anki.find import Finder
 
 import pinyin.anki.keys
 import pinyin.factproxy
+import pinyin.forms.bulkfill
+import pinyin.forms.bulkfillcontroller
 import pinyin.media
 import pinyin.transformations
 import pinyin.utils
@@ -14,7 +16,7 @@ import pinyin.utils
 from pinyin.logger import log
 from pinyin.config import getconfig, saveconfig
 
-from copy import deepcopy
+from copy import copy, deepcopy
 
 #
 # A base class for hooks added using the addHook routine.
@@ -72,6 +74,51 @@ class FocusHook(Hook):
 
         return noteChanged
     
+    # Remember which editor is showing which note, so we can show any changes we make later on
+    def onLoadNote(self, editor):
+        self.editor = editor
+    
+    # Called on a background thread when Google Translate answers a query that the expression
+    # updater couldn't wait for: update the note again now that we have the answer. NB: we mustn't
+    # wait for the main thread to do it, because it may be waiting for this thread to answer another query.
+    def onTranslationArrived(self, factproxy, expression):
+        self.invoker.post(lambda: self.updateAfterTranslation(factproxy, expression))
+    
+    def updateAfterTranslation(self, factproxy, expression):
+        note = factproxy.fact
+        showing = self.editor is not None and self.editor.note is note
+        if not showing:
+            # The editor has moved on, so the user can't see the note any more (and may even have changed
+            # it since). Update the copy we saved instead, if there is one: a note that was never added is gone.
+            log.info("The editor no longer shows the note awaiting the Google translation of %s", expression)
+            if not self.mw.col.db.scalar("select 1 from notes where id = ?", note.id):
+                return
+            
+            note = self.mw.col.getNote(note.id)
+            factproxy = pinyin.factproxy.FactProxy(self.config.candidateFieldNamesByKey, note)
+        
+        # The user may have changed the expression in the meantime, in which case the answer is useless
+        if "expression" not in factproxy or factproxy["expression"] != expression:
+            return
+        
+        savedNoteValues = deepcopy(note.values())
+        pinyin.utils.suppressexceptions(
+            lambda: self.updaters['expression'].updatefact(factproxy, expression))
+        
+        if savedNoteValues == note.values():
+            return
+        
+        if not showing:
+            log.info("Saving the update made with the answer from Google Translate for %s", expression)
+            note.flush()
+            return
+        
+        # Save the note just like the editor would have done if the user had made the change
+        log.info("Showing the update made with the answer from Google Translate for %s", expression)
+        if not self.editor.addMode:
+            note.flush()
+        self.editor.loadNote()
+    
     def install(self):
         from anki.hooks import addHook, remHook
         
@@ -81,6 +128,13 @@ class FocusHook(Hook):
         
         # Unconditionally add our new hook to Anki
         addHook('editFocusLost', self.onFocusLost)
+        
+        # Don't hold up the editor waiting for Google Translate: fill in what it tells us once it does
+        self.editor = None
+        self.invoker = pinyin.forms.bulkfillcontroller.MainThreadInvoker()
+        if 'expression' in self.updaters:
+            addHook('loadNote', self.onLoadNote)
+            self.updaters['expression'].translationarrived = self.onTranslationArrived
 
 class FieldShrinkingHook(Hook):
     def adjustFieldHeight(self, widget, field):
@@ -196,7 +250,7 @@ def buildHookMissingInformation(menu, mw, config, notifier, updaters):
     field = "expression"
     updatehow = "updatefact"
     notification = "All missing information has been successfully added to your deck."
-    function = lambda: runBulkFill(mw, config, notifier, updaters, field, updatehow, notification)
+    function = lambda: runBulkFill(mw, config, notifier, updaters, title, field, updatehow, notification)
     createBulkFillAction(menu, mw, title, tip, function)
 
 def buildHookReformatReadings(menu, mw, config, notifier, updaters):
@@ -205,7 +259,7 @@ def buildHookReformatReadings(menu, mw, config, notifier, updaters):
     field = "reading"
     updatehow = "updatefactalways"
     notification = "All readings have been successfully reformatted."
-    function = lambda: runBulkFill(mw, config, notifier, updaters, field, updatehow, notification)
+    function = lambda: runBulkFill(mw, config, notifier, updaters, title, field, updatehow, notification)
     createBulkFillAction(menu, mw, title, tip, function)
 
 # Create action with details and add to menu
@@ -236,7 +290,10 @@ def openPreferences(mw, config, notifier, mediamanager):
         config.settings = controller.model.settings
         saveconfig()
 
-def runBulkFill(mw, config, notifier, updaters, field, updatehow, notification):
+# Number of notes that runBulkFill loads and updates together
+bulkFillBatchSize = 500
+
+def runBulkFill(mw, config, notifier, updaters, title, field, updatehow, notification):
     if mw.web.key == "deckBrowser":
         return showInfo(u"No deck selected 同志!")
 
@@ -245,25 +302,73 @@ def runBulkFill(mw, config, notifier, updaters, field, updatehow, notification):
     queryStr = "deck:current "
     for tag in config.getmodeltagslist():
         queryStr += " or note:*" + tag + "* "
-    notes = Finder(mw.col).findNotes(queryStr)
-
-    for noteId in notes:
-        note = mw.col.getNote(noteId)
-        # Need a fact proxy because the updater works on dictionary-like objects
-        factproxy = pinyin.factproxy.FactProxy(config.candidateFieldNamesByKey, note)
-        if field not in factproxy:
-            continue
+    noteIds = Finder(mw.col).findNotes(queryStr)
+    
+    # Work through the notes in batches: load the notes in a batch, let the updater look up everything
+    # the batch needs in one go, and only then update them. The batches keep the dictionary caches warm.
+    # The updating happens on a worker thread, so it needs an updater that notifies and imports media
+    # by asking the main thread to do it.
+    invoker = pinyin.forms.bulkfillcontroller.MainThreadInvoker()
+    updater = copy(updaters[field])
+    for attribute in ["notifier", "mediamanager"]:
+        if hasattr(updater, attribute):
+            setattr(updater, attribute, pinyin.forms.bulkfillcontroller.MainThreadProxy(getattr(updater, attribute), invoker))
+    
+    # We are in the background anyway, so we may as well wait for any answers from Google Translate
+    if hasattr(updater, "translationarrived"):
+        updater.translationarrived = None
+    
+    def loadbatch(batchNoteIds):
+        notefactproxies = []
+        for noteId in batchNoteIds:
+            note = mw.col.getNote(noteId)
+            # Need a fact proxy because the updater works on dictionary-like objects
+            factproxy = pinyin.factproxy.FactProxy(config.candidateFieldNamesByKey, note)
+            if field in factproxy:
+                notefactproxies.append((note, factproxy))
+        
+        return notefactproxies
+    
+    def updatebatch(notefactproxies, cancelled):
+        if hasattr(updater, "prefetch"):
+            updater.prefetch([factproxy[field] for _note, factproxy in notefactproxies])
         
-        getattr(updaters[field], updatehow)(factproxy, factproxy[field])
+        changednotes = []
+        for note, factproxy in notefactproxies:
+            if cancelled():
+                break
+            
+            fieldsbefore = list(note.fields)
+            getattr(updater, updatehow)(factproxy, factproxy[field])
+            if note.fields != fieldsbefore:
+                changednotes.append(note)
         
+        return changednotes
+    
+    def savebatch(changednotes):
         # NB: very important to mark the fact as modified (see #105) because otherwise
         # the HTML etc won't be regenerated by Anki, so users may not e.g. get working
-        # sounds that have just been filled in by the updater.
-        note.flush()
+        # sounds that have just been filled in by the updater. Notes we didn't change
+        # don't need it, and skipping them saves a lot of work on big decks.
+        for note in changednotes:
+            note.flush()
+    
+    # Show the progress dialog, which kicks off the worker and lets the user cancel it.
+    # NB: VERY IMPORTANT to keep hold of the controller until we are done, or the thread will be garbage collected
+    bulkfill = pinyin.forms.bulkfill.BulkFill(mw, title)
+    _controller = pinyin.forms.bulkfillcontroller.BulkFillController(bulkfill, notifier, invoker,
+        list(pinyin.utils.chunks(noteIds, bulkFillBatchSize)), loadbatch, updatebatch, savebatch)
+    completed = bulkfill.exec_() == QDialog.Accepted
     
-    # For good measure, mark the deck as modified as well (see #105)
+    # For good measure, mark the deck as modified as well (see #105). All of the notes were written
+    # in the collection's current transaction, so commit them together. Do this even if the user
+    # cancelled, so that we keep the work that was finished.
     mw.col.setMod()
-
+    mw.col.save()
+    
+    if not(completed):
+        return
+    
     # DEBUG consider future feature to add missing measure words cards after doing so (not now)
     notifier.info(notification)
 
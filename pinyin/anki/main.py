@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import os
-import shutil
 
 import aqt.addons
 
@@ -11,6 +10,7 @@ from aqt.qt import QDialog
 
 from pinyin.db import *
 import pinyin.db.builder
+import pinyin.dictionary
 import pinyin.forms.builddb
 import pinyin.forms.builddbcontroller
 import pinyin.updater
@@ -124,7 +124,10 @@ class PinyinToolkit(object):
             _controller = pinyin.forms.builddbcontroller.BuildDBController(builddb, notifier, dbbuilder, compulsory)
             if builddb.exec_() == QDialog.Accepted:
                 # Successful completion of the build process: replace the existing database, if any
-                shutil.copyfile(dbbuilder.builtdatabasepath, dbpath)
+                dbbuilder.install()
+                
+                # Anything we looked up before now came from the old database
+                pinyin.dictionary.parseexactcache.clear()
             elif compulsory:
                 # Eeek! The dialog was "rejected" despite being compulsory. This can only happen if there
                 # was an error while building the database. Better give up now!
@@ -1,33 +1,16 @@
-import os
-
-from pinyin.logger import log
 import pinyin.media
 import pinyin.utils
 
 class AnkiMediaManager(object):
     def __init__(self, mw):
         self.mw = mw
+        self.catalog = pinyin.media.MediaCatalog(pinyin.utils.toolkitdir("pinyin", "ptkmediacatalog.p"))
     
     def mediadir(self):
         return self.mw.col.media.dir()
 
     def discovermediapacks(self):
-        packs = []
-        themediadir = self.mediadir()
-        for packname in os.listdir(themediadir):
-            # Skip the download cache directory
-            if packname.lower() == "downloads":
-                continue
-            
-            # Only try and process directories as packs:
-            packpath = os.path.join(themediadir, packname)
-            if os.path.isdir(packpath):
-                log.info("Considering %s as a media pack", packname)
-                packs.append(pinyin.media.MediaPack.frompath(packpath))
-            else:
-                log.info("Ignoring the file %s in the media directory", packname)
-        
-        return packs
+        return self.catalog.discovermediapacks(self.mediadir())
     
     def importtocurrentdeck(self, file):
         return self.mw.col.media.addFile(file)
@@ -37,8 +37,9 @@ class HanziGraphHook(hooks.Hook):
     def __init__(self, *args, **kwargs):
         hooks.Hook.__init__(self, *args, **kwargs)
         
-        # Initialize the cache
-        self.__hanzidatacache = None
+        # Initialize the cache: the statistics for the current deck, and whether we need to bring them up to date
+        self.__hanzistatsstore = None
+        self.__hanzidatastale = True
     
     # Returns the Hanzi Figure object for the plot
     def calculateHanziData(self, graphwindow, days):
@@ -85,10 +86,7 @@ class HanziGraphHook(hooks.Hook):
         # Build all the x-y pairs that we are going to display: we want to show
         # a stacked area graph of the number of characters from each grade learnt over time
         colors, xys = [], []
-        cumulative = [0 for _ in xs]
-        for grade in pinyin.statistics.hanziGrades:
-            # Increase the cumulative amount
-            cumulative = [sofar + now for sofar, now in zip(cumulative, gradeys[grade])]
+        for grade, cumulative in zip(pinyin.statistics.hanziGrades, pinyin.statistics.stackedSeries(gradeys, pinyin.statistics.hanziGrades)):
             colors.append(self.gradeColorsShortNames[grade][0])
             xys.append((xs, cumulative))
 
@@ -126,10 +124,27 @@ class HanziGraphHook(hooks.Hook):
 
     def hanziData(self):
         # If we have some data already, just give up
-        if self.__hanzidatacache is not None:
-            return self.__hanzidatacache
+        if self.__hanzistatsstore is not None and self.__hanzistatsstore.storepath == self.hanziStatsPath() and not self.__hanzidatastale:
+            return self.__hanzistatsstore.firstAnsweredValues()
         
         log.info("Updating Hanzi graph data")
+        if self.__hanzistatsstore is None or self.__hanzistatsstore.storepath != self.hanziStatsPath():
+            self.__hanzistatsstore = pinyin.statistics.HanziStatsStore(self.hanziStatsPath())
+        
+        # The statistics only need to be gathered from scratch if the cards or fields they come from change, or if
+        # the answered cards we already counted were edited, deleted or reset. Looking at how many of those cards
+        # there are, which ones they are and when their facts were last modified is enough to tell.
+        modelids = anki.utils.ids2str(self.suitableModelIds())
+        fieldnames = self.toSqlLiteral(self.config.candidateFieldNamesByKey['expression'])
+        def fingerprint(until):
+            return tuple(self.mw.deck.s.first("""
+            select count(), total(cards.id), max(notes.modified) from cards, notes
+            where
+            cards.reps > 0
+            and cards.factId = notes.id
+            and notes.modelId in %s
+            and cards.firstAnswered <= %r
+            """ % (modelids, until)))
         
         # Retrieve information about the card contents that were first answered on each day
         #
@@ -141,22 +156,35 @@ class HanziGraphHook(hooks.Hook):
         # NB: the first answered time can be 0 but repeats > 1 due to a bug in an Anki feature which will
         # have screwed up the data in old decks. We select the created date for use in such cases:
         # <http://github.com/batterseapower/pinyin-toolkit/issues/closed/#issue/48>
-        self.__hanzidatacache = self.mw.deck.s.all("""
-        select fields.value, cards.firstAnswered, cards.created from cards, fields, fieldModels, notes
-        where
-        cards.reps > 0 and
-        cards.factId = fields.factId
-        and cards.factId = notes.id
-        and notes.modelId in %s
-        and fields.fieldModelId = fieldModels.id
-        and fieldModels.name in %s
-        order by firstAnswered
-        """ % (anki.utils.ids2str(self.suitableModelIds()), self.toSqlLiteral(self.config.candidateFieldNamesByKey['expression'])))
-        return self.__hanzidatacache
+        def fetchanswered(since):
+            return self.mw.deck.s.all("""
+            select fields.value, cards.firstAnswered, cards.created from cards, fields, fieldModels, notes
+            where
+            cards.reps > 0 and
+            cards.factId = fields.factId
+            and cards.factId = notes.id
+            and notes.modelId in %s
+            and fields.fieldModelId = fieldModels.id
+            and fieldModels.name in %s
+            %s
+            order by firstAnswered
+            """ % (modelids, fieldnames, since is not None and ("and cards.firstAnswered >= %r" % since) or ""))
+        
+        self.__hanzistatsstore.update((modelids, fieldnames), fingerprint, fetchanswered)
+        self.__hanzidatastale = False
+        return self.__hanzistatsstore.firstAnsweredValues()
+
+    def hanziStatsPath(self):
+        # Keep seperate statistics for each deck
+        deckpath = self.mw.deck.path
+        if isinstance(deckpath, unicode):
+            deckpath = deckpath.encode("utf-8")
+        
+        return pinyin.utils.toolkitdir("pinyin", "ptkhanzistats-%s.p" % pinyin.utils.md5(deckpath)[:8])
 
     def invalidateHanziData(self):
-        # Used when refreshing
-        self.__hanzidatacache = None
+        # Used when refreshing: pick up anything answered since we last looked
+        self.__hanzidatastale = True
 
     def toSqlLiteral(self, thing):
         if isinstance(thing, list):
@@ -35,6 +35,7 @@ defaultsettings = {
     
     "meaninggeneration"            : True, # Should we try and fill out a field called Meaning with the definition? 
     "fallbackongoogletranslate"    : True, # Should we use Google to fill out the Meaning field if needs be? 
+    "googletranslateofflineonly"   : False, # Should we only use translations we already got from Google, rather than going online for more?
     "detectmeasurewords"           : True, # Should we try and put measure words seperately into a field called MW?
     "hanzimasking"                 : True, # Should Hanzi masking be turned on? i.e. if the expression appears in the meaning field be replaced with a "㊥" or "[~]"
     "colormeaningnumbers"          : True, # Should we color the index number for each translation a different color?
@@ -298,10 +299,6 @@ class Config(object):
         
         log.info("Initialized configuration with settings %s", settings)
         self.settings = settings
-        
-        # /Transient/ flag recording whether Google translate appears to be up. To begin
-        # with, we aren't sure
-        self.__googletranslateworking = None
     
     #
     # The pickle protocol (http://docs.python.org/library/pickle.html#pickle.Pickler)
@@ -321,7 +318,7 @@ class Config(object):
         # NB: we want to ensure that:
         # 1) Allow reading of the settings dictionary itself
         # 2) Look up the name on the class for consistency
-        # 3) Reading of transient data like __googletranslateworking goes to the instance
+        # 3) Reading of transient data goes to the instance
         if "settings" in self.__dict__ and name in self.__dict__["settings"]:
             return self.__dict__["settings"][name]
         else:
@@ -342,7 +339,6 @@ class Config(object):
     #
     
     shouldtonify = property(lambda self: tonedisplayshouldtonify[self.tonedisplay])
-    needmeanings = property(lambda self: self.meaninggeneration or self.detectmeasurewords or self.mwaudiogeneration)
     meaningnumberingstrings = property(lambda self: meaningnumberingstringss[self.meaningnumbering])
     meaningseperatorstring = property(lambda self: meaningseperatorstrings.get(self.meaningseperator) or self.custommeaningseperator)
     
@@ -394,16 +390,10 @@ class Config(object):
         if not self.fallbackongoogletranslate:
             return False
 
-        # Determine the status of Google Translate if we haven't already done so.
+        # Only use it if it appears to be working. We don't want to wait to find that out, so we assume that
+        # it is until a query fails to get through: translations are then disabled until Anki is restarted.
+        # This prevents a several second delay from occuring when changing a field with no internet
         # TODO: should try every 5 minutes or something rather than giving up on first failure.
-        if self.__googletranslateworking == None:
-            # Test internet connectivity by performing a gTrans call.
-            # If this call fails then translations are disabled until Anki is restarted.
-            # This prevents a several second delay from occuring when changing a field with no internet
-            self.__googletranslateworking = dictionaryonline.gCheck(self.dictlanguage)
-            log.info("Google Translate has tested internet access and reports status %s", self.__googletranslateworking)
-
-        # Only use it if it appears to be working
-        return self.__googletranslateworking
+        return dictionaryonline.translationclient.reachable is not False
 
     shouldusegoogletranslate = property(getshouldusegoogletranslate)
@@ -1,5 +1,6 @@
 import cjklib.dbconnector
 import sqlalchemy
+import threading
 
 import pinyin.utils
 from pinyin.logger import log
@@ -7,4 +8,22 @@ from pinyin.logger import log
 
 dbpath = pinyin.utils.toolkitdir("pinyin", "db", "cjklib.db")
 
-database = pinyin.utils.Thunk(lambda: cjklib.dbconnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) }))
+# Dictionary tables are also compiled into a memory-mappable form next to the database (see pinyin.db.compiled)
+compileddictionaryfilename = lambda tablename: tablename.lower() + ".ptkd"
+compileddictionarypath = lambda tablename: pinyin.utils.toolkitdir("pinyin", "db", compileddictionaryfilename(tablename))
+
+# SQLite connections can only be used from the thread that created them, so each thread (e.g. the bulk fill
+# worker) makes its own connection. NB: don't use getDBConnector, because it shares one connection between all callers.
+database = pinyin.utils.ThreadLocalThunk(lambda: cjklib.dbconnector.DatabaseConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) }))
+
+"""
+Closes this thread's connection to the database, if it made one. Worker threads must call this when
+they finish, or their connection (and the engine behind it) stays open for as long as Anki does.
+"""
+def closedatabase():
+    def close(connector):
+        log.info("Closing the database connection for %s", threading.currentThread().getName())
+        connector.connection.close()
+        connector.engine.dispose()
+    
+    database.forget(close)
@@ -6,6 +6,8 @@ import tempfile
 import os
 import zipfile
 
+from pinyin.db import dbpath, compileddictionaryfilename, compileddictionarypath
+from pinyin.db.compiled import writecompileddictionary
 from pinyin.logger import log
 import pinyin.utils
 
@@ -25,9 +27,13 @@ class DBBuilder(object):
         #'CharacterVariant', 'ZVariants'
       ]
 
+    # Dictionary tables that we additionally compile for fast lookup
+    compiledgroups = ['CEDICT', 'CFDICT', 'HanDeDict']
+
     cjkdatapath = pinyin.utils.toolkitdir("pinyin", "vendor", "cjklib", "cjklib", "data")
 
     builtdatabasepath = property(lambda self: os.path.join(self.dictionarydatapath, "cjklib.db"))
+    builtcompileddictionarypath = lambda self, tablename: os.path.join(self.dictionarydatapath, compileddictionaryfilename(tablename))
 
     def __init__(self, satisfiers):
         self.satisfiers = satisfiers
@@ -42,12 +48,12 @@ class DBBuilder(object):
             pass
     
     def build(self):
-        # [1/4]: copy and extract necessary files into a location cjklib can deal with
+        # [1/5]: copy and extract necessary files into a location cjklib can deal with
         log.info("Copying in dictionary data")
         for requirement, satisfier in self.satisfiers:
             satisfier(os.path.join(self.dictionarydatapath, requirement))
         
-        # [2/4]: setup the database builder with a standard set of requirements
+        # [2/5]: setup the database builder with a standard set of requirements
         log.info("Initializing builder")
         database = cjklib.dbconnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=self.builtdatabasepath) })
         self.cjkdbbuilder = cjklib.build.DatabaseBuilder(
@@ -60,15 +66,28 @@ class DBBuilder(object):
                     'CombinedCharacterResidualStrokeCountBuilder',
                     'HanDeDictFulltextSearchBuilder', 'UnihanBMPBuilder'])
         
-        # [3/4]: build the database
+        # [3/5]: build the database
         log.info("Building the cjklib database: the target file is %s", self.builtdatabasepath)
         self.cjkdbbuilder.build(DBBuilder.wantgroups)
         
-        # [4/4]: clean up, so that we don't get errors if (when) the temporary database is deleted
+        # [4/5]: compile the dictionaries so that lookups don't have to go through SQL at all
+        for tablename in DBBuilder.compiledgroups:
+            log.info("Compiling the %s dictionary", tablename)
+            dicttable = sqlalchemy.Table(tablename, database.metadata, autoload=True)
+            writecompileddictionary(self.builtcompileddictionarypath(tablename), database.selectRows(sqlalchemy.select(
+                [dicttable.c.HeadwordSimplified, dicttable.c.HeadwordTraditional, dicttable.c.Reading, dicttable.c.Translation])))
+        
+        # [5/5]: clean up, so that we don't get errors if (when) the temporary database is deleted
         database.connection.close()
         del database.connection
         database.engine.dispose()
         del database.engine
+    
+    def install(self):
+        # NB: the compiled dictionaries must be copied after the database, so that they are seen to be at least as fresh
+        shutil.copyfile(self.builtdatabasepath, dbpath)
+        for tablename in DBBuilder.compiledgroups:
+            shutil.copyfile(self.builtcompileddictionarypath(tablename), compileddictionarypath(tablename))
 
 
 def getSatisfiers():
@@ -201,8 +220,6 @@ def getSatisfiers():
     return maxtimestamp, satisfiers
 
 if __name__ == "__main__":
-    import shutil
-    
     builder = DBBuilder(getSatisfiers()[1])
     builder.build()
-    shutil.copyfile(builder.builtdatabasepath, pinyin.utils.toolkitdir("pinyin", "db", "cjklib.db"))
+    builder.install()
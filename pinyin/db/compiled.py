@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import mmap
+import struct
+
+from pinyin.logger import log
+
+
+# A compiled dictionary is a single file laid out as follows (all integers are little-endian and unsigned):
+#  * A header: magic, format version, number of keys, number of entries
+#  * The key table: for each key, in order of the UTF-8 encoding, the offset and length of the key
+#    in the string pool along with the index of its first entry and the number of entries it has
+#  * The entry table: for each entry, the offset and length of the reading and of the translation
+#  * The string pool: every key, reading and translation, encoded as UTF-8
+#
+# A row whose simplified and traditional headwords differ gets an entry under both keys, but
+# the strings in the pool are shared between them.
+
+magic = "PTKD"
+version = 1
+
+headerstruct = struct.Struct("<4sIII")
+keystruct = struct.Struct("<IIII")
+entrystruct = struct.Struct("<IIII")
+
+"""
+Writes a compiled dictionary to the given path. The rows are (simplified, traditional, reading, translation)
+tuples, and entries for each headword keep the order in which the rows were supplied.
+"""
+def writecompileddictionary(path, rows):
+    pool, poolsize = [], [0]
+    def intern(text):
+        encoded = text.encode('utf-8')
+        offset = poolsize[0]
+        pool.append(encoded)
+        poolsize[0] += len(encoded)
+        return offset, len(encoded)
+
+    entriesbykey = {}
+    for simplified, traditional, reading, translation in rows:
+        entry = intern(reading) + intern(translation)
+        for headword in set([simplified, traditional]):
+            entriesbykey.setdefault(headword.encode('utf-8'), []).append(entry)
+
+    keys, entries = [], []
+    for key in sorted(entriesbykey.keys()):
+        keyoffset, keylength = poolsize[0], len(key)
+        pool.append(key)
+        poolsize[0] += keylength
+
+        keys.append((keyoffset, keylength, len(entries), len(entriesbykey[key])))
+        entries.extend(entriesbykey[key])
+
+    log.info("Writing compiled dictionary with %d keys and %d entries to %s", len(keys), len(entries), path)
+    file = open(path, 'wb')
+    try:
+        file.write(headerstruct.pack(magic, version, len(keys), len(entries)))
+        for key in keys:
+            file.write(keystruct.pack(*key))
+        for entry in entries:
+            file.write(entrystruct.pack(*entry))
+        for string in pool:
+            file.write(string)
+    finally:
+        file.close()
+
+"""
+Read-only view of a compiled dictionary. The file is memory mapped rather than read, so lookups
+only touch the pages they need and several processes can share the same copy of the data.
+"""
+class CompiledDictionary(object):
+    def __init__(self, path):
+        file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+
+        filemagic, fileversion, self.keycount, self.entrycount = headerstruct.unpack_from(self.data, 0)
+        if filemagic != magic or fileversion != version:
+            raise IOError("The file at %s is not a compiled dictionary this version of the Toolkit understands" % path)
+
+        self.keysoffset = headerstruct.size
+        self.entriesoffset = self.keysoffset + self.keycount * keystruct.size
+        self.pooloffset = self.entriesoffset + self.entrycount * entrystruct.size
+
+    def __len__(self):
+        return self.keycount
+
+    # Lets us use the bisect module directly on the sorted key table
+    def __getitem__(self, n):
+        return self.string(*keystruct.unpack_from(self.data, self.keysoffset + n * keystruct.size)[0:2])
+
+    def string(self, offset, length):
+        start = self.pooloffset + offset
+        return self.data[start:start + length]
+
+    def headwords(self):
+        for n in xrange(self.keycount):
+            yield self[n].decode('utf-8')
+
+    def lookup(self, word):
+        key = word.encode('utf-8')
+        n = bisect.bisect_left(self, key)
+        if n == self.keycount or self[n] != key:
+            return []
+
+        return self.entries(n)
+
+    """
+    Looks up many words at once, returning a dictionary mapping each of them to what lookup would give.
+    We look for the words in key order, so each search only has to cover the keys after the last one found.
+    """
+    def lookupmany(self, words):
+        readingstranslations = {}
+        n = 0
+        for key, word in sorted([(word.encode('utf-8'), word) for word in set(words)]):
+            n = bisect.bisect_left(self, key, n)
+            if n < self.keycount and self[n] == key:
+                readingstranslations[word] = self.entries(n)
+            else:
+                readingstranslations[word] = []
+
+        return readingstranslations
+
+    def entries(self, n):
+        _keyoffset, _keylength, firstentry, entrycount = keystruct.unpack_from(self.data, self.keysoffset + n * keystruct.size)
+
+        readingstranslations = []
+        for entry in xrange(firstentry, firstentry + entrycount):
+            readingoffset, readinglength, translationoffset, translationlength = entrystruct.unpack_from(self.data, self.entriesoffset + entry * entrystruct.size)
+            readingstranslations.append((self.string(readingoffset, readinglength).decode('utf-8'),
+                                         self.string(translationoffset, translationlength).decode('utf-8')))
+
+        return readingstranslations
+
+    def close(self):
+        self.data.close()
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import codecs
+import cPickle
+import itertools
 import os
 import re
 import meanings
@@ -12,11 +13,27 @@ from sqlalchemy.schema import Table
 from model import *
 from utils import *
 
-from db import database
+from db import database, dbpath, compileddictionarypath
+from db.compiled import CompiledDictionary
 
 from logger import log
 
 
+# Bulk lookups against the database are split into IN clauses of at most this many words, which keeps
+# us comfortably below the limit SQLite places on the number of parameters to a single query
+bulklookupsize = 400
+
+"""
+Sources are (headwords, lookup) pairs, optionally followed by a function that looks up many words at once.
+Returns that bulk lookup function, falling back on one that just makes a lookup for each word in turn.
+The bulk lookup result maps each of the words to the (reading, meaning) pairs the source has for it.
+"""
+def sourcelookupmany(source):
+    if len(source) > 2:
+        return source[2]
+    else:
+        return lambda words: dict([(word, list(source[1](word))) for word in words])
+
 def parseMeaning(meaning, simptradindex):
     meaning = zapempty(meaning)
     if meaning is None:
@@ -24,6 +41,77 @@ def parseMeaning(meaning, simptradindex):
     
     return lambda prefersimptrad, tonedcharscallback: meanings.MeaningFormatter(simptradindex, prefersimptrad).parsedefinition(meaning, tonedcharscallback)
 
+# Version of the format of the index files we keep next to file-based dictionaries
+fileindexversion = 1
+
+"""
+Indexes the lines of a file-based dictionary from the given byte offset onwards, recording the offset of
+each line under both of its headwords. Lines are only parsed properly when somebody looks them up.
+"""
+def indexlines(filename, start, offsets):
+    file = open(filename, "rb")
+    try:
+        file.seek(start)
+        offset = start
+        for line in file:
+            m = PinyinDictionary.lineregex.match(line.decode('utf-8'))
+            if m:
+                for characters in set([m.group(1), m.group(2)]):
+                    offsets.setdefault(characters, []).append(offset)
+            
+            offset += len(line)
+    finally:
+        file.close()
+    
+    return offsets
+
+"""
+Returns the headword index for a file-based dictionary. We only index the file if it has changed
+since we last saw it, and if it has just grown since then we only need to index the new lines.
+"""
+def fileindex(filename):
+    indexfilename = filename + ".index"
+    mtime, size = os.path.getmtime(filename), os.path.getsize(filename)
+    
+    index = None
+    if os.path.exists(indexfilename):
+        try:
+            file = open(indexfilename, "rb")
+            try:
+                index = cPickle.load(file)
+            finally:
+                file.close()
+        except Exception, e:
+            log.exception("Ignoring unreadable dictionary index at %s", indexfilename)
+        
+        if index is not None and index.get("version") != fileindexversion:
+            index = None
+    
+    if index is not None and index["mtime"] == mtime and index["size"] == size:
+        log.info("Using up to date dictionary index at %s", indexfilename)
+        return index["offsets"]
+    
+    contents = filecontents(filename, "rb")
+    if index is not None and index["size"] <= size and contents[index["size"] - 1:index["size"]] == "\n" and md5(contents[:index["size"]]) == index["md5"]:
+        # Lines have just been added to the end of the file, so keep what we already know
+        log.info("Extending dictionary index at %s with the lines after byte %d", indexfilename, index["size"])
+        offsets = indexlines(filename, index["size"], index["offsets"])
+    else:
+        log.info("Building dictionary index at %s", indexfilename)
+        offsets = indexlines(filename, 0, {})
+    
+    try:
+        file = open(indexfilename, "wb")
+        try:
+            cPickle.dump({ "version" : fileindexversion, "mtime" : mtime, "size" : size, "md5" : md5(contents), "offsets" : offsets }, file, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            file.close()
+    except IOError, e:
+        # Not a problem: we'll just have to index the file again next time
+        log.warn("Could not save the dictionary index to %s: %s", indexfilename, e)
+    
+    return offsets
+
 def fileSource(dictname):
     filename = toolkitdir("pinyin", "dictionaries", dictname)
     
@@ -33,39 +121,42 @@ def fileSource(dictname):
         return None
     
     log.info("Loading file-based dictionary from %s", filename)
-    file = codecs.open(filename, "r", encoding='utf-8')
-    try:
-        readingsmeanings = FactoryDict(lambda _: [])
-        maxcharacterlen = 0
-        for line in file:
-            # Match this line
-            m = PinyinDictionary.lineregex.match(line)
-            if not(m):
-                continue
-            
-            # Extract information from dictionary
-            lcharacters = m.group(1)
-            rcharacters = m.group(2)
-            raw_pinyin = m.group(3)
-            raw_definition = m.group(5)
-            
-            # Save meanings and readings
-            for characters in [lcharacters, rcharacters]:
-                # Update the maximum character length
-                maxcharacterlen = max(maxcharacterlen, len(characters))
+    return indexedFileSource(filename)
+
+def indexedFileSource(filename):
+    offsets = fileindex(filename)
+    
+    def lookup(word):
+        if word not in offsets:
+            return []
+        
+        readingsmeanings = []
+        file = open(filename, "rb")
+        try:
+            for offset in offsets[word]:
+                file.seek(offset)
+                m = PinyinDictionary.lineregex.match(file.readline().decode('utf-8'))
                 
-                # Save the readings and meanings for both simplified and traditional keys
-                readingsmeanings[characters].append((raw_pinyin, raw_definition))
-    finally:
-        file.close()
+                # The file may have been changed under our feet since we indexed it, so check we have the right line
+                if m and word in [m.group(1), m.group(2)]:
+                    readingsmeanings.append((m.group(3), parseMeaning(m.group(5), 0)))
+        finally:
+            file.close()
+        
+        return readingsmeanings
     
-    return maxcharacterlen, lambda word: [(reading, parseMeaning(meaning, 0)) for reading, meaning in readingsmeanings[word]]
+    return offsets.keys, lookup
 
 def databaseDictionarySource(tablename, simptradindex):
     log.info("Loading full dictionary from database table %s", tablename)
     
     dicttable = Table(tablename, database.metadata, autoload=True)
-    maxcharacterlen = database.selectScalar(sqlalchemy.func.max(sqlalchemy.func.length(dicttable.c.HeadwordSimplified)))
+    
+    def headwords():
+        for simplified, traditional in database.selectRows(sqlalchemy.select([dicttable.c.HeadwordSimplified, dicttable.c.HeadwordTraditional])):
+            yield simplified
+            if traditional != simplified:
+                yield traditional
     
     def inner(word):
         for reading, meaning in database.selectRows(sqlalchemy.select(
@@ -75,30 +166,130 @@ def databaseDictionarySource(tablename, simptradindex):
                                dicttable.c.HeadwordTraditional == word))):
             yield (reading, parseMeaning(meaning, simptradindex))
     
-    return maxcharacterlen, inner
+    def many(words):
+        readingsmeanings = dict([(word, []) for word in words])
+        for somewords in chunks(list(readingsmeanings.keys()), bulklookupsize):
+            for simplified, traditional, reading, meaning in database.selectRows(sqlalchemy.select(
+                    [dicttable.c.HeadwordSimplified,
+                     dicttable.c.HeadwordTraditional,
+                     dicttable.c.Reading,
+                     dicttable.c.Translation],
+                    sqlalchemy.or_(dicttable.c.HeadwordSimplified.in_(somewords),
+                                   dicttable.c.HeadwordTraditional.in_(somewords)))):
+                readingmeaning = (reading, parseMeaning(meaning, simptradindex))
+                for headword in set([simplified, traditional]):
+                    if headword in readingsmeanings:
+                        readingsmeanings[headword].append(readingmeaning)
+        
+        return readingsmeanings
+    
+    return headwords, inner, many
+
+def compiledDictionarySource(path, simptradindex):
+    log.info("Loading compiled dictionary from %s", path)
+    
+    compiled = CompiledDictionary(path)
+    
+    def parseall(readingsmeanings):
+        return [(reading, parseMeaning(meaning, simptradindex)) for reading, meaning in readingsmeanings]
+    
+    def many(words):
+        return dict([(word, parseall(readingsmeanings)) for word, readingsmeanings in compiled.lookupmany(words).items()])
+    
+    return compiled.headwords, lambda word: parseall(compiled.lookup(word)), many
+
+def dictionarySource(tablename, simptradindex):
+    # Prefer the compiled form of the table, but only if it was built along with the current database.
+    # Older installations won't have it until the next time the database gets rebuilt.
+    path = compileddictionarypath(tablename)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(dbpath):
+        return compiledDictionarySource(path, simptradindex)
+    else:
+        return databaseDictionarySource(tablename, simptradindex)
 
 def databaseReadingSource():
     log.info("Loading character reading database")
     
     readingtable = sqlalchemy.Table("CharacterPinyin", database.metadata, autoload=True)
     
-    return 1, lambda word: [(reading[0], None) for reading in database.selectRows(sqlalchemy.select([readingtable.c.Reading], readingtable.c.ChineseCharacter == word))]
+    headwords = lambda: database.selectScalars(sqlalchemy.select([readingtable.c.ChineseCharacter], distinct=True))
+    
+    def many(words):
+        readingsmeanings = dict([(word, []) for word in words])
+        for somewords in chunks(list(readingsmeanings.keys()), bulklookupsize):
+            for character, reading in database.selectRows(sqlalchemy.select([readingtable.c.ChineseCharacter, readingtable.c.Reading], readingtable.c.ChineseCharacter.in_(somewords))):
+                readingsmeanings[character].append((reading, None))
+        
+        return readingsmeanings
+    
+    return headwords, lambda word: [(reading[0], None) for reading in database.selectRows(sqlalchemy.select([readingtable.c.Reading], readingtable.c.ChineseCharacter == word))], many
 
-def squelchMeaning(maxlensource):
+def squelchMeaning(headwordssource):
     log.info("Preparing to squelch meanings")
     
-    def inner(word):
-        for reading, meaningfun in maxlensource[1](word):
-            if meaningfun is None:
-                yield reading, None
-            else:
-                def squelch(*meanargs):
-                    meaning, measurewords = meaningfun(*meanargs)
-                    return None, measurewords
-                
-                yield reading, squelch
+    def squelch(meaningfun):
+        if meaningfun is None:
+            return None
+        
+        def inner(*meanargs):
+            meaning, measurewords = meaningfun(*meanargs)
+            return None, measurewords
+        
+        return inner
+    
+    def squelchall(readingsmeanings):
+        return [(reading, squelch(meaningfun)) for reading, meaningfun in readingsmeanings]
+    
+    def many(words):
+        return dict([(word, list(squelchall(readingsmeanings))) for word, readingsmeanings in sourcelookupmany(headwordssource)(words).items()])
+    
+    return headwordssource[0], lambda word: squelchall(headwordssource[1](word)), many
+
+"""
+Prefix tree over the headwords of all the dictionary sources. Lets the segmenter find every
+headword starting at some position in a sentence with a single walk over the characters.
+"""
+class HeadwordTrie(object):
+    def __init__(self, headwords=[]):
+        # Rather than nesting one dictionary per node, we key each node by the string that spells
+        # out the path to it from the root. The value records whether that node ends a headword.
+        # This is much kinder on memory when we have a few hundred thousand headwords.
+        self.nodes = {}
+        for headword in headwords:
+            self.add(headword)
+    
+    def __contains__(self, word):
+        return self.nodes.get(word, False)
+    
+    def add(self, headword):
+        if len(headword) == 0:
+            return
+        
+        for n in range(1, len(headword)):
+            self.nodes.setdefault(headword[:n], False)
+        
+        self.nodes[headword] = True
     
-    return maxlensource[0], inner
+    """
+    Returns the lengths of all the headwords that begin at the given position in the text, longest first.
+    """
+    def matchlengths(self, text, start):
+        lengths = []
+        for end in range(start + 1, len(text) + 1):
+            isheadword = self.nodes.get(text[start:end])
+            if isheadword is None:
+                # Fell off the bottom of the trie: no longer headword can match here
+                break
+            elif isheadword:
+                lengths.append(end - start)
+        
+        lengths.reverse()
+        return lengths
+
+# Results of PinyinDictionary.parseexact, keyed by (word, source set). This is shared by every dictionary
+# object so that e.g. the updaters and the preferences preview benefit from each others lookups.
+# NB: must be cleared whenever the database is rebuilt, as it may refer to stale dictionary data.
+parseexactcache = LRUCache(20000)
 
 """
 Encapsulates one or more Chinese dictionaries, and provides the ability to transform
@@ -110,7 +301,7 @@ class PinyinDictionary(object):
     
     @classmethod
     def loadall(cls):
-        def buildDictionary(usefallback, table, simptradindex):
+        def buildDictionary(language, usefallback, table, simptradindex):
             # DEBUG - this means that we will lose measure words for languages other than English - seperate the two
             rawsources = [
                     # User dictionary has absolute priority
@@ -118,121 +309,62 @@ class PinyinDictionary(object):
                     # Pinyin Toolkit specific overrides for system dictionaries
                     fileSource('pinyin_toolkit_sydict.u8'),
                     # Main language database
-                    table and databaseDictionarySource(table, simptradindex) or None,
+                    table and dictionarySource(table, simptradindex) or None,
                     # Fallback databases for readings only if we have a non-english primary database
-                    usefallback and squelchMeaning(databaseDictionarySource("CEDICT", 1)) or None,
+                    usefallback and squelchMeaning(dictionarySource("CEDICT", 1)) or None,
                     # Unihan as a last resort - lowest quality data
                     databaseReadingSource()
                 ]
             
-            return PinyinDictionary([source for source in rawsources if source is not None])
+            return PinyinDictionary([source for source in rawsources if source is not None], language)
         
         dictionaries = {}
         for language, table, simptradindex in [('en', "CEDICT", 1), ('de', "HanDeDict", 0), ('fr', "CFDICT", 0), ('default', None, None)]:
-            dictionaries[language] = Thunk(lambda l=language, t=table, sti=simptradindex: buildDictionary(l != 'en', t, sti))
+            dictionaries[language] = Thunk(lambda l=language, t=table, sti=simptradindex: buildDictionary(l, l != 'en', t, sti))
         
         def inner(language):
             return (dictionaries.get(language, None) or dictionaries['default'])()
         
         return inner
     
-    def __init__(self, maxlenssources):
-        maxlens, self.__sources = unzip(maxlenssources)
-        self.__maxcharacterlen = max(maxlens)
+    def __init__(self, headwordssources, sourceset=None):
+        headwordss = [source[0] for source in headwordssources]
+        self.__sources = [source[1] for source in headwordssources]
+        self.__lookupmanys = [sourcelookupmany(source) for source in headwordssources]
+        
+        # Identifies our sources in the shared parseexact cache. Dictionaries that don't say what their
+        # sources are get a key of their own, so they never see results from a different dictionary.
+        self.__sourceset = sourceset or object()
+        
+        # NB: building the trie means reading every headword from every source, so delay it until we segment something
+        self.__headwordtrie = Thunk(lambda: HeadwordTrie(itertools.chain(*[headwords() for headwords in headwordss])))
+
+    """
+    Segment the string of Hanzi once, returning an analysis from which the reading, toned
+    characters and meanings can all be obtained without consulting the dictionary again.
+    """
+    def analyse(self, sentence):
+        log.info("Requested analysis of %s", sentence)
+        return SentenceAnalysis(list(self.parse(sentence)), self.tonedchars)
 
     """
     Given a string of Hanzi, return the result rendered into a list of Pinyin and unrecognised tokens (as strings).
     """
     def reading(self, sentence):
-        log.info("Requested reading for %s", sentence)
-        
-        def addword(words, _text, readingtokens):
-            # If we already have some text building up, add a preceding space.
-            # However, if the word we got looks like a period, don't do it.
-            # This ensures consistency in the treatment of Western and Chinese
-            # punctuation.  Furthermore, avoid adding double-spaces.  This is
-            # also important for punctuation consistency, because Western
-            # punctuation is typically followed by a space whereas the Chinese
-            # equivalents are not.
-            words_need_space = needsspacebeforeappend(words)
-            is_punctuation = ispunctuation(flatten(readingtokens))
-            reading_starts_with_er = len(readingtokens) > 0 and readingtokens[0].iser
-            if words_need_space and not(is_punctuation) and not(reading_starts_with_er):
-                words.append(Word(Text(u' ')))
-            
-            # Add this reading into the token list with nice formatting
-            words.append(Word.spacedwordfromunspacedtokens(readingtokens))
-        
-        return self.mapparsedtokens(sentence, addword)
+        return self.analyse(sentence).reading()
 
     """
     Given a string of Hanzi, return the result rendered into a list of characters with tone information and unrecognised tokens (as string).
     """
     def tonedchars(self, sentence):
-        log.info("Requested toned characters for %s", sentence)
-        
-        def addword(words, text, readingtokens):
-            # Match up the reading data with the characters to produce toned characters
-            words.append(Word(*(tonedcharactersfromreading(text, readingtokens))))
-        
-        return self.mapparsedtokens(sentence, addword)
-
-    def mapparsedtokens(self, sentence, addword):
-        # Represents the resulting stream of words
-        words = []
-        
-        for readingsmeanings, text in self.parse(sentence):
-            if readingsmeanings is None:
-                # A single unrecognised character: it's probably just whitespace or punctuation.
-                # Append it directly to the token list.
-                words.append(Word(Text(text)))
-            else:
-                # Got a recognised token sequence! Hooray! Use the user-supplied function to add
-                # the reading of this thing to the output
-                addword(words, text, tokenizespaceseperatedtext(readingsmeanings[0][0]))
-        
-        return words
+        return self.analyse(sentence).tonedchars()
 
     """
     Given a string of Hanzi, return meanings and measure words for the first recognisable thing in the string.
     If there is more than one recognisable thing then assume it is a phrase and don't return a meaning.
     """
     def meanings(self, sentence, prefersimptrad):
-        log.info("Requested meanings for %s", sentence)
-        
-        isfirstparsedthing = True
-        foundmeanings, foundmeasurewords = None, None
-        for readingsmeanings, text in self.parse(sentence):
-            if readingsmeanings is None and (ispunctuation(text.strip()) or text.strip() == u""):
-                # Discard punctuation and whitespace from consideration, or we don't return a reading for e.g. "你好!"
-                continue
-            
-            if not (isfirstparsedthing):
-                # This is a phrase with more than one word - let someone else translate it
-                # NB: apply this even if the first thing was an unrecognised bit of English,
-                # see <http://github.com/batterseapower/pinyin-toolkit/issues/unreads#issue/71>.
-                # We want to translate things like U盘 using Google rather than just returning "tray".
-                log.info("We found a phrase, so returning no meanings")
-                return None, None
-            
-            isfirstparsedthing = False
-            
-            if readingsmeanings is not None:
-                # A recognised thing!  Find the definition in the dictionary:
-                while len(readingsmeanings) > 0 and readingsmeanings[0][1] is None:
-                    readingsmeanings.pop(0)
-                
-                # Did we actually have a non-null meaning in there?
-                if len(readingsmeanings) == 0:
-                    # NB: we return None if there is no meaning in the codomain. This case can
-                    # occur if the character only comes
-                    log.info("We found a reading but no meaning for some text")
-                    return None, None
-                else:
-                    # Instantiate the raw definition with our particular requirements
-                    foundmeanings, foundmeasurewords = readingsmeanings[0][1](prefersimptrad, self.tonedchars)
-                    
-        return foundmeanings, foundmeasurewords
+        return self.analyse(sentence).meanings(prefersimptrad)
 
     def parse(self, sentence):
         assert type(sentence)==unicode
@@ -245,9 +377,10 @@ class PinyinDictionary(object):
         # Iterate through the text
         i = 0;
         while i < len(sentence):
-            # Try all possible word lengths (naive, but easy to code)
+            # Try the lengths of the headwords that begin here, longest first. We only need to
+            # consult the sources about the words we actually pick.
             found_something = False
-            for word_len in range(self.__maxcharacterlen, 0, -1):
+            for word_len in self.__headwordtrie().matchlengths(sentence, i):
                 candidate_word = sentence[i:i + word_len]
                 readingmeanings = self.parseexact(candidate_word)
                 if len(readingmeanings) > 0:
@@ -265,20 +398,135 @@ class PinyinDictionary(object):
                 yield (None, sentence[i:i+1])
                 i += 1
     
+    """
+    Looks up every word that parsing the given sentences might ask about, consulting each source only
+    once for all of them. Parsing those sentences afterwards is answered from the parseexact cache.
+    NB: the cache is bounded, so don't prefetch many more sentences than you are about to parse.
+    """
+    def prefetch(self, sentences):
+        words = set()
+        for sentence in sentences:
+            sentence = striphtml(sentence)
+            for i in range(len(sentence)):
+                for word_len in self.__headwordtrie().matchlengths(sentence, i):
+                    words.add(sentence[i:i + word_len])
+        
+        words = [word for word in words if (word, self.__sourceset) not in parseexactcache]
+        log.info("Prefetching %d words for %d sentences", len(words), len(sentences))
+        
+        readingsmeaningss = [lookupmany(words) for lookupmany in self.__lookupmanys]
+        for word in words:
+            parseexactcache[(word, self.__sourceset)] = concat([readingsmeanings[word] for readingsmeanings in readingsmeaningss])
+    
     # The readings and meaning functions returned for a word should correspond to each other,
     # and be returned in priority order: highest priority first
     def parseexact(self, word):
-        readingsmeanings = []
-        for source in self.__sources:
-            readingsmeanings.extend(source(word))
+        cachekey = (word, self.__sourceset)
+        readingsmeanings = parseexactcache.get(cachekey)
+        if readingsmeanings is None:
+            readingsmeanings = []
+            for source in self.__sources:
+                readingsmeanings.extend(source(word))
+            
+            # TODO: (perhaps) consolidate competing definitions from a single source if
+            # they occur as a result of simplification and we prefer simplified characters
+            
+            # TODO: match up definitions /across/ sources so that we can get measure word
+            # information in German (for example). (#120)
+            
+            parseexactcache[cachekey] = readingsmeanings
         
-        # TODO: (perhaps) consolidate competing definitions from a single source if
-        # they occur as a result of simplification and we prefer simplified characters
+        # NB: hand out a copy, because callers are allowed to modify the list
+        return list(readingsmeanings)
+
+"""
+The result of segmenting a sentence with a PinyinDictionary. Each of the views of the
+sentence is only computed when first asked for, and is then remembered.
+"""
+class SentenceAnalysis(object):
+    def __init__(self, parsed, tonedcharscallback):
+        # List of (readingsmeanings, text) pairs, exactly as produced by PinyinDictionary.parse
+        self.parsed = parsed
+        self.tonedcharscallback = tonedcharscallback
         
-        # TODO: match up definitions /across/ sources so that we can get measure word
-        # information in German (for example). (#120)
+        self.reading = Thunk(lambda: self.mapparsedtokens(self.addreadingword))
+        self.tonedchars = Thunk(lambda: self.mapparsedtokens(self.addtonedcharsword))
+        self.meaningsbysimptrad = FactoryDict(self.findmeanings)
+    
+    def meanings(self, prefersimptrad):
+        return self.meaningsbysimptrad[prefersimptrad]
+    
+    def addreadingword(self, words, _text, readingtokens):
+        # If we already have some text building up, add a preceding space.
+        # However, if the word we got looks like a period, don't do it.
+        # This ensures consistency in the treatment of Western and Chinese
+        # punctuation.  Furthermore, avoid adding double-spaces.  This is
+        # also important for punctuation consistency, because Western
+        # punctuation is typically followed by a space whereas the Chinese
+        # equivalents are not.
+        words_need_space = needsspacebeforeappend(words)
+        is_punctuation = ispunctuation(flatten(readingtokens))
+        reading_starts_with_er = len(readingtokens) > 0 and readingtokens[0].iser
+        if words_need_space and not(is_punctuation) and not(reading_starts_with_er):
+            words.append(Word(Text(u' ')))
         
-        return readingsmeanings
+        # Add this reading into the token list with nice formatting
+        words.append(Word.spacedwordfromunspacedtokens(readingtokens))
+    
+    def addtonedcharsword(self, words, text, readingtokens):
+        # Match up the reading data with the characters to produce toned characters
+        words.append(Word.fromtokens(tonedcharactersfromreading(text, readingtokens)))
+    
+    def mapparsedtokens(self, addword):
+        # Represents the resulting stream of words
+        words = []
+        
+        for readingsmeanings, text in self.parsed:
+            if readingsmeanings is None:
+                # A single unrecognised character: it's probably just whitespace or punctuation.
+                # Append it directly to the token list.
+                words.append(Word(Text(text)))
+            else:
+                # Got a recognised token sequence! Hooray! Use the supplied function to add
+                # the reading of this thing to the output
+                addword(words, text, tokenizespaceseperatedtext(readingsmeanings[0][0]))
+        
+        return words
+    
+    def findmeanings(self, prefersimptrad):
+        isfirstparsedthing = True
+        foundmeanings, foundmeasurewords = None, None
+        for readingsmeanings, text in self.parsed:
+            if readingsmeanings is None and (ispunctuation(text.strip()) or text.strip() == u""):
+                # Discard punctuation and whitespace from consideration, or we don't return a reading for e.g. "你好!"
+                continue
+            
+            if not (isfirstparsedthing):
+                # This is a phrase with more than one word - let someone else translate it
+                # NB: apply this even if the first thing was an unrecognised bit of English,
+                # see <http://github.com/batterseapower/pinyin-toolkit/issues/unreads#issue/71>.
+                # We want to translate things like U盘 using Google rather than just returning "tray".
+                log.info("We found a phrase, so returning no meanings")
+                return None, None
+            
+            isfirstparsedthing = False
+            
+            if readingsmeanings is not None:
+                # A recognised thing!  Find the definition in the dictionary. NB: don't modify
+                # readingsmeanings itself, because the reading is taken from its first entry
+                meaningfunctions = [meaning for _reading, meaning in readingsmeanings if meaning is not None]
+                
+                # Did we actually have a non-null meaning in there?
+                if len(meaningfunctions) == 0:
+                    # NB: we return None if there is no meaning in the codomain. This case can
+                    # occur if the character only comes
+                    log.info("We found a reading but no meaning for some text")
+                    return None, None
+                else:
+                    # Instantiate the raw definition with our particular requirements
+                    foundmeanings, foundmeasurewords = meaningfunctions[0](prefersimptrad, self.tonedcharscallback)
+                    
+        return foundmeanings, foundmeasurewords
 
 def combinemeaningsmws(dictmeanings, dictmeasurewords):
     if dictmeasurewords is not None and len(dictmeasurewords) > 0:
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import urllib2
-import re
+import Queue
 import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib2
 
 from model import Text, Word
 from logger import log
@@ -13,10 +18,55 @@ import utils
 # For now this modle provides support for google translate. In the future more dictionaries may be added.
 
 
-# Translate the parsed text from Chinese into target language using google translate:
-def gTrans(query, destlanguage='en', prompterror=True):
+# Where we send queries to Google Translate: the blanks are the query, source language and destination language
+translateurl = "http://translate.google.com/translate_a/t?client=j&text=%s&sl=%s&tl=%s"
+
+# How many seconds we give Google Translate to connect or send us something before giving up on it
+translatetimeout = 10
+
+# How many seconds we wait for an answer before giving up on it. This is longer than the above, because the
+# query may have to wait its turn behind others, but we must never wait forever: we may be holding up the GUI.
+answertimeout = 30
+
+# The language we translate from
+sourcelanguage = 'zh-CN'
+
+# Translate the parsed text from Chinese into target language using google translate. If offline is set,
+# we only give translations we have saved from before, and never go online for new ones.
+def gTrans(query, destlanguage='en', prompterror=True, offline=False):
     log.info("Using Google translate to determine the unknown translation of %s", query)
+    
+    query = cleanquery(query)
+    if query is None:
+        return None
+    
+    # Wait for the answer, which may mean waiting for someone else who asked the same thing
+    return meaningsfromanswer(translationclient.answer(query, destlanguage, wait=True, offline=offline), prompterror)
 
+"""
+Like gTrans, but never waits for Google. If the answer hasn't arrived yet, we return None straight
+away and ask for it in the background, calling whenanswered (on some other thread) once we have it.
+We don't call whenanswered if all we got was an error: asking again would most likely just fail again.
+"""
+def gTransAsync(query, destlanguage='en', prompterror=True, whenanswered=None, offline=False):
+    query = cleanquery(query)
+    if query is None:
+        return None
+    
+    def answered(answer):
+        if isinstance(answer, Exception):
+            log.info("Not passing on the error from Google Translate for %s: %s", query, answer)
+        else:
+            whenanswered()
+    
+    answer = translationclient.answer(query, destlanguage, whenanswered=whenanswered and answered, offline=offline)
+    if answer is pending:
+        log.info("Asked Google translate for the translation of %s in the background", query)
+        return None
+    
+    return meaningsfromanswer(answer, prompterror)
+
+def cleanquery(query):
     # No meanings if we don't have a query
     if query == None:
         return None
@@ -25,32 +75,162 @@ def gTrans(query, destlanguage='en', prompterror=True):
     query = utils.striphtml(query)
     if query.strip() == u"":
         return None
+    
+    return query
 
-    try:
+def meaningsfromanswer(answer, prompterror):
+    if not isinstance(answer, Exception):
         # Return the meanings (or lack of them) directly
-        return lookup(query, destlanguage)
-    except urllib2.URLError, e:
+        return answer
+    elif isinstance(answer, IOError):
         # The only 'meaning' should be an error telling the user that there was some problem
-        log.exception("Error while trying to obtain Google response")
+        log.error("Error while trying to obtain Google response: %s", answer)
         if prompterror:
             return [[Word(Text('<span style="color:gray">[Internet Error]</span>'))]]
         else:
             return None
-    except ValueError, e:
+    else:
         # Not an internet problem
-        log.exception("Error while interpreting translation response from Google")
+        log.error("Error while interpreting translation response from Google: %s", answer)
         if prompterror:
             return [[Word(Text('<span style="color:gray">[Error In Google Translate Response]</span>'))]]
         else:
             return None
 
+# Stands in for an answer that hasn't arrived yet
+pending = object()
+
+"""
+Makes queries to Google Translate on background threads. Several people asking the same question
+before the answer comes back share a single query, and we remember the answers for next time,
+in the persistent cache (if we have one) as well as in memory. If the network lets us down we
+take note, so that the Toolkit can stop relying on Google.
+"""
+class TranslationClient(object):
+    def __init__(self, lookup, workers=2, cache=None):
+        self.lookup = lookup
+        self.workers = workers
+        self.cache = cache
+        
+        # Whether Google appears to be reachable. We don't know until we've asked it something.
+        self.reachable = None
+        
+        self.lock = threading.Lock()
+        self.queries = Queue.Queue()
+        self.threads = []
+        
+        # Answers so far, either meanings or the ValueError we got trying to interpret Google's response.
+        # NB: we don't remember IOErrors, because the network might come back.
+        self.answers = utils.LRUCache(1000)
+        
+        # The queries in progress, mapping to the functions to call once they are answered
+        self.inflight = {}
+    
+    """
+    Returns the answer to the query, or if we don't have it yet, asks for it and returns pending. The
+    answer is the meanings or the exception raised trying to get them. If we have to ask for the answer,
+    calls whenanswered with it once it arrives or, if wait is set, waits for it (for at most answertimeout
+    seconds, after which the answer is None) and returns it. If offline is set, we never ask: the answer is
+    just None (i.e. no meanings) if we don't have it already.
+    """
+    def answer(self, query, destlanguage, whenanswered=None, wait=False, offline=False):
+        key = (query, destlanguage)
+        if wait:
+            arrived, answers = threading.Event(), []
+            whenanswered = lambda answer: answers.append(answer) or arrived.set()
+        
+        self.lock.acquire()
+        try:
+            answer = self.answers.get(key, pending)
+            if answer is pending and self.cache is not None:
+                answer = self.cache.get((query, sourcelanguage, destlanguage), pending)
+                if answer is not pending:
+                    self.answers[key] = answer
+            
+            if answer is not pending:
+                return answer
+            elif offline:
+                log.info("Not asking Google for the translation of %s because we are offline", query)
+                return None
+            
+            if key in self.inflight:
+                # Someone has already asked: we'll get the answer they get
+                log.info("Waiting for the Google translation of %s already in progress", query)
+            else:
+                self.inflight[key] = []
+                self.queries.put(key)
+                if len(self.threads) < self.workers:
+                    self.startthread()
+            
+            if whenanswered is not None:
+                self.inflight[key].append(whenanswered)
+        finally:
+            self.lock.release()
+        
+        if not wait:
+            return pending
+        
+        arrived.wait(answertimeout)
+        if not arrived.isSet():
+            log.warn("Gave up waiting for the Google translation of %s", query)
+            return None
+        
+        return answers[0]
+    
+    def startthread(self):
+        thread = threading.Thread(target=self.work, name="Google Translate")
+        thread.setDaemon(True)
+        thread.start()
+        self.threads.append(thread)
+    
+    def work(self):
+        while True:
+            query, destlanguage = key = self.queries.get()
+            try:
+                answer = self.lookup(query, destlanguage)
+                self.reachable = True
+            except IOError, e:
+                answer = e
+                self.reachable = False
+            except ValueError, e:
+                answer = e
+                self.reachable = True
+            except Exception, e:
+                # Don't let anything kill the thread or leave anyone waiting. Treat it like a network
+                # problem, since it may well be one (e.g. a broken HTTP response), and stop relying on
+                # Google: otherwise everyone who asks again just gets the same failure.
+                log.exception("Unexpected error while querying Google Translate")
+                answer = IOError(str(e))
+                self.reachable = False
+            
+            # NB: remember the answer before handing it out, so that anyone who updates a fact in response
+            # to the answer arriving (or who comes back to the fact later) finds it without asking again
+            self.lock.acquire()
+            try:
+                if not isinstance(answer, IOError):
+                    self.answers[key] = answer
+                
+                # Only the meanings are worth keeping between sessions: Google may understand next time
+                if self.cache is not None and not isinstance(answer, Exception):
+                    self.cache[(query, sourcelanguage, destlanguage)] = answer
+                
+                inflight = self.inflight.pop(key)
+            finally:
+                self.lock.release()
+            
+            for whenanswered in inflight:
+                try:
+                    whenanswered(answer)
+                except Exception, e:
+                    log.exception("Error while handing out the answer from Google Translate")
+
 # This function will send a sample query to Google Translate and return true or false depending on success
 # It is used to determine connectivity for the Anki session (and thus whether Pinyin Toolkit should use online services or not)
 def gCheck(destlanguage='en'):
     try:
         lookup(u"好", destlanguage)
         return True
-    except urllib2.URLError:
+    except IOError:
         return False
     except ValueError:
         # Arguably could return True here, because it's not that the website is offline
@@ -59,17 +239,18 @@ def gCheck(destlanguage='en'):
 # The lookup function is based on code from the Chinese Example Sentence Plugin by <aaron@lamelion.com>
 def lookup(query, destlanguage):
     # Set up URL
-    url = "http://translate.google.com/translate_a/t?client=j&text=%s&sl=%s&tl=%s" % (utils.urlescape(query), 'zh-CN', destlanguage)
+    url = translateurl % (utils.urlescape(query), sourcelanguage, destlanguage)
     con = urllib2.Request(url, headers={'User-Agent':'Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11'}, origin_req_host='http://translate.google.com')
     
     # Open the connection
     log.info("Issuing Google query for %s to %s", query, url)
-    req = urllib2.urlopen(con)
+    req = urllib2.urlopen(con, timeout=translatetimeout)
     
-    # Build the result literal from the request
-    literal = u""
-    for line in req:
-        literal += line.decode('utf-8')
+    # Read the result literal from the request in one go
+    try:
+        literal = req.read().decode('utf-8')
+    finally:
+        req.close()
         
     # Parse the response:
     try:
@@ -182,6 +363,80 @@ def lookup(query, destlanguage):
 def parsegoogleresponse(response):
     return json.loads(response)
 
+"""
+Translations we got from Google, saved to disk so that we don't have to ask again in later sessions
+(or at all, when offline). Keys are (query, source language, destination language) and values are
+meanings. Entries expire after ttl seconds, and the oldest ones go once there are more than maxsize.
+"""
+class TranslationCache(object):
+    # Version of the format of the saved translations
+    version = 1
+    
+    def __init__(self, cachepath, ttl=30 * 24 * 60 * 60, maxsize=20000):
+        self.cachepath = cachepath
+        self.ttl = ttl
+        self.maxsize = maxsize
+        
+        # SQLite connections can only be used from the thread that created them, so each thread makes its own
+        self.connection = utils.ThreadLocalThunk(self.connect)
+    
+    def connect(self):
+        connection = sqlite3.connect(self.cachepath, timeout=translatetimeout)
+        connection.execute("create table if not exists Translations (Query text, SourceLanguage text, DestLanguage text, Version integer, Meanings text, Saved real, "
+                           "primary key (Query, SourceLanguage, DestLanguage))")
+        connection.execute("create index if not exists TranslationsBySaved on Translations (Saved)")
+        connection.commit()
+        return connection
+    
+    def get(self, key, default=None):
+        # Don't make the file just to find that there's nothing in it
+        if not os.path.exists(self.cachepath):
+            return default
+        
+        try:
+            row = self.connection().execute("select Version, Meanings, Saved from Translations where Query = ? and SourceLanguage = ? and DestLanguage = ?", key).fetchone()
+        except sqlite3.Error, e:
+            log.warn("Could not read translations from %s: %s", self.cachepath, e)
+            return default
+        
+        if row is None:
+            return default
+        
+        version, meanings, saved = row
+        if version != TranslationCache.version or saved < time.time() - self.ttl:
+            log.info("The saved translation of %s is too old to use", key[0])
+            return default
+        
+        return meaningsfromjson(meanings)
+    
+    def __setitem__(self, key, meanings):
+        try:
+            connection = self.connection()
+            connection.execute("insert or replace into Translations values (?, ?, ?, ?, ?, ?)", key + (TranslationCache.version, meaningstojson(meanings), time.time()))
+            self.evict(connection)
+            connection.commit()
+        except sqlite3.Error, e:
+            # Not a problem: we'll just have to ask Google again next time
+            log.warn("Could not save the translation of %s to %s: %s", key[0], self.cachepath, e)
+    
+    def evict(self, connection):
+        connection.execute("delete from Translations where Saved < ?", (time.time() - self.ttl,))
+        
+        excess = connection.execute("select count(*) from Translations").fetchone()[0] - self.maxsize
+        if excess > 0:
+            log.info("Forgetting the %d oldest saved translations", excess)
+            connection.execute("delete from Translations where rowid in (select rowid from Translations order by Saved limit ?)", (excess,))
+
+# We save the meanings as the text of each token of each word of each meaning
+def meaningstojson(meanings):
+    return json.dumps(meanings and [[[unicode(token) for token in word] for word in meaning] for meaning in meanings])
+
+def meaningsfromjson(text):
+    meanings = json.loads(text)
+    return meanings and [[Word(*[Text(token) for token in word]) for word in meaning] for meaning in meanings]
+
+translationclient = TranslationClient(lambda query, destlanguage: lookup(query, destlanguage), cache=TranslationCache(utils.toolkitdir("pinyin", "ptktranslations.db")))
+
 ################################################################################
 #Indicators
 # Future interest in having icons above the facteditor representing various dictionaries
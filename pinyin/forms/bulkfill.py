@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from aqt.qt import QProgressDialog, Qt, SIGNAL, SLOT
+
+from pinyin.logger import log
+
+
+"""
+Progress dialog shown while a bulk fill runs in the background. It only closes when the
+controller says so: cancelling just asks the controller to stop the worker at the next
+opportunity, so we never leave a thread running after the dialog has gone away.
+"""
+class BulkFill(QProgressDialog):
+    def __init__(self, parent, title):
+        QProgressDialog.__init__(self, parent)
+        self.setWindowTitle(title)
+        self.setWindowModality(Qt.WindowModal)
+        self.setCancelButtonText("Cancel")
+        self.setMinimumDuration(0)
+        self.setAutoClose(False)
+        self.setAutoReset(False)
+        
+        # Stop the cancel button from hiding the dialog behind our backs
+        self.disconnect(self, SIGNAL("canceled()"), self, SLOT("cancel()"))
+    
+    def reject(self):
+        # e.g. the user pressed Escape: treat this just like the cancel button
+        log.info("User asked to close the bulk fill dialog")
+        self.emit(SIGNAL("canceled()"))
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import Queue
+import sys
+
+from aqt.qt import QObject, QThread, QDialog, Qt, SIGNAL
+from pinyin.db import closedatabase
+from pinyin.logger import log
+
+
+"""
+Runs actions on the main thread on behalf of a worker thread, which waits for the result (or, if
+the action is posted, just gets on with its work). Only the main thread may touch the GUI or the
+Anki collection, so a worker has to do those things through one of these. NB: must be constructed
+on the main thread.
+"""
+class MainThreadInvoker(QObject):
+    def __init__(self):
+        QObject.__init__(self)
+        self.connect(self, SIGNAL("invoke(PyQt_PyObject)"), self.invoked, Qt.QueuedConnection)
+        self.connect(self, SIGNAL("post(PyQt_PyObject)"), self.posted, Qt.QueuedConnection)
+    
+    def invoked(self, request):
+        action, results = request
+        try:
+            results.put((True, action()))
+        except Exception, e:
+            results.put((False, sys.exc_info()))
+    
+    def posted(self, action):
+        try:
+            action()
+        except Exception, e:
+            log.exception("Suppressed exception in action posted to the main thread")
+    
+    def __call__(self, action):
+        if QThread.currentThread() == self.thread():
+            return action()
+        
+        results = Queue.Queue()
+        self.emit(SIGNAL("invoke(PyQt_PyObject)"), (action, results))
+        succeeded, result = results.get()
+        if succeeded:
+            return result
+        else:
+            raise result[0], result[1], result[2]
+    
+    # Runs the action on the main thread some time soon, without waiting for it. Use this when the main thread
+    # might itself be waiting for us, or we could wait for each other forever.
+    def post(self, action):
+        self.emit(SIGNAL("post(PyQt_PyObject)"), action)
+
+"""
+Wraps an object (e.g. the notifier or media manager) so that any method called on it from a worker thread runs on the main thread.
+"""
+class MainThreadProxy(object):
+    def __init__(self, target, invoker):
+        self.target = target
+        self.invoker = invoker
+    
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.invoker(lambda: getattr(self.target, name)(*args, **kwargs))
+
+class BulkFillController(object):
+    def __init__(self, view, notifier, invoker, batches, loadbatch, updatebatch, savebatch):
+        # Reflect the size of the job into the progress bar
+        total = sum([len(batch) for batch in batches])
+        view.setLabelText("Updating %d notes..." % total)
+        view.setRange(0, total)
+        view.setValue(0)
+        
+        # Create and run a thread that does the updating. Loading and saving touch the Anki collection,
+        # so happen on the main thread. Everything in between is done in the background.
+        class Worker(QThread):
+            def __init__(self):
+                QThread.__init__(self)
+                self.cancelled = False
+            
+            def run(self):
+                try:
+                    done = 0
+                    for batch in batches:
+                        if self.cancelled:
+                            log.info("Bulk fill cancelled after %d notes", done)
+                            break
+                        
+                        items = invoker(lambda: loadbatch(batch))
+                        changeditems = updatebatch(items, lambda: self.cancelled)
+                        
+                        # Stream the results back: the main thread saves them while we get on with the next batch
+                        done += len(batch)
+                        self.emit(SIGNAL("batchdone(PyQt_PyObject)"), (changeditems, done))
+                    
+                    self.emit(SIGNAL("fillfinished()"))
+                except Exception, e:
+                    log.exception("Suppressed exception in bulk fill process")
+                    self.emit(SIGNAL("fillfailure(PyQt_PyObject)"), sys.exc_info())
+                finally:
+                    # We're done with the connection we made to look things up in the background
+                    closedatabase()
+        
+        # NB: as in the BuildDBController, the QThread must not be garbage collected while it is running,
+        # so our user has to keep hold of this controller until the dialog is closed.
+        self.thread = Worker()
+        
+        def batchDone(result):
+            changeditems, done = result
+            savebatch(changeditems)
+            view.setValue(done)
+        
+        def cancel():
+            log.info("User cancelled the bulk fill")
+            view.setLabelText("Cancelling...")
+            self.thread.cancelled = True
+        
+        def fillFailure(e):
+            notifier.exception("There was an error while filling in the missing information!", e)
+            view.done(QDialog.Rejected)
+        
+        view.connect(self.thread, SIGNAL("batchdone(PyQt_PyObject)"), batchDone)
+        view.connect(self.thread, SIGNAL("fillfinished()"), lambda: view.done(self.thread.cancelled and QDialog.Rejected or QDialog.Accepted))
+        view.connect(self.thread, SIGNAL("fillfailure(PyQt_PyObject)"), lambda e: fillFailure(e))
+        view.connect(view, SIGNAL("canceled()"), cancel)
+        
+        # GO!
+        self.thread.start()
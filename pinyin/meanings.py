@@ -7,6 +7,18 @@ from logger import log
 from model import *
 import utils
 
+# Definitions we have parsed recently, keyed by the raw definition and the simplified/traditional settings.
+# The same common words come up over and over again in a bulk fill, and parsing them is not cheap.
+parseddefinitions = utils.LRUCache(5000)
+
+"""
+Stands in for the words the toned characters callback would give for some characters in a remembered
+definition, because the callback can be different each time we hand the definition out.
+"""
+class TonedCharactersPlaceholder(object):
+    def __init__(self, characters):
+        self.characters = characters
+
 class MeaningFormatter(object):
     embeddedchineseregex = re.compile(r"(?:(?:([^\|\[\s]+)\|([^\|\[\s]+)(?:\s*\[([^\]]*)\])?)|(?:([^\|\[\s]+)\s*\[([^\]]*)\]))")
     
@@ -15,12 +27,34 @@ class MeaningFormatter(object):
         self.prefersimptrad = prefersimptrad
     
     def parsedefinition(self, raw_definition, tonedchars_callback=None):
-        log.info("Parsing the raw definition %s", raw_definition)
-        
         # Default the toned characters callback to something sensible
         if tonedchars_callback is None:
             tonedchars_callback = lambda characters: [Word(Text(characters))]
         
+        cachekey = (raw_definition, self.simplifiedcharindex, self.prefersimptrad)
+        parsed = parseddefinitions.get(cachekey)
+        if parsed is None:
+            parsed = self.parsedefinitionwith(raw_definition, lambda characters: [TonedCharactersPlaceholder(characters)])
+            parseddefinitions[cachekey] = parsed
+        
+        # NB: hand out fresh words, because callers are allowed to modify them. The tokens themselves are shared.
+        meaningswithplaceholders, measurewords = parsed
+        meanings = []
+        for wordswithplaceholders in meaningswithplaceholders:
+            words = []
+            for word in wordswithplaceholders:
+                if isinstance(word, TonedCharactersPlaceholder):
+                    words.extend(tonedchars_callback(word.characters))
+                else:
+                    words.append(Word.fromtokens(word))
+            
+            meanings.append(words)
+        
+        return meanings, [([Word.fromtokens(word) for word in characterswords], [Word.fromtokens(word) for word in pinyinwords]) for characterswords, pinyinwords in measurewords]
+    
+    def parsedefinitionwith(self, raw_definition, tonedchars_callback):
+        log.info("Parsing the raw definition %s", raw_definition)
+        
         meanings, measurewords = [], []
         for definition in raw_definition.strip().lstrip("/").rstrip("/").split("/"):
             # Remove stray spaces
@@ -60,7 +94,7 @@ class MeaningFormatter(object):
                     else:
                         # Just a string: append it as a list of tokens, trying to extract any otherwise-unmarked
                         # pinyin in the sentence for colorisation etc
-                        words.append(Word(*tokenize(thing, forcenumeric=True)))
+                        words.append(Word.fromtokens(tokenize(thing, forcenumeric=True)))
                 
                 meanings.append(words)
             
@@ -87,7 +121,7 @@ class MeaningFormatter(object):
         if rawpinyin != None:
             # There was some pinyin for the character after it - include it
             pinyintokens = tokenizespaceseperatedtext(rawpinyin)
-            return ([Word(*(tonedcharactersfromreading(character, pinyintokens)))], [Word.spacedwordfromunspacedtokens(pinyintokens)])
+            return ([Word.fromtokens(tonedcharactersfromreading(character, pinyintokens))], [Word.spacedwordfromunspacedtokens(pinyintokens)])
         else:
             # Look up the tone for the character so we can display it more nicely, as in the other branch
             return (tonedchars_callback(character), None)
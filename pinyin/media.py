@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cPickle
 import os
 import re
 import urllib
@@ -101,6 +102,17 @@ class MediaPack(object):
         
         # Normalize capitalisation for ease of lookup
         self.media = dict([(name.lower(), filename) for name, filename in media.items()])
+        
+        # Memoizes mediaforany, as we get asked about the same few hundred syllables over and over
+        self.mediaforanycache = {}
+    
+    # No point in saving the memo table along with the pack (e.g. in a MediaCatalog)
+    def __getstate__(self):
+        return { "packpath" : self.packpath, "media" : self.media }
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mediaforanycache = {}
     
     def __str__(self):
         return self.name
@@ -140,15 +152,124 @@ class MediaPack(object):
         # No suitable media existed!
         return None
     
+    """
+    Finds media for the first of the base names we have some for, trying every extension for each one.
+    """
+    def mediaforany(self, basenames, audioextensions):
+        key = (tuple(basenames), tuple(audioextensions))
+        if key not in self.mediaforanycache:
+            media = None
+            for basename in basenames:
+                media = self.mediafor(basename, audioextensions)
+                if media:
+                    break
+            
+            self.mediaforanycache[key] = media
+        
+        return self.mediaforanycache[key]
+    
     @classmethod
     def frompath(cls, packpath):
         media = {}
         for filename in os.listdir(packpath):
-            log.info("Discovered media %s in %s", filename, packpath)
             media[filename] = os.path.join(packpath, filename)
         
+        log.info("Discovered %d media files in %s", len(media), packpath)
         return MediaPack(packpath, media)
 
+"""
+Remembers the media packs in a media directory, along with the modification times of the directories
+we found them in. Only directories that have changed since we last looked get listed again, which saves
+us a lot of disk access because we look for packs every time we generate some audio. If given a path,
+the catalog is kept on disk so that it stays useful between sessions.
+
+The media directory itself changes whenever Anki adds any media to the collection, and is mostly full of
+such files, so when it changes we only check the entries we haven't seen before to see if they are packs.
+"""
+class MediaCatalog(object):
+    # Version of the format of the saved catalog
+    version = 2
+    
+    def __init__(self, catalogpath=None):
+        self.catalogpath = catalogpath
+        
+        # Map from media directory to its modification time, the paths of the packs inside it, and the
+        # names of the other things inside it (which we know not to be packs)
+        self.packpaths = {}
+        # Map from pack directory to its modification time and the corresponding MediaPack
+        self.packs = {}
+        
+        if catalogpath is not None and os.path.exists(catalogpath):
+            try:
+                file = open(catalogpath, "rb")
+                try:
+                    catalog = cPickle.load(file)
+                finally:
+                    file.close()
+                
+                if catalog["version"] == MediaCatalog.version:
+                    self.packpaths, self.packs = catalog["packpaths"], catalog["packs"]
+            except Exception, e:
+                log.exception("Ignoring unreadable media catalog at %s", catalogpath)
+    
+    def discovermediapacks(self, mediadir):
+        changed = False
+        
+        mtime = os.path.getmtime(mediadir)
+        lastmtime, lastpackpaths, lastnotpacks = self.packpaths.get(mediadir, (None, [], set()))
+        if lastmtime != mtime:
+            packpaths, notpacks = [], set()
+            for packname in os.listdir(mediadir):
+                # Skip the download cache directory, and things we already know aren't packs
+                packpath = os.path.join(mediadir, packname)
+                if packname.lower() == "downloads" or packname in lastnotpacks:
+                    notpacks.add(packname)
+                    continue
+                
+                # Only try and process directories as packs. NB: we check the ones we already knew about
+                # again, in case they have been replaced by something else
+                if os.path.isdir(packpath):
+                    if packpath not in lastpackpaths:
+                        log.info("Considering %s as a media pack", packname)
+                    packpaths.append(packpath)
+                else:
+                    notpacks.add(packname)
+            
+            self.packpaths[mediadir] = (mtime, packpaths, notpacks)
+            changed = True
+        
+        packs = []
+        for packpath in self.packpaths[mediadir][1]:
+            # The pack directory might have been deleted since we listed the media directory
+            if not(os.path.isdir(packpath)):
+                continue
+            
+            packmtime = os.path.getmtime(packpath)
+            if self.packs.get(packpath, (None, None))[0] != packmtime:
+                self.packs[packpath] = (packmtime, MediaPack.frompath(packpath))
+                changed = True
+            
+            packs.append(self.packs[packpath][1])
+        
+        if changed:
+            self.save()
+        
+        return packs
+    
+    def save(self):
+        if self.catalogpath is None:
+            return
+        
+        try:
+            file = open(self.catalogpath, "wb")
+            try:
+                cPickle.dump({ "version" : MediaCatalog.version, "packpaths" : self.packpaths, "packs" : self.packs }, file, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                file.close()
+        except IOError, e:
+            # Not a problem: we'll just have to list the directories again next time
+            log.warn("Could not save the media catalog to %s: %s", self.catalogpath, e)
+
 # Use to discover files in the media directory that are not referenced in the media
 # database. If this is true, the user has just copied them in - and we consider
 # such things "legacy" sounds that should be replaced with a true media pack.
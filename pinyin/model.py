@@ -3,12 +3,11 @@
 
 import htmlentitydefs
 import re
-from BeautifulSoup import BeautifulSoup, Tag
-import sqlalchemy
+import sgmllib
 import unicodedata
 
 import utils
-from db import database
+from pinyinsyllables import validpinyin
 
 from logger import log
 
@@ -58,24 +57,35 @@ def waysToSubstituteAwayUUmlaut(inwhat):
 #  5) Neutral
 
 """
-Represents the spoken and written tones of something in the system.
+Represents the spoken and written tones of something in the system. There are only a few dozen
+possible ToneInfos and nobody ever modifies one, so each is made once and then shared.
 """
 class ToneInfo(object):
-    def __init__(self, written=None, spoken=None):
-        object.__init__(self)
-        
+    __slots__ = ("written", "spoken")
+    
+    def __new__(cls, written=None, spoken=None):
         if written is None and spoken is None:
             raise ValueError("At least one of the tones supplied to ToneInfo must be non-None")
         
         # Default the written tone to the spoken one and vice-versa
-        self.written = written or spoken
-        self.spoken = spoken or written
+        written, spoken = written or spoken, spoken or written
+        
+        self = internedtoneinfos.get((written, spoken))
+        if self is None:
+            self = object.__new__(cls)
+            self.written = written
+            self.spoken = spoken
+            internedtoneinfos[(written, spoken)] = self
+        
+        return self
 
     def __repr__(self):
         return u"ToneInfo(written=%s, spoken=%s)" % (repr(self.written), repr(self.spoken))
     
     def __eq__(self, other):
-        if other is None or other.__class__ != self.__class__:
+        if other is self:
+            return True
+        elif other is None or other.__class__ != self.__class__:
             return False
         
         return other.written == self.written and other.spoken == self.spoken
@@ -83,16 +93,34 @@ class ToneInfo(object):
     def __ne__(self, other):
         return not(self == other)
 
+# The ToneInfos made so far, keyed by their written and spoken tones
+internedtoneinfos = {}
+
+"""
+The HTML attributes of all the tokens that don't have any. Since it is shared, it may not be modified.
+NB: the attributes of a token may be shared with other tokens in any case, so whoever wants to change
+them should give the token a modified copy instead.
+"""
+class NoHTMLAttrs(dict):
+    def readonly(self, *args, **kwargs):
+        raise TypeError("The empty HTML attributes are shared between tokens and cannot be modified")
+    
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = readonly
+
+noattrs = NoHTMLAttrs()
+
 """
 Represents a purely textual token.
 """
 class Text(unicode):
+    __slots__ = ("htmlattrs",)
+    
     def __new__(cls, text, htmlattrs=None):
         if len(text) == 0:
             raise ValueError("All Text tokens must be non-empty")
         
         self = unicode.__new__(cls, text)
-        self.htmlattrs = htmlattrs or {}
+        self.htmlattrs = htmlattrs or noattrs
         return self
 
     iser = property(lambda self: False)
@@ -112,14 +140,15 @@ class Text(unicode):
     def accept(self, visitor):
         return visitor.visitText(self)
 
+# Results of Pinyin.parse, keyed by the text and whether it had to be numeric. Each is either
+# the (word, toneinfo) that the text parsed into or the message explaining why it didn't parse.
+parsecache = utils.LRUCache(5000)
+
 """
 Represents a single Pinyin character in the system.
 """
 class Pinyin(object):
-    # Extract a simple regex of all the possible pinyin.
-    # NB: we have to delay-load  this in order to give the UI a chance to create the database if it is missing
-    # NB: we only need to consider the ü versions because the regex is used to check *after* we have normalised to ü
-    validpinyin = utils.Thunk(lambda: set(["r"] + [substituteForUUmlaut(pinyin[0]).lower() for pinyin in database.selectRows(sqlalchemy.select([sqlalchemy.Table("PinyinSyllables", database.metadata, autoload=True).c.Pinyin]))]))
+    __slots__ = ("word", "toneinfo", "htmlattrs")
     
     def __init__(self, word, toneinfo, htmlattrs=None):
         self.word = word
@@ -130,7 +159,7 @@ class Pinyin(object):
         else:
             self.toneinfo = toneinfo
         
-        self.htmlattrs = htmlattrs or {}
+        self.htmlattrs = htmlattrs or noattrs
     
     iser = property(lambda self: self.word.lower() == u"r" and self.toneinfo.written == 5)
 
@@ -162,7 +191,8 @@ class Pinyin(object):
             return self.word + str(getattr(self.toneinfo, tone))
     
     def tonifiedformat(self):
-        return PinyinTonifier().tonify(self.numericformat(hideneutraltone=False))
+        numeric = self.numericformat(hideneutraltone=False)
+        return tonifiedsyllables.get(numeric) or PinyinTonifier().tonify(numeric)
 
     """
     Constructs a Pinyin object from text representing a single character and numeric tone mark
@@ -173,6 +203,26 @@ class Pinyin(object):
     """
     @classmethod
     def parse(cls, text, forcenumeric=False):
+        # There are only so many syllables, and we see the same ones over and over (e.g. in every dictionary
+        # reading) so remember how each one parsed. Failures are remembered too, as their error message.
+        parsed = parsecache.get((text, forcenumeric))
+        if parsed is None:
+            try:
+                parsed = cls.parsewordtoneinfo(text, forcenumeric)
+            except ValueError, e:
+                parsed = e.args[0]
+            
+            parsecache[(text, forcenumeric)] = parsed
+        
+        if isinstance(parsed, basestring):
+            raise ValueError(parsed)
+        
+        # NB: the Pinyin must be fresh, because whoever gets it can give it some HTML attributes
+        word, toneinfo = parsed
+        return Pinyin(word, toneinfo)
+    
+    @classmethod
+    def parsewordtoneinfo(cls, text, forcenumeric):
         # Normalise u: and v: into umlauted version:
         # NB: might think about doing lower() here, as some dictionary words have upper case (e.g. proper names)
         text = substituteForUUmlaut(text)
@@ -215,17 +265,19 @@ class Pinyin(object):
             word = unicodedata.normalize('NFC', word)
         
         # Sanity check to catch English/French/whatever that doesn't look like pinyin
-        if word.lower() not in cls.validpinyin():
+        if word.lower() not in validpinyin:
             log.info("Couldn't find %s in the valid pinyin list", word)
             raise ValueError(u"The proposed pinyin '%s' doesn't look like pinyin after all" % text)
         
         # We now have a word and tone info, whichever route we took
-        return Pinyin(word, toneinfo)
+        return word, toneinfo
 
 """
 Represents a Chinese character with tone information in the system.
 """
 class TonedCharacter(unicode):
+    __slots__ = ("toneinfo", "htmlattrs")
+    
     def __new__(cls, character, toneinfo, htmlattrs=None):
         if len(character) == 0:
             raise ValueError("All TonedCharacters tokens must be non-empty")
@@ -238,7 +290,7 @@ class TonedCharacter(unicode):
         else:
             self.toneinfo = toneinfo
         
-        self.htmlattrs = htmlattrs or {}
+        self.htmlattrs = htmlattrs or noattrs
         return self
     
     def __repr__(self):
@@ -310,12 +362,14 @@ def tokenizeonewitherhua(possible_token, forcenumeric=False):
     # Nope, we're just going to have to fail :(
     return [Text(possible_token)]
 
+# To recognise pinyin amongst the rest of the text, for now just look for maximal
+# sequences of alphanumeric characters as defined by Unicode. This should catch
+# the pinyin, its tone marks, tone numbers (if any) and allow umlauts.
+possiblepinyinregex = re.compile(u"(\w|:)+", re.UNICODE)
+
 def tokenizetext(text, forcenumeric):
-    # To recognise pinyin amongst the rest of the text, for now just look for maximal
-    # sequences of alphanumeric characters as defined by Unicode. This should catch
-    # the pinyin, its tone marks, tone numbers (if any) and allow umlauts.
     tokens = []
-    for recognised, match in utils.regexparse(re.compile(u"(\w|:)+", re.UNICODE), text):
+    for recognised, match in utils.regexparse(possiblepinyinregex, text):
         if recognised:
             tokens.extend(tokenizeonewitherhua(match.group(0), forcenumeric=forcenumeric))
         else:
@@ -331,109 +385,259 @@ def tokenizetext(text, forcenumeric):
 Turns an arbitrary string containing pinyin and HTML into a sequence of tokens. Does its best
 to seperate pinyin out from normal text, but no guarantees!
 """
-
 def tokenize(html, forcenumeric=False):
-    def extract_attr_maybe(attrs, attr, into, extractor):
-        if attr not in attrs:
-            return {}
+    if not isinstance(html, unicode):
+        html = html.decode("utf-8")
+    
+    # Fix up the things that SGMLParser would otherwise choke on before we start
+    for regex, replacement in htmlmassages:
+        html = regex.sub(replacement, html)
+    
+    parser = TokenizingHTMLParser(forcenumeric)
+    parser.feed(html)
+    return parser.finish()
 
-        res = extractor(attrs[attr])
-        if res is None:
-            return {}
+# The two most common instances of invalid HTML that choke SGMLParser: <br/> (no space before
+# the end of a self-closing tag) and <! --Comment--> (extraneous whitespace in a declaration)
+htmlmassages = [(re.compile(u"(<[^<>]*)/>"), lambda match: match.group(1) + u" />"),
+                (re.compile(u"<!\s+([^<>]*)>"), lambda match: u"<!" + match.group(1) + u">")]
 
-        (extracted, newattrval) = res
-        if newattrval is not None:
-            attrs[attr] = newattrval
-        else:
-            del attrs[attr]
+# Tags that never have any content, so are closed as soon as they are opened
+selfclosingtags = frozenset(["br", "hr", "input", "img", "meta", "spacer", "link", "frame", "base", "col"])
 
-        return { into : extracted }
+# Tags whose content is just text, even if it looks like HTML
+quotetags = frozenset(["script", "textarea"])
 
-    def take_dict_elem(dict, key):
-        if key in dict:
-            val = dict[key]
-            del dict[key]
-            return (val, dict)
-        else:
-            return None
-
-    # Quick, dirty and wrong:
-    def parse_style(style):
-        intelligible = {}
-        unintelligible = []
-        for pair in style.split(";"):
-            split = pair.split(":")
-            if len(split) == 2:
-                k, v = split
-                intelligible[k.strip().lower()] = v
-            else:
-                unintelligible.append(pair)
+# Tags inside which we don't collapse whitespace
+preservewhitespacetags = frozenset(["pre", "textarea"])
 
-        return (intelligible, unintelligible)
+# Tags that can be nested inside another of the same type, each mapping to the tags that
+# reset the nesting (e.g. a <td> in a new <tr> doesn't close the <td> from the one outside it)
+nestabletags = dict([(tag, []) for tag in ["span", "font", "q", "object", "bdo", "sub", "sup", "center", "blockquote", "div", "fieldset", "ins", "del", "ol", "ul", "dl", "table"]] +
+                    [("li", ["ul", "ol"]), ("dd", ["dl"]), ("dt", ["dl"]), ("tr", ["table", "tbody", "tfoot", "thead"]), ("td", ["tr"]), ("th", ["tr"]),
+                     ("thead", ["table"]), ("tbody", ["table"]), ("tfoot", ["table"])])
 
-        return dict([(pair.split(":")[0].strip(), pair.split(":")[1].strip()) for pair in style.split(";")])
+# Opening one of these implicitly closes everything back to the last one of them
+resetnestingtags = frozenset(["blockquote", "div", "fieldset", "ins", "del", "noscript", "address", "form", "p", "pre",
+                              "ol", "ul", "li", "dl", "dd", "dt", "table", "tr", "td", "th", "thead", "tbody", "tfoot"])
 
-    def unparse_style(parsed_style):
-        intelligible, unintelligible = parsed_style
-        return "; ".join([k + " : " + v for k, v in intelligible] + unintelligible)
+# Entities are left as they are, but any bare ampersands or angle brackets in the text get escaped
+barehtmlcharregex = re.compile(u"([<>]|&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;))")
+barehtmlcharentities = { u"<" : u"&lt;", u">" : u"&gt;", u"&" : u"&amp;" }
 
-    # For now, we only worry about the color attribute in the span tag's style
-    def take_style_val(key):
-        def go(style):
-            intelligible, unintelligible = parse_style(style)
+def escapebarehtmlchars(text):
+    return barehtmlcharregex.sub(lambda match: barehtmlcharentities[match.group(0)], text)
 
-            taken = take_dict_elem(intelligible, key)
-            if taken is not None:
-                value, intelligible = taken
-            else:
-                value = None
+# Numeric entities in attribute values are turned into the characters they stand for
+attrentityregex = re.compile(u"&(#\d+|#x[0-9a-fA-F]+|\w+);")
 
-            return (value, unparse_style((intelligible, unintelligible)))
+def unescapeattrentity(match):
+    entity = match.group(1)
+    if entity.startswith(u"#x"):
+        return unichr(int(entity[2:], 16))
+    elif entity.startswith(u"#"):
+        return unichr(int(entity[1:]))
+    else:
+        return u"&%s;" % entity
+
+# Characters we consider to be whitespace when deciding whether some text is blank
+asciiwhitespace = dict((ord(c), None) for c in u"\t\n\f\r ")
 
-        return go
+"""
+Tokenizes HTML as SGMLParser reads through it, without building any tree. We keep track of the tags
+that are open along with the attributes (i.e. the span color) that apply to the text inside each, and
+tidy up badly nested or unclosed tags much as a web browser (or BeautifulSoup) would.
+"""
+class TokenizingHTMLParser(sgmllib.SGMLParser):
+    def __init__(self, forcenumeric):
+        sgmllib.SGMLParser.__init__(self)
+        self.forcenumeric = forcenumeric
         
-    def contextify(attributesstack, what):
-        # Get the most recent attributes to apply at this point in time
-        current_attrs = {}
-        for attrs in attributesstack:
-            current_attrs.update(attrs)
+        self.tokens = []
+        self.currentdata = []
         
-        for k, v in current_attrs.items():
-            what.htmlattrs[k] = v
+        # The open tags, innermost last, each paired with the attributes for the tokens inside it.
+        # The tokens all share the dictionary of attributes in effect when they were made.
+        self.openattrs = noattrs
+        self.opentags = []
         
-        return what
-    
-    # Stateful recursive algorithm for consuming the parse tree: tokens accumulate in the 'tokens' list
-    tokens = []
-    def recurse(attributesstack, parent):
-        for child in parent.contents:
-            if not isinstance(child, Tag):
-                tokens.extend([contextify(attributesstack, token) for token in tokenizetext(unicode(child), forcenumeric)])
-            elif child.isSelfClosing:
-                tokens.append(Text("<%s />" % child.name))
+        # The tags inside which we are treating everything as text
+        self.quotestack = []
+    
+    def finish(self):
+        # Close out any unfinished text and all the tags that are still open
+        self.enddata()
+        self.poptotag(None)
+        return self.tokens
+    
+    def enddata(self, format=escapebarehtmlchars):
+        if len(self.currentdata) == 0:
+            return
+        
+        data = u"".join(self.currentdata)
+        self.currentdata = []
+        
+        # Blank text is collapsed to a single character unless we are somewhere that whitespace matters
+        if len(data.translate(asciiwhitespace)) == 0 and not [tag for tag, _ in self.opentags if tag in preservewhitespacetags]:
+            data = "\n" in data and u"\n" or u" "
+        
+        tokens = tokenizetext(format(data), self.forcenumeric)
+        if self.openattrs is not noattrs:
+            for token in tokens:
+                token.htmlattrs = self.openattrs
+        
+        self.tokens.extend(tokens)
+    
+    def pushtag(self, tag, attrs):
+        self.opentags.append((tag, self.openattrs))
+        if len(attrs) != 0:
+            self.openattrs = utils.updated(dict(self.openattrs), attrs)
+    
+    # Closes the tags back to and including (or, if inclusive is False, excluding) the last open one with the given name.
+    # If the name is None, closes all the tags that are open.
+    def poptotag(self, tag, inclusive=True):
+        for n in range(len(self.opentags) - 1, -1, -1):
+            if tag is None or self.opentags[n][0] == tag:
+                break
+        else:
+            return
+        
+        if tag is None:
+            n = 0
+        elif not inclusive:
+            n = n + 1
+        
+        while len(self.opentags) > n:
+            closedtag, self.openattrs = self.opentags.pop()
+            self.tokens.append(Text(u"</%s>" % closedtag))
+    
+    def smartpop(self, tag):
+        # We need to pop up to the previous tag of this type, unless one of this tag's nesting reset triggers comes between
+        # this tag and the previous tag of this type, OR unless this tag is a generic nesting trigger and another generic
+        # nesting trigger comes between this tag and the previous tag of this type. For example:
+        #  <p>Foo<b>Bar *<p>* should pop to 'p', not 'b'.
+        #  <p>Foo<table>Bar *<p>* should pop to 'table', not 'p'.
+        #  <li><ul><li> *<li>* should pop to 'ul', not the first 'li'.
+        resettriggers = nestabletags.get(tag)
+        for opentag, _ in reversed(self.opentags):
+            if opentag == tag and resettriggers is None:
+                # Non-nestable tags get popped to their last occurence
+                self.poptotag(tag)
+                return
+            
+            if (resettriggers is not None and opentag in resettriggers) or \
+               (resettriggers is None and tag in resetnestingtags and opentag in resetnestingtags):
+                self.poptotag(opentag, inclusive=False)
+                return
+    
+    def unknown_starttag(self, tag, attrs):
+        if self.quotestack:
+            # Not a real tag
+            self.handle_data(u"<%s%s>" % (tag, u"".join([u' %s="%s"' % (key, value) for key, value in attrs])))
+            return
+        
+        self.enddata()
+        
+        if tag in selfclosingtags:
+            self.tokens.append(Text(u"<%s />" % tag))
+            return
+        
+        self.smartpop(tag)
+        
+        attrs = [(key, attrentityregex.sub(unescapeattrentity, value)) for key, value in attrs]
+        if tag == "span":
+            # This is why we're even at this party: we want to grab the color out of the style. It's more convenient
+            # if we can see the attributes as a dictionary, although we might e.g. drop duplicates
+            attrs = dict(attrs)
+            if "style" in attrs:
+                color, attrs["style"] = takestylecolor(attrs["style"])
+                contextattrs = { "color" : color }
             else:
-                if child.name.lower() == "span":
-                    # It's more convenient if we can see the attributes as a dictionary,
-                    # although we might e.g. drop duplicates
-                    attrsdict = dict([(k.lower(), v) for k, v in child.attrs])
-    
-                    # This is why we're even at this party: we want to grab the style stuff out
-                    thisattributesstack = attributesstack + [extract_attr_maybe(attrsdict, "style", "color", take_style_val("color"))]
-        
-                    # We are still interested in writing out the remainder of the <span> tag, in
-                    # case it had other information in it (apart from the "style" attribute)
-                    thisattrs = attrsdict.items()
-                else:
-                    thisattributesstack = attributesstack
-                    thisattrs = child.attrs
+                contextattrs = {}
+            
+            # We are still interested in writing out the remainder of the <span> tag, in
+            # case it had other information in it (apart from the "style" attribute)
+            attrs = attrs.items()
+        else:
+            contextattrs = {}
+        
+        self.tokens.append(Text(u"<%s%s>" % (tag, u"".join([u' %s="%s"' % (key, value) for key, value in attrs]))))
+        self.pushtag(tag, contextattrs)
+        
+        if tag in quotetags:
+            self.quotestack.append(tag)
+            self.literal = 1
+    
+    def unknown_endtag(self, tag):
+        if self.quotestack and self.quotestack[-1] != tag:
+            # Not a real end tag
+            self.handle_data(u"</%s>" % tag)
+            return
+        
+        self.enddata()
+        self.poptotag(tag)
+        
+        if self.quotestack and self.quotestack[-1] == tag:
+            self.quotestack.pop()
+            self.literal = len(self.quotestack) > 0
+    
+    def handle_data(self, data):
+        self.currentdata.append(data)
+    
+    def handle_charref(self, ref):
+        self.handle_data(u"&#%s;" % ref)
+    
+    def handle_entityref(self, ref):
+        self.handle_data(u"&%s;" % ref)
+    
+    # Comments and the like are kept as text of their own
+    def handle_special(self, text, format):
+        self.enddata()
+        self.handle_data(text)
+        self.enddata(format)
+    
+    def handle_comment(self, text):
+        self.handle_special(text, lambda text: u"<!--%s-->" % escapebarehtmlchars(text))
+    
+    def handle_decl(self, text):
+        self.handle_special(text, lambda text: u"<!%s>" % escapebarehtmlchars(text))
+    
+    def handle_pi(self, text):
+        if text[:3] == "xml":
+            text = u"xml version='1.0' encoding='utf-8'"
+        self.handle_special(text, lambda text: u"<?%s?>" % text)
+    
+    def parse_declaration(self, i):
+        # Treat a CDATA declaration as text, and a bogus SGML declaration as raw data
+        if self.rawdata[i:i+9] == "<![CDATA[":
+            k = self.rawdata.find("]]>", i)
+            if k == -1:
+                k = len(self.rawdata)
             
-                tokens.append(Text("<%s%s>" % (child.name, "".join([' %s="%s"' % (key, value) for key, value in thisattrs]))))
-                recurse(thisattributesstack, child)
-                tokens.append(Text("</%s>" % child.name))
+            self.handle_special(self.rawdata[i+9:k], lambda text: u"<![CDATA[%s]]>" % escapebarehtmlchars(text))
+            return k + 3
+        else:
+            try:
+                return sgmllib.SGMLParser.parse_declaration(self, i)
+            except sgmllib.SGMLParseError:
+                self.handle_data(self.rawdata[i:])
+                return len(self.rawdata)
+
+# For now, we only worry about the color attribute in the span tag's style. Returns the color
+# (or None if there wasn't one) and what's left of the style. Quick, dirty and wrong:
+def takestylecolor(style):
+    color = None
+    intelligible, unintelligible = [], []
+    for pair in style.split(";"):
+        split = pair.split(":")
+        if len(split) != 2:
+            unintelligible.append(pair)
+        elif split[0].strip().lower() == "color":
+            color = split[1]
+        else:
+            intelligible.append(split[0].strip().lower() + " : " + split[1])
     
-    # This is it, chaps: let's munge that HTML!
-    recurse([], BeautifulSoup(html))
-    return tokens
+    return color, "; ".join(intelligible + unintelligible)
 
 """
 Represents a word boundary in the system, where the tokens inside represent a complete Chinese word.
@@ -475,16 +679,19 @@ class Word(list):
             token.accept(visitor)
     
     def map(self, visitor):
-        word = Word()
-        for token in self:
-            word.append(token.accept(visitor))
-        return word
+        return Word.fromtokens([newtoken for newtoken in [token.accept(visitor) for token in self] if newtoken is not None])
     
     def concatmap(self, visitor):
-        word = Word()
-        for token in self:
-            for newtoken in token.accept(visitor):
-                word.append(newtoken)
+        return Word.fromtokens([newtoken for token in self for newtoken in token.accept(visitor) if newtoken is not None])
+    
+    """
+    Builds a Word from tokens that are known to be acceptable, e.g. because they came from another
+    Word or from the tokenizer, without the checks that the constructor makes on each of them.
+    """
+    @classmethod
+    def fromtokens(cls, tokens):
+        word = cls()
+        list.extend(word, tokens)
         return word
     
     @classmethod
@@ -502,35 +709,41 @@ class Word(list):
         return word
 
 """
-Flattens the supplied tokens down into a single string.
+Flattens the supplied words (or tokens) down into a single string.
 """
 def flatten(words, tonify=False):
-    visitor = FlattenTokensVisitor(tonify)
+    # Collect the pieces of output and join them at the end, rather than building ever longer strings
+    output = []
+    currentcolor, currenttexts = None, []
     for word in words:
-        word.accept(visitor)
-    return visitor.output
-
-class FlattenTokensVisitor(TokenVisitor):
-    def __init__(self, tonify):
-        self.output = u""
-        self.tonify = tonify
-
-    def visitText(self, text):
-        self.wrapHtml(text, unicode(text))
-
-    def visitPinyin(self, pinyin):
-        self.wrapHtml(pinyin, self.tonify and pinyin.tonifiedformat() or unicode(pinyin))
-
-    def visitTonedCharacter(self, tonedcharacter):
-        self.wrapHtml(tonedcharacter, unicode(tonedcharacter))
+        # NB: we may be given bare tokens as well as Words
+        if not isinstance(word, Word):
+            word = [word]
+        
+        for token in word:
+            if token.__class__ is Pinyin:
+                text = tonify and token.tonifiedformat() or unicode(token)
+            else:
+                text = unicode(token)
+            
+            # Runs of tokens in the same color share a single <span>
+            color = token.htmlattrs.get("color")
+            if color != currentcolor:
+                flushspan(output, currentcolor, currenttexts)
+                currentcolor, currenttexts = color, []
+            
+            currenttexts.append(text)
     
-    def wrapHtml(self, token, text):
-        if "color" in token.htmlattrs:
-            self.output += '<span style="color:%s">' % token.htmlattrs["color"]
-            self.output += text
-            self.output += '</span>'
-        else:
-            self.output += text
+    flushspan(output, currentcolor, currenttexts)
+    return u"".join(output)
+
+def flushspan(output, color, texts):
+    if color is None:
+        output.extend(texts)
+    else:
+        output.append(u'<span style="color:%s">' % color)
+        output.extend(texts)
+        output.append(u'</span>')
 
 """
 Report whether the supplied list of words ends with a space
@@ -592,18 +805,22 @@ class PinyinTonifier(object):
     # The pinyin tone mark placement rules come from http://www.pinyin.info/rules/where.html
     
     # map (final) constanant+tone to tone+constanant
-    constTone2ToneConst = {
-        u'([nNrR])([1234])'  : ur'\g<2>\g<1>',
-        u'([nN][gG])([1234])': ur'\g<2>\g<1>'
-    }
+    constTone2ToneConst = [
+        (re.compile(u'([nNrR])([1234])'),   ur'\g<2>\g<1>'),
+        (re.compile(u'([nN][gG])([1234])'), ur'\g<2>\g<1>')
+    ]
 
     #
     # map vowel+vowel+tone to vowel+tone+vowel
-    vowelVowelTone2VowelToneVowel = {
-        u'([aA])([iIoO])([1234])' : ur'\g<1>\g<3>\g<2>',
-        u'([eE])([iI])([1234])'   : ur'\g<1>\g<3>\g<2>',
-        u'([oO])([uU])([1234])'   : ur'\g<1>\g<3>\g<2>'
-    }
+    vowelVowelTone2VowelToneVowel = [
+        (re.compile(u'([aA])([iIoO])([1234])'), ur'\g<1>\g<3>\g<2>'),
+        (re.compile(u'([eE])([iI])([1234])'),   ur'\g<1>\g<3>\g<2>'),
+        (re.compile(u'([oO])([uU])([1234])'),   ur'\g<1>\g<3>\g<2>')
+    ]
+    
+    # Every rule above only ever looks inside a run of letters and numbers, so we can tonify a
+    # line by finding the runs that contain a tone number and tonifying each one independently
+    tonedrunregex = re.compile(u'(?<![^\W_])[^\W_]*[1-5][^\W_]*', re.UNICODE)
 
     """
     Convert pinyin text with tone numbers to pinyin with diacritical marks
@@ -619,19 +836,35 @@ class PinyinTonifier(object):
     def tonify(self, line):
         assert type(line)==unicode
         
+        # Look up lone syllables in the table, and only work out the marks for anything else
+        line = self.tonedrunregex.sub(lambda match: tonifiedsyllables.get(match.group(0)) or self.tonifyrun(match.group(0)), line)
+        
+        # Turn combining marks into real characters - saves us doing this in all the test (Python
+        # unicode string comparison does not appear to normalise!! Very bad!)
+        return unicodedata.normalize('NFC', line)
+    
+    """
+    Tonify a single run of letters and numbers, such as a syllable or a few syllables written together.
+    """
+    @classmethod
+    def tonifyrun(cls, run):
         # First transform: commute tone numbers over finals containing only constants
-        for (x,y) in self.constTone2ToneConst.items():
-            line = re.sub(x, y, line)
+        for (x,y) in cls.constTone2ToneConst:
+            run = x.sub(y, run)
 
         # Second transform: for runs of two vowels with a following tone mark, move
         # the tone mark so it occurs directly afterwards the first vowel
-        for (x,y) in self.vowelVowelTone2VowelToneVowel.items():
-            line = re.sub(x, y, line)
+        for (x,y) in cls.vowelVowelTone2VowelToneVowel:
+            run = x.sub(y, run)
 
         # Third transform: map tones to the Unicode equivalent
         for (x,y) in enumerate(tonecombiningmarks):
-            line = line.replace(str(x + 1), y)
+            run = run.replace(str(x + 1), y)
+        
+        return unicodedata.normalize('NFC', run)
 
-        # Turn combining marks into real characters - saves us doing this in all the test (Python
-        # unicode string comparison does not appear to normalise!! Very bad!)
-        return unicodedata.normalize('NFC', line)
+# The tonified form of every valid syllable with every tone, in lower case and capitalised. Rendering
+# a reading tonifies each syllable in turn, so this saves us doing it with the regexes every time.
+tonifiedsyllables = dict((numeric, PinyinTonifier.tonifyrun(numeric)) for numeric in (
+    word + unicode(tone) for syllable in validpinyin for word in set([syllable, syllable.capitalize()]) for tone in range(1, 6)
+  ))
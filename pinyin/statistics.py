@@ -1,10 +1,19 @@
 #!/usr/bin/python
 #-*- coding: utf-8 -*-
 
+import cPickle
+import os
 import time
 
+from logger import log
 import utils
 
+try:
+    import numpy
+except ImportError:
+    # We can do without, just more slowly
+    numpy = None
+
 # Defines the HSK grade character
 # Basic:        803
 # Elementary:   798
@@ -75,24 +84,58 @@ hanzi500sTrad = [
   ]
 
 
-hanziGrades = [grade for grade, _ in hanziByGrades]
-
-def hanziGrade(hanzi):
-    if not utils.isHanzi(hanzi):
-        return None
+"""
+Maps each character straight to its grade under one grading scheme, given as a list of (grade, characters)
+pairs like those above. The last grade is the one given to any Hanzi the scheme doesn't list (unless we are told
+to add a grade to use for those), and things that aren't Hanzi get no grade at all.
+"""
+class HanziGradeIndex(object):
+    def __init__(self, hanzibygrades, othergrade=None):
+        if othergrade is not None:
+            hanzibygrades = hanzibygrades + [(othergrade, u'')]
+        
+        self.grades = [grade for grade, _ in hanzibygrades]
+        self.othergrade = self.grades[-1]
+        
+        # Where a character is listed in more than one grade, the earliest one wins
+        self.index = {}
+        for grade, hanzis in reversed(hanzibygrades):
+            for hanzi in utils.filterHanzi(hanzis):
+                self.index[hanzi] = grade
     
-    for grade, hanzis in hanziByGrades:
-        if hanzi in hanzis:
+    def grade(self, hanzi):
+        grade = self.index.get(hanzi)
+        if grade is not None:
             return grade
+        elif utils.isHanzi(hanzi):
+            return self.othergrade
+        else:
+            return None
     
-    # Default to Non-HSK
-    return hanziByGrades[-1][0]
+    def gradeall(self, hanzis):
+        return [self.grade(hanzi) for hanzi in hanzis]
+
+hskGradeIndex = HanziGradeIndex(hanziByGrades)
+
+# Every grading scheme we know about. Others (e.g. the HSK 3.0 levels, or TOCFL) just need an entry here
+hanziGradeIndexes = {
+    u'HSK' : hskGradeIndex,
+    u'Taiwan Standard' : HanziGradeIndex(hanzitaiwanstandard, u'Non-Standard'),
+    u'Frequency (Simplified)' : HanziGradeIndex(hanzi500sSimp, u'Uncommon'),
+    u'Frequency (Traditional)' : HanziGradeIndex(hanzi500sTrad, u'Uncommon')
+  }
+
+hanziGrades = hskGradeIndex.grades
+
+def hanziGrade(hanzi):
+    return hskGradeIndex.grade(hanzi)
 
 # This function takes three arguments (firstAnsweredValues, daysInRange) where:
 #  * 'firstAnsweredValues' is a list of (string, date, date) tuples where each string
 #    value that has been answered occurs exactly once, and is paired with the date
 #    at which it was first answered by the user and the date at which the card was created.
 #  * 'daysInRange' is an integer expressing how many days of data should be returned.
+#  * 'gradeindex' is the HanziGradeIndex for the grading scheme to break the totals down by (HSK by default).
 #
 # This function returns a tuple (days, cumulativeTotal, cumulativesByGrade) where:
 #  * 'days' is a list of (negative) day indexes, with 0 representing today
@@ -100,11 +143,10 @@ def hanziGrade(hanzi):
 #    of hanzi that the user has "learned" up until the day
 #  * 'cumulativesByGrade' is a dictionary of lists containing the same information, but
 #    broken down by grade
-def hanziDailyStats(firstAnsweredValues, daysInRange):
-    # Holds, for each day, the set constructued by appending values of all fields
-    # for the cards that were first answered on the given day and removing duplicates
-    firstLearnedByDay = {}
-    firstDay = 0
+def hanziDailyStats(firstAnsweredValues, daysInRange, gradeindex=hskGradeIndex):
+    # Holds, for each character in the values of all fields, the day on which we
+    # first answered a card containing it
+    firstLearnedDay = {}
     endOfDay = time.time()
     for (value, firstAnswered, createdTime) in firstAnsweredValues:
         # To work around a former bug in Anki, if the answered date was 0 then use the card creation
@@ -112,57 +154,149 @@ def hanziDailyStats(firstAnsweredValues, daysInRange):
         if firstAnswered == 0:
             firstAnswered = createdTime
         
-        # FIXME: this doesn't account for midnightOffset
+        # FIXME: this doesn't account for midnightOffset. NB: anything learnt after today never counts
         day = int((firstAnswered - endOfDay) / 86400.0)
-        firstLearnedByDay[day] = utils.updated(firstLearnedByDay.get(day, set()), set(value))
+        for hanzi in utils.filterHanzi(value):
+            if day < firstLearnedDay.get(hanzi, 1):
+                firstLearnedDay[hanzi] = day
+    
+    # Sort the days on which things were learnt by grade
+    hanzis = firstLearnedDay.keys()
+    firstLearnedDaysByGrade = dict([(grade, []) for grade in gradeindex.grades])
+    for hanzi, grade in zip(hanzis, gradeindex.gradeall(hanzis)):
+        if grade is not None:
+            firstLearnedDaysByGrade[grade].append(firstLearnedDay[hanzi])
+    
+    # We output one entry per day in the range, where the last day is today. Anything learnt before the range counts
+    # towards its first day. NB: this means we always get an initial 0 if we don't have data for earlier times, which is
+    # important when working out what the graph x range should be later on, to ensure all the graph gets displayed
+    # on e.g. decks with large initial imports. See <http://github.com/batterseapower/pinyin-toolkit/issues/#issue/69>
+    days = range(1 - daysInRange, 1)
+    cumulativeTotals = cumulativeDailyCounts(firstLearnedDay.values(), daysInRange)
+    cumulativesByGrades = dict([(grade, cumulativeDailyCounts(firstLearnedDaysByGrade[grade], daysInRange)) for grade in gradeindex.grades])
+    
+    return days, cumulativeTotals, cumulativesByGrades
+
+"""
+Given the (non-positive) days on which things happened, counts how many had happened by the end
+of each of the last daysInRange days, where the first day of the range counts everything before it too.
+"""
+def cumulativeDailyCounts(days, daysInRange):
+    if daysInRange <= 0:
+        return []
+    
+    firstDay = 1 - daysInRange
+    if numpy is not None:
+        # Bucket all the days in one go and then sum them up
+        buckets = numpy.clip(numpy.asarray(days, dtype=int) - firstDay, 0, daysInRange - 1)
+        return numpy.cumsum(numpy.bincount(buckets, minlength=daysInRange)).tolist()
+    else:
+        counts = [0] * daysInRange
+        for day in days:
+            counts[max(day - firstDay, 0)] += 1
         
-        # Record the earliest moment at which we answered any question
-        if day < firstDay:
-            firstDay = day
-
-    # Internal state while we run time forward
-    alreadyLearnt = set()
-    cumulativeTotal = 0
-    cumulativeByGrades = {}
+        return list(utils.cumulative(counts))
+
+"""
+Stacks the series for each grade on top of each other, in order, for drawing as a stacked area graph.
+"""
+def stackedSeries(seriesByGrades, grades):
+    if numpy is not None and len(grades) > 0:
+        return numpy.cumsum(numpy.array([seriesByGrades[grade] for grade in grades], dtype=int), axis=0).tolist()
     
-    # Totals for output accumulated while running time forward
-    days, cumulativeTotals, cumulativesByGrades = [], [], {}
+    stacked = []
+    for grade in grades:
+        if len(stacked) == 0:
+            stacked.append(list(seriesByGrades[grade]))
+        else:
+            stacked.append([sofar + now for sofar, now in zip(stacked[-1], seriesByGrades[grade])])
     
-    # The core of the algorithm. Run time forward:
-    # NB: be careful to start at -daysInRange if we don't have data for
-    # later times. This is to ensure we get an initial 0 when working out
-    # what the graph x range should be later on, which is important to ensure
-    # all the graph gets displayed on e.g. decks with large initial imports.
-    # See <http://github.com/batterseapower/pinyin-toolkit/issues/#issue/69>
-    for day in xrange(min(firstDay, -daysInRange), 1):
-        for hanzi in firstLearnedByDay.get(day, set()):
-            # First check: if we have already learnt this thing, we don't care
-            if hanzi in alreadyLearnt:
-                continue
-            
-            # Second check: if this thing is not actually a hanzi, we don't care
-            grade = hanziGrade(hanzi)
-            if grade is None:
-                continue
-            
-            # It's new and it's a hanzi: remember we learnt it
-            alreadyLearnt.add(hanzi)
-            
-            # Update running totals
-            cumulativeTotal += 1
-            cumulativeByGrades[grade] = cumulativeByGrades.get(grade, 0) + 1
+    return stacked
+
+"""
+Remembers when each Hanzi was first learnt, so that when we draw the graph again we need only look
+at the cards answered since last time rather than every answered card in the deck. It can be
+saved to disk between sessions.
+"""
+class HanziStatsStore(object):
+    # Version of the format of the saved store
+    version = 2
+    
+    def __init__(self, storepath=None):
+        self.storepath = storepath
+        self.clear()
         
-        # We're done with the day. Add output to the graph if we are interested
-        if day > -daysInRange:
-            # X axis
-            days.append(day)
-            
-            # "Total" Y axis
-            cumulativeTotals.append(cumulativeTotal)
+        if storepath is not None and os.path.exists(storepath):
+            try:
+                file = open(storepath, "rb")
+                try:
+                    store = cPickle.load(file)
+                finally:
+                    file.close()
+                
+                if store["version"] == HanziStatsStore.version:
+                    self.key, self.fingerprint, self.lastfirstanswered, self.firstlearnt = store["key"], store["fingerprint"], store["lastfirstanswered"], store["firstlearnt"]
+            except Exception, e:
+                log.exception("Ignoring unreadable Hanzi statistics at %s", storepath)
+    
+    def clear(self):
+        # Identifies the cards and fields the statistics were gathered from
+        self.key = None
+        # Fingerprint of the cards we have looked at so far, as of when we last looked: if this ever changes, something
+        # we counted was edited, deleted or reset
+        self.fingerprint = None
+        # The latest first answered time of any card we have looked at so far
+        self.lastfirstanswered = None
+        # Map from Hanzi to the time at which it was first learnt
+        self.firstlearnt = {}
+    
+    # Brings the statistics up to date. The fetchanswered function is given the time from which we need cards
+    # (or None if we need all of them) and should return the (value, firstAnswered, created) tuples for them.
+    # The fingerprint function is given a time and should return something that changes whenever any of the
+    # cards first answered by then (or their contents) does, e.g. their number, the sum of their ids and the
+    # latest time any of them was modified.
+    def update(self, key, fingerprint, fetchanswered):
+        if key != self.key or (self.lastfirstanswered is not None and fingerprint(self.lastfirstanswered) != self.fingerprint):
+            log.info("Gathering Hanzi statistics from scratch")
+            self.clear()
+            self.key = key
+            changed = True
+        else:
+            changed = False
+        
+        for value, firstAnswered, createdTime in fetchanswered(self.lastfirstanswered):
+            # Work around the old Anki bug with first answered dates just like hanziDailyStats does
+            learnt = firstAnswered or createdTime
+            for hanzi in utils.filterHanzi(value):
+                if learnt < self.firstlearnt.get(hanzi, learnt + 1):
+                    self.firstlearnt[hanzi] = learnt
+                    changed = True
             
-            # Other Y axes (one per grade)
-            for grade in hanziGrades:
-                cumulativesByGrades[grade] = cumulativeByGrade = cumulativesByGrades.get(grade, [])
-                cumulativeByGrade.append(cumulativeByGrades.get(grade, 0))
+            if firstAnswered > self.lastfirstanswered:
+                self.lastfirstanswered = firstAnswered
+        
+        lastfingerprint = self.fingerprint
+        if self.lastfirstanswered is not None:
+            self.fingerprint = fingerprint(self.lastfirstanswered)
+        
+        if changed or self.fingerprint != lastfingerprint:
+            self.save()
     
-    return days, cumulativeTotals, cumulativesByGrades
+    # The statistics in the form hanziDailyStats expects: one entry for each Hanzi that has been learnt
+    def firstAnsweredValues(self):
+        return [(hanzi, learnt, learnt) for hanzi, learnt in self.firstlearnt.iteritems()]
+    
+    def save(self):
+        if self.storepath is None:
+            return
+        
+        try:
+            file = open(self.storepath, "wb")
+            try:
+                cPickle.dump({ "version" : HanziStatsStore.version, "key" : self.key, "fingerprint" : self.fingerprint,
+                               "lastfirstanswered" : self.lastfirstanswered, "firstlearnt" : self.firstlearnt }, file, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                file.close()
+        except IOError, e:
+            # Not a problem: we'll just have to look at all the cards again next time
+            log.warn("Could not save the Hanzi statistics to %s: %s", self.storepath, e)
@@ -59,19 +59,6 @@ class ConfigTest(unittest.TestCase):
         self.assertTrue(Config({ "tonedisplay" : "tonified" }).shouldtonify)
         self.assertFalse(Config({ "tonedisplay" : "numeric" }).shouldtonify)
     
-    def testNeedMeanings(self):
-        def row(mg, dmw, mwag, res):
-            self.assertEquals(Config({ "meaninggeneration" : mg, "detectmeasurewords" : dmw, "mwaudiogeneration" : mwag }).needmeanings, res)
-        
-        row(True, True, True, True)
-        row(True, True, False, True)
-        row(True, False, True, True)
-        row(True, False, False, True)
-        row(False, True, True, True)
-        row(False, True, False, True)
-        row(False, False, True, True)
-        row(False, False, False, False)
-    
     def testMeaningNumber(self):
         self.assertEquals(map(lambda n: Config({ "meaningnumbering" : "arabicParens", "colormeaningnumbers" : False, "emphasisemainmeaning" : False }).meaningnumber(n), [2, 10, 21]),
                           [u"(2)", u"(10)", u"(21)"])
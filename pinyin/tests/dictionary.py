@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
 
 from pinyin.dictionary import *
 from pinyin.db import database
+from pinyin.db.compiled import writecompileddictionary
+from pinyin.utils import withtempdir
 from pinyin.model import ToneInfo, flatten, tokenizespaceseperatedtext
 
 
@@ -121,6 +124,64 @@ class PinyinDictionaryTest(unittest.TestCase):
     def testTradMeanings(self):
         self.assertEquals(self.flatmeanings(englishdict, u"书", prefersimptrad="trad"), [u"book", u"letter", u"see also 書經 Book of History", u"MW: 本 - ben3, 冊 - ce4, 部 - bu4"])
     
+    def testAnalysis(self):
+        analysis = englishdict.analyse(u"鼓聲")
+        self.assertEquals(flatten(analysis.reading()), "gu3 sheng1")
+        self.assertEquals(flatten(analysis.tonedchars()), u"鼓聲")
+        self.assertEquals([flatten(meaning) for meaning in analysis.meanings("simp")[0]], ["sound of a drum", "drumbeat"])
+    
+    def testAnalysisSegmentsOnce(self):
+        sourcelookups = []
+        def source(word):
+            sourcelookups.append(word)
+            return [(u"zhong1", None), (u"zhong4", lambda prefersimptrad, tonedcharscallback: ([[Word(Text(u"hit"))]], None))]
+        
+        analysis = PinyinDictionary([(lambda: [u"中"], source)]).analyse(u"中")
+        self.assertEquals(flatten(analysis.meanings("simp")[0][0]), u"hit")
+        self.assertEquals(flatten(analysis.reading()), u"zhong1")
+        self.assertEquals(flatten(analysis.tonedchars()), u"中")
+        self.assertEquals(sourcelookups, [u"中"])
+    
+    def testParseExactIsCached(self):
+        sourcelookups = []
+        def source(word):
+            sourcelookups.append(word)
+            return [(u"hao3", None)]
+        
+        dictionary = PinyinDictionary([(lambda: [u"好"], source)])
+        hits = parseexactcache.hits
+        self.assertEquals(flatten(dictionary.reading(u"好好")), u"hao3 hao3")
+        self.assertEquals(flatten(dictionary.reading(u"好")), u"hao3")
+        self.assertEquals(sourcelookups, [u"好"])
+        self.assertEquals(parseexactcache.hits - hits, 2)
+    
+    def testPrefetchLooksUpAllWordsAtOnce(self):
+        lookups, bulklookups = [], []
+        def lookup(word):
+            lookups.append(word)
+            return []
+        def lookupmany(words):
+            bulklookups.append(sorted(words))
+            return dict([(word, [(word == u"你好" and u"ni3 hao3" or u"hao3", None)]) for word in words])
+        
+        dictionary = PinyinDictionary([(lambda: [u"你好", u"好"], lookup, lookupmany)])
+        dictionary.prefetch([u"你好", u"好<b>好</b>"])
+        self.assertEquals(flatten(dictionary.reading(u"你好")), u"ni3 hao3")
+        self.assertEquals(flatten(dictionary.reading(u"好好")), u"hao3 hao3")
+        self.assertEquals(bulklookups, [[u"你好", u"好"]])
+        self.assertEquals(lookups, [])
+    
+    def testPrefetchFromSourcesWithoutBulkLookup(self):
+        dictionary = PinyinDictionary([(lambda: [u"好"], lambda word: [(u"hao3", None)])])
+        dictionary.prefetch([u"好"])
+        self.assertEquals(flatten(dictionary.reading(u"好")), u"hao3")
+    
+    def testParseExactCacheKeyedBySources(self):
+        hao = PinyinDictionary([(lambda: [u"好"], lambda word: [(u"hao3", None)])])
+        hao4 = PinyinDictionary([(lambda: [u"好"], lambda word: [(u"hao4", None)])])
+        self.assertEquals(flatten(hao.reading(u"好")), u"hao3")
+        self.assertEquals(flatten(hao4.reading(u"好")), u"hao4")
+    
     def testNonFlatMeanings(self):
         dictmeanings, dictmeasurewords = englishdict.meanings(u"书", prefersimptrad="simp")
         self.assertEquals(self.flattenall(dictmeanings), [u"book", u"letter", u"see also 书经 Book of History"])
@@ -138,6 +199,156 @@ class PinyinDictionaryTest(unittest.TestCase):
         else:
             return None
 
+class HeadwordTrieTest(unittest.TestCase):
+    def testContains(self):
+        trie = HeadwordTrie([u"一个", u"一"])
+        self.assertTrue(u"一个" in trie)
+        self.assertTrue(u"一" in trie)
+        self.assertFalse(u"个" in trie)
+    
+    def testPrefixIsNotAHeadword(self):
+        self.assertFalse(u"一" in HeadwordTrie([u"一个"]))
+    
+    def testMatchLengthsLongestFirst(self):
+        self.assertEquals(HeadwordTrie([u"一", u"一个", u"一个人"]).matchlengths(u"一个人们", 0), [3, 2, 1])
+    
+    def testMatchLengthsFromOffset(self):
+        self.assertEquals(HeadwordTrie([u"个人", u"人"]).matchlengths(u"一个人们", 1), [2])
+        self.assertEquals(HeadwordTrie([u"个人", u"人"]).matchlengths(u"一个人们", 2), [1])
+    
+    def testMatchLengthsStopsAtEndOfText(self):
+        self.assertEquals(HeadwordTrie([u"一个人"]).matchlengths(u"一个", 0), [])
+    
+    def testNoMatches(self):
+        self.assertEquals(HeadwordTrie([u"一"]).matchlengths(u"English", 0), [])
+        self.assertEquals(HeadwordTrie().matchlengths(u"", 0), [])
+
+class FileDictionaryTest(unittest.TestCase):
+    lines = u"""# A comment
+书 書 [shu1] /book/letter/
+马 馬 [Ma3] /surname Ma/
+马 馬 [ma3] /horse/
+""".encode('utf-8')
+    
+    def testLookup(self):
+        def do(filename):
+            lookup = indexedFileSource(filename)[1]
+            self.assertEquals(self.meanings(lookup(u"書")), [(u"shu1", [u"book", u"letter"])])
+            self.assertEquals(self.meanings(lookup(u"马")), [(u"Ma3", [u"surname Ma"]), (u"ma3", [u"horse"])])
+            self.assertEquals(lookup(u"你"), [])
+        
+        self.withdictionary(self.lines, do)
+    
+    def testHeadwords(self):
+        self.withdictionary(self.lines, lambda filename: self.assertEquals(sorted(indexedFileSource(filename)[0]()), sorted([u"书", u"書", u"马", u"馬"])))
+    
+    def testIndexSaved(self):
+        def do(filename):
+            fileindex(filename)
+            self.assertTrue(os.path.exists(filename + ".index"))
+            self.assertEquals(fileindex(filename), indexlines(filename, 0, {}))
+        
+        self.withdictionary(self.lines, do)
+    
+    def testIndexExtendedWhenLinesAdded(self):
+        def do(filename):
+            fileindex(filename)
+            
+            file = open(filename, "ab")
+            file.write(u"你好 你好 [ni3 hao3] /hello/\n".encode('utf-8'))
+            file.close()
+            
+            self.assertEquals(fileindex(filename), indexlines(filename, 0, {}))
+            self.assertEquals(self.meanings(indexedFileSource(filename)[1](u"你好")), [(u"ni3 hao3", [u"hello"])])
+        
+        self.withdictionary(self.lines, do)
+    
+    def testIndexRebuiltWhenFileChanged(self):
+        def do(filename):
+            fileindex(filename)
+            
+            file = open(filename, "wb")
+            file.write(u"你好 你好 [ni3 hao3] /hello/\n".encode('utf-8'))
+            file.close()
+            
+            self.assertEquals(indexedFileSource(filename)[0](), [u"你好"])
+        
+        self.withdictionary(self.lines, do)
+    
+    # Test helpers
+    def meanings(self, readingsmeanings):
+        return [(reading, [flatten(meaning) for meaning in meaningfun("simp", None)[0]]) for reading, meaningfun in readingsmeanings]
+    
+    def withdictionary(self, contents, action):
+        def do(tempdir):
+            filename = os.path.join(tempdir, "dict.u8")
+            file = open(filename, "wb")
+            file.write(contents)
+            file.close()
+            
+            action(filename)
+        
+        withtempdir(do)
+
+class CompiledDictionaryTest(unittest.TestCase):
+    rows = [
+        (u"书", u"書", u"shu1", u"/book/letter/"),
+        (u"你好", u"你好", u"ni3 hao3", u"/Hello!/Hi!/"),
+        (u"马", u"馬", u"Ma3", u"/surname Ma/"),
+        (u"马", u"馬", u"ma3", u"/horse/")
+      ]
+    
+    def testLookupSimplifiedAndTraditional(self):
+        self.assertEquals(self.lookup(u"书"), [(u"shu1", [u"book", u"letter"])])
+        self.assertEquals(self.lookup(u"書"), [(u"shu1", [u"book", u"letter"])])
+    
+    def testLookupPreservesEntryOrder(self):
+        self.assertEquals(self.lookup(u"馬"), [(u"Ma3", [u"surname Ma"]), (u"ma3", [u"horse"])])
+    
+    def testLookupSameSimplifiedAndTraditional(self):
+        self.assertEquals(self.lookup(u"你好"), [(u"ni3 hao3", [u"Hello!", u"Hi!"])])
+    
+    def testLookupMissing(self):
+        self.assertEquals(self.lookup(u"你"), [])
+        self.assertEquals(self.lookup(u"English"), [])
+    
+    def testHeadwords(self):
+        self.assertEquals(sorted(self.withsource(lambda source: list(source[0]()))), sorted([u"书", u"書", u"你好", u"马", u"馬"]))
+    
+    def testLookupMany(self):
+        words = [u"馬", u"你", u"书", u"English", u"你好", u"書", u"书"]
+        def lookupboth(source):
+            many = sourcelookupmany(source)(words)
+            return many, dict([(word, source[1](word)) for word in words])
+        
+        many, one = self.withsource(lambda source: self.flattenall(lookupboth(source)))
+        self.assertEquals(many, one)
+        self.assertEquals(many[u"馬"], [(u"Ma3", [u"surname Ma"]), (u"ma3", [u"horse"])])
+        self.assertEquals(many[u"你"], [])
+    
+    def testLookupManyIsBatched(self):
+        self.assertTrue(self.withsource(lambda source: len(source) > 2))
+    
+    # Test helpers
+    def lookup(self, word):
+        return self.withsource(lambda source: self.flattenreadingsmeanings(source[1](word)))
+    
+    def flattenall(self, lookups):
+        return [dict([(word, self.flattenreadingsmeanings(readingsmeanings)) for word, readingsmeanings in lookup.items()]) for lookup in lookups]
+    
+    def flattenreadingsmeanings(self, readingsmeanings):
+        return [(reading, [flatten(meaning) for meaning in meaningfun("simp", None)[0]]) for reading, meaningfun in readingsmeanings]
+    
+    def withsource(self, action):
+        result = []
+        def do(path):
+            compiledpath = os.path.join(path, "test.ptkd")
+            writecompileddictionary(compiledpath, self.rows)
+            result.append(action(compiledDictionarySource(compiledpath, 1)))
+        
+        withtempdir(do)
+        return result[0]
+
 class PinyinConverterTest(unittest.TestCase):
     # Test data:
     nihao_simp = u'你好，我喜欢学习汉语。我的汉语水平很低。'
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import BaseHTTPServer
+import httplib
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+import urlparse
 
+import pinyin.dictionaryonline
 from pinyin.dictionaryonline import *
 
 
@@ -107,6 +115,217 @@ class GoogleTranslateTest(unittest.TestCase):
     def testCheck(self):
         self.assertEquals(gCheck(), True)
 
+class TranslationClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInGoogleServer()
+        self.cachedir = tempfile.mkdtemp()
+        self.client = TranslationClient(lookup, cache=TranslationCache(os.path.join(self.cachedir, "translations.db")))
+        
+        # Point all our queries at the stand-in server instead of Google
+        self.originals = pinyin.dictionaryonline.translateurl, pinyin.dictionaryonline.translatetimeout, pinyin.dictionaryonline.answertimeout, pinyin.dictionaryonline.translationclient
+        pinyin.dictionaryonline.translateurl = "http://127.0.0.1:%d/translate_a/t?client=j&text=%%s&sl=%%s&tl=%%s" % self.server.server_port
+        pinyin.dictionaryonline.translationclient = self.client
+    
+    def tearDown(self):
+        pinyin.dictionaryonline.translateurl, pinyin.dictionaryonline.translatetimeout, pinyin.dictionaryonline.answertimeout, pinyin.dictionaryonline.translationclient = self.originals
+        self.server.stop()
+        shutil.rmtree(self.cachedir)
+    
+    def testLookup(self):
+        self.assertEquals(lookup(u"你好", "en"), [[Word(Text(u"Hello"))]])
+        self.assertEquals(self.server.queries, [(u"你好", "zh-CN", "en")])
+    
+    def testAnswerWaiting(self):
+        self.assertEquals(self.client.answer(u"你好", "en", wait=True), [[Word(Text(u"Hello"))]])
+        self.assertEquals(self.client.reachable, True)
+    
+    def testAnswerInBackground(self):
+        answers, answered = [], threading.Event()
+        self.assertTrue(self.client.answer(u"你好", "en", whenanswered=lambda answer: answers.append(answer) or answered.set()) is pending)
+        
+        answered.wait(5)
+        self.assertEquals(answers, [[[Word(Text(u"Hello"))]]])
+    
+    def testCoalesceQueriesInProgress(self):
+        self.server.held.clear()
+        answers = []
+        for _ in range(3):
+            self.client.answer(u"你好", "en", whenanswered=answers.append)
+        
+        self.server.held.set()
+        self.assertEquals(self.client.answer(u"你好", "en", wait=True), [[Word(Text(u"Hello"))]])
+        self.assertEquals(answers, [[[Word(Text(u"Hello"))]]] * 3)
+        self.assertEquals(len(self.server.queries), 1)
+    
+    def testRemembersAnswers(self):
+        self.client.answer(u"你好", "en", wait=True)
+        self.assertEquals(self.client.answer(u"你好", "en"), [[Word(Text(u"Hello"))]])
+        self.client.answer(u"你好", "fr", wait=True)
+        self.assertEquals(len(self.server.queries), 2)
+    
+    def testTimeout(self):
+        pinyin.dictionaryonline.translatetimeout = 0.2
+        self.server.held.clear()
+        try:
+            self.assertTrue(isinstance(self.client.answer(u"你好", "en", wait=True), IOError))
+            self.assertEquals(self.client.reachable, False)
+        finally:
+            self.server.held.set()
+    
+    def testWaitingWhileCallbacksPending(self):
+        # Both workers are stuck handing out answers (e.g. waiting for a busy GUI), so nobody gets to our query
+        pinyin.dictionaryonline.answertimeout = 0.2
+        stuck, unstuck = threading.Semaphore(0), threading.Event()
+        def whenanswered(answer):
+            stuck.release()
+            unstuck.wait(5)
+        
+        try:
+            for query in [u"你好", u"你好吗"]:
+                self.client.answer(query, "en", whenanswered=whenanswered)
+            for _ in range(2):
+                stuck.acquire()
+            
+            self.assertEquals(self.client.answer(u"我很好", "en", wait=True), None)
+        finally:
+            unstuck.set()
+        
+        pinyin.dictionaryonline.answertimeout = 5
+        self.assertEquals(self.client.answer(u"我很好", "en", wait=True), [[Word(Text(u"Hello"))]])
+    
+    def testBadResponse(self):
+        self.assertTrue(isinstance(self.client.answer(u"坏", "en", wait=True), ValueError))
+        self.assertEquals(self.client.reachable, True)
+    
+    def testUnexpectedError(self):
+        def lookup(query, destlanguage):
+            raise httplib.BadStatusLine("")
+        
+        client = TranslationClient(lookup)
+        self.assertTrue(isinstance(client.answer(u"你好", "en", wait=True), IOError))
+        self.assertEquals(client.reachable, False)
+    
+    def testGTrans(self):
+        self.assertEquals(gTrans(u"你好", "en"), [[Word(Text(u"Hello"))]])
+        self.assertEquals(gTrans(u"坏", "en"), [[Word(Text('<span style="color:gray">[Error In Google Translate Response]</span>'))]])
+        self.assertEquals(gTrans(u"坏", "en", prompterror=False), None)
+    
+    def testGTransAsync(self):
+        answered = threading.Event()
+        self.assertEquals(gTransAsync(u"你好", "en", whenanswered=answered.set), None)
+        
+        answered.wait(5)
+        self.assertTrue(answered.isSet())
+        self.assertEquals(gTransAsync(u"你好", "en"), [[Word(Text(u"Hello"))]])
+    
+    def testGTransAsyncError(self):
+        answered = threading.Event()
+        gTransAsync(u"坏", "en", whenanswered=answered.set)
+        
+        self.client.answer(u"坏", "en", wait=True)
+        self.assertFalse(answered.isSet())
+    
+    def testRemembersAnswersBetweenSessions(self):
+        self.client.answer(u"你好", "en", wait=True)
+        nextsession = TranslationClient(lookup, cache=self.client.cache)
+        self.assertEquals(nextsession.answer(u"你好", "en"), [[Word(Text(u"Hello"))]])
+        self.assertEquals(len(self.server.queries), 1)
+    
+    def testDoesNotRememberBadResponsesBetweenSessions(self):
+        self.client.answer(u"坏", "en", wait=True)
+        self.assertEquals(self.client.cache.get((u"坏", "zh-CN", "en"), pending), pending)
+    
+    def testOffline(self):
+        self.assertEquals(self.client.answer(u"你好", "en", wait=True, offline=True), None)
+        self.assertEquals(gTransAsync(u"你好", "en", whenanswered=self.fail, offline=True), None)
+        self.assertEquals(self.server.queries, [])
+        
+        self.client.answer(u"你好", "en", wait=True)
+        self.assertEquals(gTrans(u"你好", "en", offline=True), [[Word(Text(u"Hello"))]])
+
+class TranslationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.cachepath = os.path.join(self.cachedir, "translations.db")
+    
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+    
+    def testMissing(self):
+        self.assertEquals(TranslationCache(self.cachepath).get((u"你好", "zh-CN", "en"), pending), pending)
+        self.assertFalse(os.path.exists(self.cachepath))
+    
+    def testRoundTrip(self):
+        meanings = [[Word(Text(u"Hello"))], [Word(Text(u"Interjection: "), Text(u"hi"))]]
+        TranslationCache(self.cachepath)[(u"你好", "zh-CN", "en")] = meanings
+        self.assertEquals(TranslationCache(self.cachepath).get((u"你好", "zh-CN", "en")), meanings)
+    
+    def testRoundTripNoMeanings(self):
+        cache = TranslationCache(self.cachepath)
+        cache[(u"canttranslatemefromchinese", "zh-CN", "en")] = None
+        self.assertEquals(cache.get((u"canttranslatemefromchinese", "zh-CN", "en"), pending), None)
+    
+    def testKeyedOnLanguages(self):
+        cache = TranslationCache(self.cachepath)
+        cache[(u"你好", "zh-CN", "en")] = [[Word(Text(u"Hello"))]]
+        self.assertEquals(cache.get((u"你好", "zh-CN", "fr")), None)
+        self.assertEquals(cache.get((u"你好", "zh-TW", "en")), None)
+    
+    def testExpires(self):
+        TranslationCache(self.cachepath)[(u"你好", "zh-CN", "en")] = [[Word(Text(u"Hello"))]]
+        self.assertEquals(TranslationCache(self.cachepath, ttl=-1).get((u"你好", "zh-CN", "en")), None)
+    
+    def testForgetsOldest(self):
+        cache = TranslationCache(self.cachepath, maxsize=2)
+        for query in [u"一", u"二", u"三"]:
+            cache[(query, "zh-CN", "en")] = [[Word(Text(query))]]
+        
+        self.assertEquals(cache.get((u"一", "zh-CN", "en")), None)
+        self.assertEquals(cache.get((u"二", "zh-CN", "en")), [[Word(Text(u"二"))]])
+        self.assertEquals(cache.get((u"三", "zh-CN", "en")), [[Word(Text(u"三"))]])
+    
+    def testUnwritable(self):
+        cache = TranslationCache(os.path.join(self.cachedir, "missing", "translations.db"))
+        cache[(u"你好", "zh-CN", "en")] = [[Word(Text(u"Hello"))]]
+        self.assertEquals(cache.get((u"你好", "zh-CN", "en")), None)
+
+"""
+Answers queries in the way that Google Translate does, keeping a record of them. While the held event is
+clear, it doesn't answer until it is set again. It can't make any sense of the query 坏.
+"""
+class StandInGoogleServer(BaseHTTPServer.HTTPServer):
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInGoogleHandler)
+        self.queries = []
+        self.held = threading.Event()
+        self.held.set()
+        
+        self.thread = threading.Thread(target=lambda: self.serve_forever(0.05))
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    def stop(self):
+        self.held.set()
+        self.shutdown()
+        self.server_close()
+
+class StandInGoogleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        parameters = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        query = parameters["text"][0].decode("utf-8")
+        self.server.queries.append((query, parameters["sl"][0], parameters["tl"][0]))
+        
+        self.server.held.wait(5)
+        
+        response = query == u"坏" and '{"sentences": ' or '{"sentences":[{"trans":"Hello","orig":"%s","translit":""}],"src":"zh-CN"}' % query.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.end_headers()
+        self.wfile.write(response)
+    
+    def log_message(self, *args):
+        pass
+
 if __name__ == '__main__':
     unittest.main()
 
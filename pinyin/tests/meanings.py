@@ -74,7 +74,26 @@ class MeaningFormatterTest(unittest.TestCase):
         self.assertEquals(means[0][0][2], Pinyin(u"hen", 3))
         self.assertEquals(means[0][0][-1], Pinyin(u"hao", 3))
         self.assertEquals(means[1][0][2], Text(u"hen"))
-        
+
+    def testReuseParsedDefinition(self):
+        self.parse(1, "simp", self.shu_def)
+        hits = parseddefinitions.hits
+        self.assertEquals(self.parse(1, "simp", self.shu_def), (self.shu_simp_meanings, self.shu_simp_mws))
+        self.assertEquals(self.parse(1, "trad", self.shu_def), (self.shu_trad_meanings, self.shu_trad_mws))
+        self.assertEquals(parseddefinitions.hits - hits, 1)
+
+    def testCallbackAppliedToReusedDefinition(self):
+        self.parse(1, "simp", self.shu_def)
+        means, mws = self.parse(1, "simp", self.shu_def, tonedchars_callback=lambda x: [Word(Text(u"JUNK"))])
+        self.assertEquals(means, [u'book', u'letter', u'same as JUNK Book of History'])
+
+    def testModifyingReusedDefinition(self):
+        means, mws = self.parseunflat(1, "simp", self.shangwu_def)
+        means[0].append(Word(Text(u"JUNK")))
+        means[0][0].append(Text(u"JUNK"))
+        mws[0][0][0].append(Text(u"JUNK"))
+        self.assertEquals(self.parse(1, "simp", self.shangwu_def), (self.shangwu_meanings, self.shangwu_simp_mws))
+
     # Test helpers
     def parse(self, *args, **kwargs):
         means, mws = self.parseunflat(*args, **kwargs)
@@ -140,6 +140,12 @@ class MediaPackTest(unittest.TestCase):
     def testMediaForMissing(self):
         self.assertEquals(MediaPack("Example", {}).mediafor("hi", [".mp3"]), None)
     
+    def testMediaForAny(self):
+        pack = MediaPack("Example", {"nu:3.mp3" : "NU:3", "nv3.ogg" : "NV3"})
+        self.assertEquals(pack.mediaforany(["nu:3", "nv3"], [".mp3"]), "NU:3")
+        self.assertEquals(pack.mediaforany(["nu:3", "nv3"], [".ogg"]), "NV3")
+        self.assertEquals(pack.mediaforany(["nu3"], [".mp3", ".ogg"]), None)
+    
     def testFromPath(self):
         def do(path):
             # Create enclosing directory
@@ -161,6 +167,98 @@ class MediaPackTest(unittest.TestCase):
         # Create a temporary directory with which to do our test
         utils.withtempdir(do)
     
+class MediaCatalogTest(unittest.TestCase):
+    def testDiscover(self):
+        def do(mediadir):
+            self.makepack(mediadir, "My Pack", ["ni3.mp3"])
+            utils.touch(os.path.join(mediadir, "loose.mp3"))
+            os.mkdir(os.path.join(mediadir, "downloads"))
+            
+            packs = MediaCatalog().discovermediapacks(mediadir)
+            self.assertEquals(packs, [MediaPack(os.path.join(mediadir, "My Pack"), { "ni3.mp3" : os.path.join(mediadir, "My Pack", "ni3.mp3") })])
+        
+        utils.withtempdir(do)
+    
+    def testReusesUnchangedPacks(self):
+        def do(mediadir):
+            self.makepack(mediadir, "My Pack", ["ni3.mp3"])
+            
+            catalog = MediaCatalog()
+            self.assertTrue(catalog.discovermediapacks(mediadir)[0] is catalog.discovermediapacks(mediadir)[0])
+        
+        utils.withtempdir(do)
+    
+    def testRescansChangedPacks(self):
+        def do(mediadir):
+            packpath = self.makepack(mediadir, "My Pack", ["ni3.mp3"])
+            
+            catalog = MediaCatalog()
+            catalog.discovermediapacks(mediadir)
+            
+            utils.touch(os.path.join(packpath, "hao3.mp3"))
+            os.utime(packpath, (0, 0))
+            self.assertEquals(catalog.discovermediapacks(mediadir)[0].mediafor("hao3", [".mp3"]), os.path.join(packpath, "hao3.mp3"))
+        
+        utils.withtempdir(do)
+    
+    def testFindsNewPacks(self):
+        def do(mediadir):
+            catalog = MediaCatalog()
+            self.assertEquals(catalog.discovermediapacks(mediadir), [])
+            
+            self.makepack(mediadir, "My Pack", ["ni3.mp3"])
+            os.utime(mediadir, (0, 0))
+            self.assertEquals([pack.name for pack in catalog.discovermediapacks(mediadir)], ["My Pack"])
+        
+        utils.withtempdir(do)
+    
+    def testOnlyChecksNewMedia(self):
+        def do(mediadir):
+            self.makepack(mediadir, "My Pack", ["ni3.mp3"])
+            utils.touch(os.path.join(mediadir, "loose.mp3"))
+            
+            catalog = MediaCatalog()
+            packs = catalog.discovermediapacks(mediadir)
+            
+            # Anki adds some audio to the collection, which changes the media directory
+            utils.touch(os.path.join(mediadir, "imported.mp3"))
+            os.utime(mediadir, (0, 0))
+            
+            checked = []
+            isdir = os.path.isdir
+            os.path.isdir = lambda path: checked.append(os.path.basename(path)) or isdir(path)
+            try:
+                self.assertTrue(catalog.discovermediapacks(mediadir)[0] is packs[0])
+            finally:
+                os.path.isdir = isdir
+            
+            self.assertEquals(sorted(checked), ["My Pack", "My Pack", "imported.mp3"])
+        
+        utils.withtempdir(do)
+    
+    def testSavedBetweenSessions(self):
+        def do(mediadir):
+            catalogpath = os.path.join(mediadir, "catalog.p")
+            self.makepack(mediadir, "My Pack", ["ni3.mp3"])
+            
+            packs = MediaCatalog(catalogpath).discovermediapacks(mediadir)
+            self.assertTrue(os.path.exists(catalogpath))
+            
+            catalog = MediaCatalog(catalogpath)
+            self.assertEquals(catalog.packs.keys(), [os.path.join(mediadir, "My Pack")])
+            self.assertEquals(catalog.discovermediapacks(mediadir), packs)
+        
+        utils.withtempdir(do)
+    
+    # Test helpers
+    def makepack(self, mediadir, name, files):
+        packpath = os.path.join(mediadir, name)
+        os.mkdir(packpath)
+        for file in files:
+            utils.touch(os.path.join(packpath, file))
+        
+        return packpath
+
 class LegacyMediaTest(unittest.TestCase):
     def testDiscoverNothing(self):
         self.assertEquals(discoverlegacymedia(None, []), None)
@@ -29,6 +29,31 @@ class ToneInfoTest(unittest.TestCase):
 
     def testMustBeNonEmpty(self):
         self.assertRaises(ValueError, lambda: ToneInfo())
+    
+    def testInterned(self):
+        self.assertTrue(ToneInfo(written=3, spoken=2) is ToneInfo(written=3, spoken=2))
+        self.assertTrue(ToneInfo(written=4) is ToneInfo(written=4, spoken=4))
+    
+    def testNoDict(self):
+        self.assertFalse(hasattr(ToneInfo(written=1), "__dict__"))
+
+class NoHTMLAttrsTest(unittest.TestCase):
+    def testShared(self):
+        self.assertTrue(Text(u"a").htmlattrs is Pinyin(u"hen", 3).htmlattrs)
+        self.assertEquals(Text(u"a").htmlattrs, {})
+    
+    def testCannotModify(self):
+        self.assertRaises(TypeError, lambda: Text(u"a").htmlattrs.update({ "color" : "red" }))
+        self.assertRaises(TypeError, lambda: Pinyin(u"hen", 3).htmlattrs.setdefault("color", "red"))
+    
+    def testCopyCanBeModified(self):
+        htmlattrs = TonedCharacter(u"很", 3).htmlattrs.copy()
+        htmlattrs["color"] = "red"
+        self.assertEquals(TonedCharacter(u"很", 3, htmlattrs).htmlattrs, { "color" : "red" })
+    
+    def testTokensHaveNoDict(self):
+        for token in [Text(u"a"), Pinyin(u"hen", 3), TonedCharacter(u"很", 3)]:
+            self.assertFalse(hasattr(token, "__dict__"))
 
 class PinyinTest(unittest.TestCase):
     def testConvenienceConstructor(self):
@@ -52,6 +77,21 @@ class PinyinTest(unittest.TestCase):
         self.assertNotEquals(Pinyin(u"hen", 3), Pinyin(u"hen", 3, { "moo" : "cow" }))
         self.assertNotEquals(Pinyin(u"hen", 3, { "moo" : "cow" }), Pinyin(u"hen", 3, { "moo" : "sheep" }))
     
+    def testParseSharesToneInfo(self):
+        one, other = Pinyin.parse(u"hěn"), Pinyin.parse(u"hen3")
+        self.assertEquals(one, other)
+        self.assertTrue(one.toneinfo is other.toneinfo)
+    
+    def testParseRepeatedlyGivesFreshPinyin(self):
+        one = Pinyin.parse(u"hen3")
+        one.htmlattrs = { "color" : "red" }
+        self.assertEquals(Pinyin.parse(u"hen3"), Pinyin(u"hen", 3))
+    
+    def testParseRepeatedlyFails(self):
+        for _ in range(2):
+            self.assertRaises(ValueError, lambda: Pinyin.parse(u"hello"))
+            self.assertRaises(ValueError, lambda: Pinyin.parse(u"hen", forcenumeric=True))
+    
     def testEqDissimilar(self):
         self.assertNotEquals(Pinyin(u"hen", 3), "Pinyin(u'hen', 3)")
         self.assertNotEquals("Pinyin(u'hen', 3)", Pinyin(u"hen", 3))
@@ -145,6 +185,18 @@ class PinyinTest(unittest.TestCase):
     def testRejectsPinyinlikeEnglish(self):
         self.assertRaises(ValueError, lambda: Pinyin.parse("USB"))
 
+class PinyinSyllablesTest(unittest.TestCase):
+    def testAgreesWithDatabase(self):
+        import sqlalchemy
+        from pinyin.db import database
+        from pinyin.pinyinsyllables import syllables
+        
+        table = sqlalchemy.Table("PinyinSyllables", database.metadata, autoload=True)
+        self.assertEquals(syllables, frozenset([substituteForUUmlaut(pinyin).lower() for pinyin in database.selectScalars(sqlalchemy.select([table.c.Pinyin]))]))
+    
+    def testErhua(self):
+        self.assertEquals(Pinyin.parse(u"r5"), Pinyin(u"r", 5))
+
 class TextTest(unittest.TestCase):
     def testNonEmpty(self):
         self.assertRaises(ValueError, lambda: Text(u""))
@@ -204,6 +256,11 @@ class WordTest(unittest.TestCase):
         word.append(None)
         self.assertEquals(word, Word(Text("yes"), Text("no")))
     
+    def testFromTokens(self):
+        word = Word.fromtokens([Text(u"yes"), Pinyin(u"hen", 3)])
+        self.assertTrue(isinstance(word, Word))
+        self.assertEquals(word, Word(Text(u"yes"), Pinyin(u"hen", 3)))
+    
     def testAccept(self):
         output = []
         class Visitor(object):
@@ -315,7 +372,26 @@ class TokenizeTest(unittest.TestCase):
         # TODO: enable this test and make it pass somehow... SGMLParser doesn't support self-closing tags :-(
         #self.assertEquals([Text(u'<b />')], tokenize(u'<b />'))
         self.assertEquals([Text(u'<span style="mehhhh!">'), Text("</span>")], tokenize(u'<span style="mehhhh!"></span>'))
-        
+    
+    def testTokenizeNestedHTML(self):
+        self.assertEquals([Text(u'<span style="">'), Text(u'a', { "color" : "red" }), Text(u'<b>'), Pinyin(u'ni', 3, { "color" : "red" }), Text(u'</b>'), Text(u'</span>'), Pinyin(u'hao', 3)],
+                          tokenize(u'<span style="color:red">a<b>ni3</b></span>hao3'))
+    
+    def testTokenizeSpanWithOtherStyles(self):
+        self.assertEquals([Text(u'<span style="font-size : 3">'), Pinyin(u'ni', 3, { "color" : "red" }), Text(u'</span>')],
+                          tokenize(u'<span style="color:red;font-size:3">ni3</span>'))
+    
+    def testTokenizeSelfClosingHTML(self):
+        self.assertEquals([Pinyin(u'hao', 3), Text(u'<br />'), Pinyin(u'ma', 5), Text(u'<br />')], tokenize(u'hao3<br>ma5<br/>'))
+    
+    def testTokenizeBadlyNestedHTML(self):
+        self.assertEquals([Pinyin(u'ni', 3), Pinyin(u'hao', 3)], tokenize(u'ni3</b>hao3'))
+        self.assertEquals([Text(u'<i>'), Pinyin(u'ni', 3), Text(u'</i>')], tokenize(u'<i>ni3'))
+        self.assertEquals([Text(u'<p>'), Text(u'a'), Text(u'</p>'), Text(u'<p>'), Text(u'b'), Text(u'</p>')], tokenize(u'<p>a<p>b'))
+    
+    def testTokenizeEntities(self):
+        self.assertEquals(u'a &amp; b &lt; &nbsp; &#20320;', u"".join([unicode(token) for token in tokenize(u'a &amp; b < &nbsp; &#20320;')]))
+
 class PinyinTonifierTest(unittest.TestCase):
     def testEasy(self):
         self.assertEquals(PinyinTonifier().tonify(u"Han4zi4 bu4 mie4, Zhong1guo2 bi4 wang2!"),
@@ -331,6 +407,18 @@ class PinyinTonifierTest(unittest.TestCase):
     def testGreeting(self):
         self.assertEquals(PinyinTonifier().tonify(u"ni3 hao3, wo3 xi3 huan xue2 xi2 Han4 yu3. wo3 de Han4 yu3 shui3 ping2 hen3 di1."),
                           u"nǐ hǎo, wǒ xǐ huan xué xí Hàn yǔ. wǒ de Hàn yǔ shuǐ píng hěn dī.")
+    
+    def testSyllablesWrittenTogether(self):
+        self.assertEquals(PinyinTonifier().tonify(u"Zhong1guo2ren2 lai2le5"), u"Zhōngguórén láile")
+    
+    def testToneNumbersInsideWords(self):
+        # Not Pinyin, but we should treat it just like we always have: the tone numbers move about within the word
+        self.assertEquals(PinyinTonifier().tonify(u"n3g1"), PinyinTonifier.tonifyrun(u"n3g1"))
+        self.assertEquals(PinyinTonifier().tonify(u"n3g1"), u"\u030C\u0304ng")
+    
+    def testTableAgreesWithRules(self):
+        for numeric in [u"zhuang4", u"Er2", u"lüe4", u"ma5"]:
+            self.assertEquals(tonifiedsyllables[numeric], PinyinTonifier.tonifyrun(numeric))
 
 class FlattenTest(unittest.TestCase):
     def testFlatten(self):
@@ -343,6 +431,18 @@ class FlattenTest(unittest.TestCase):
     
     def testUsesWrittenTone(self):
         self.assertEquals(flatten([Word(Pinyin("hen", ToneInfo(written=2,spoken=3)))]), "hen2")
+    
+    def testFlattenTokens(self):
+        self.assertEquals(flatten([Text(u'a '), Pinyin.parse(u"hen3")]), u"a hen3")
+    
+    def testFlattenColored(self):
+        self.assertEquals(flatten([Word(Text(u'a ')), Word(Pinyin(u"hen", 3, { "color" : "red" }), Text(u' b'))]),
+                          u'a <span style="color:red">hen3</span> b')
+    
+    def testFlattenCoalescesSameColor(self):
+        self.assertEquals(flatten([Word(Pinyin(u"hen", 3, { "color" : "red" }), Text(u' ', { "color" : "red" })), Word(), Word(Pinyin(u"hao", 3, { "color" : "red" })),
+                                   Word(Pinyin(u"ma", 5, { "color" : "blue" }))]),
+                          u'<span style="color:red">hen3 hao3</span><span style="color:blue">ma</span>')
 
 class NeedsSpaceBeforeAppendTest(unittest.TestCase):
     def testEmptyDoesntNeedSpace(self):
@@ -1,10 +1,39 @@
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
 
 from pinyin.statistics import *
+import pinyin.statistics
+import pinyin.utils
 
 
+class HanziGradeTest(unittest.TestCase):
+    def testGrades(self):
+        self.assertEquals(hanziGrade(u"的"), u"HSK Basic")
+        self.assertEquals(hanziGrade(u"丈"), u"HSK Elementary")
+        self.assertEquals(hanziGrade(u"丹"), u"HSK Advanced")
+    
+    def testNonHSK(self):
+        self.assertEquals(hanziGrade(u"龘"), u"Non-HSK")
+    
+    def testNotHanzi(self):
+        self.assertEquals(hanziGrade(u"a"), None)
+        self.assertEquals(hanziGrade(u" "), None)
+    
+    def testGradeAll(self):
+        self.assertEquals(hskGradeIndex.gradeall(u"的a龘"), [u"HSK Basic", None, u"Non-HSK"])
+    
+    def testOtherSchemes(self):
+        index = hanziGradeIndexes[u"Taiwan Standard"]
+        self.assertEquals(index.grades[0], u"Level 1")
+        self.assertEquals(index.grades[-1], u"Non-Standard")
+        self.assertEquals(index.gradeall(u"人直a"), [u"Level 1", u"Level 2", None])
+    
+    def testEarliestGradeWins(self):
+        index = HanziGradeIndex([(u"One", u"一二"), (u"Two", u"二三")], u"Other")
+        self.assertEquals(index.gradeall(u"一二三四"), [u"One", u"One", u"Two", u"Other"])
+
 class HanziDailyStatsTest(unittest.TestCase):
     def testNoDays(self):
         self.assertEquals(self.statsByDay([], 0), [])
@@ -52,6 +81,21 @@ class HanziDailyStatsTest(unittest.TestCase):
             (0, [1, 1, 0, 0, 0, 0])
           ])
     
+    def testOtherGradeScheme(self):
+        index = HanziGradeIndex([(u"One", u"的"), (u"Two", u"是")], u"Other")
+        days, cumulativeTotals, cumulativesByGrades = hanziDailyStats([(u"的是斯x", self.nDaysAgo(0), 0)], 1, index)
+        self.assertEquals((days, cumulativeTotals), ([0], [3]))
+        self.assertEquals(cumulativesByGrades, { u"One" : [1], u"Two" : [1], u"Other" : [1] })
+    
+    def testLearntInFutureNotCounted(self):
+        self.assertEquals(self.statsByDay([(u"的", 2), (u"是", 0)], 1), [
+            (0, [1, 1, 0, 0, 0, 0])
+          ])
+    
+    def testSameWithoutNumPy(self):
+        firstAnsweredValues = [(u"的是斯", self.nDaysAgo(-3), 0), (u"轴扛", self.nDaysAgo(-40), 0), (u'暇', 0, self.nDaysAgo(-1))]
+        self.assertEquals(withoutNumPy(lambda: hanziDailyStats(firstAnsweredValues, 10)), hanziDailyStats(firstAnsweredValues, 10))
+    
     def statsByDay(self, firstAnsweredValuesByDay, daysInRange):
         # Turn the day based time in the test into a seconds based one relative to the present
         # Zero out the created date because we will never need it
@@ -69,6 +113,146 @@ class HanziDailyStatsTest(unittest.TestCase):
     def nDaysAgo(self, n):
         return (time.time() - 100) + (n * 86400.0)
 
+class CumulativeDailyCountsTest(unittest.TestCase):
+    def testCounts(self):
+        self.assertEquals(self.counts([0, -1, -1, -3], 5), [0, 1, 1, 3, 4])
+    
+    def testEarlierDaysCountTowardsFirst(self):
+        self.assertEquals(self.counts([-10, -2, 0], 2), [2, 3])
+    
+    def testEmpty(self):
+        self.assertEquals(self.counts([], 3), [0, 0, 0])
+        self.assertEquals(self.counts([0], 0), [])
+    
+    # Gives the same answer whether or not we have NumPy to hand
+    def counts(self, days, daysInRange):
+        counts = cumulativeDailyCounts(days, daysInRange)
+        self.assertEquals(withoutNumPy(lambda: cumulativeDailyCounts(days, daysInRange)), counts)
+        return counts
+
+class StackedSeriesTest(unittest.TestCase):
+    def testStack(self):
+        self.assertEquals(self.stack({ "a" : [1, 2], "b" : [0, 3], "c" : [4, 4] }, ["a", "b", "c"]), [[1, 2], [1, 5], [5, 9]])
+    
+    def testEmpty(self):
+        self.assertEquals(self.stack({ "a" : [], "b" : [] }, ["a", "b"]), [[], []])
+        self.assertEquals(self.stack({}, []), [])
+    
+    # Gives the same answer whether or not we have NumPy to hand
+    def stack(self, seriesByGrades, grades):
+        stacked = stackedSeries(seriesByGrades, grades)
+        self.assertEquals(withoutNumPy(lambda: stackedSeries(seriesByGrades, grades)), stacked)
+        return stacked
+
+class HanziStatsStoreTest(unittest.TestCase):
+    def testFoldsInCards(self):
+        store = HanziStatsStore()
+        cards = StandInCards({ 1 : (u"的是", 20, 1), 2 : (u"是x斯", 10, 1), 3 : (u"斯", 0, 5) })
+        store.update("key", cards.fingerprint, cards.fetchanswered)
+        self.assertEquals(sorted(store.firstAnsweredValues()), [(u"斯", 5, 5), (u"是", 10, 10), (u"的", 20, 20)])
+    
+    def testOnlyFetchesNewCards(self):
+        store = HanziStatsStore()
+        cards = StandInCards({ 1 : (u"的", 20, 1) })
+        store.update("key", cards.fingerprint, cards.fetchanswered)
+        cards.answer(2, u"是的", 30)
+        store.update("key", cards.fingerprint, cards.fetchanswered)
+        self.assertEquals(cards.sinces, [None, 20])
+        self.assertEquals(sorted(store.firstAnsweredValues()), [(u"是", 30, 30), (u"的", 20, 20)])
+    
+    def testStartsAgainWhenKeyChanges(self):
+        store = HanziStatsStore()
+        store.update("key", StandInCards({ 1 : (u"的", 20, 1) }).fingerprint, lambda since: [(u"的", 20, 1)])
+        store.update("other key", lambda until: (0, 0, None), lambda since: since is None and [(u"是", 30, 1)] or [])
+        self.assertEquals(store.firstAnsweredValues(), [(u"是", 30, 30)])
+    
+    def testStartsAgainWhenCardsGoAway(self):
+        store = HanziStatsStore()
+        cards = StandInCards({ 1 : (u"的", 20, 1), 2 : (u"是", 30, 1) })
+        store.update("key", cards.fingerprint, cards.fetchanswered)
+        cards.delete(1)
+        store.update("key", cards.fingerprint, cards.fetchanswered)
+        self.assertEquals(store.firstAnsweredValues(), [(u"是", 30, 30)])
+    
+    def testStartsAgainWhenExpressionEdited(self):
+        store = HanziStatsStore()
+        cards = StandInCards({ 1 : (u"的", 20, 1), 2 : (u"是", 30, 1) })
+        store.update("key", cards.fingerprint, cards.fetchanswered)
+        cards.edit(1, u"斯")
+        store.update("key", cards.fingerprint, cards.fetchanswered)
+        self.assertEquals(sorted(store.firstAnsweredValues()), [(u"斯", 20, 20), (u"是", 30, 30)])
+    
+    def testStartsAgainWhenCardDeletedAndAnotherAnswered(self):
+        store = HanziStatsStore()
+        cards = StandInCards({ 1 : (u"的", 20, 1), 2 : (u"是", 30, 1) })
+        store.update("key", cards.fingerprint, cards.fetchanswered)
+        cards.delete(1)
+        cards.answer(3, u"斯", 40)
+        store.update("key", cards.fingerprint, cards.fetchanswered)
+        self.assertEquals(sorted(store.firstAnsweredValues()), [(u"斯", 40, 40), (u"是", 30, 30)])
+    
+    def testSavedBetweenSessions(self):
+        def do(tempdir):
+            storepath = os.path.join(tempdir, "stats.p")
+            cards = StandInCards({ 1 : (u"的", 20, 1) })
+            HanziStatsStore(storepath).update("key", cards.fingerprint, cards.fetchanswered)
+            
+            store = HanziStatsStore(storepath)
+            self.assertEquals(store.firstAnsweredValues(), [(u"的", 20, 20)])
+            self.assertEquals(store.lastfirstanswered, 20)
+            
+            # The saved fingerprint is still good, so we only look at the new cards
+            cards.answer(2, u"是", 30)
+            store.update("key", cards.fingerprint, cards.fetchanswered)
+            self.assertEquals(cards.sinces, [None, 20])
+        
+        pinyin.utils.withtempdir(do)
+    
+    def testSameStatsAsAllCards(self):
+        firstAnsweredValues = [(u"的是斯", time.time() - 86400 * 3, 0), (u"是轴", time.time() - 86400, 0), (u"扛", 0, time.time() - 86400 * 2)]
+        store = HanziStatsStore()
+        store.update("key", StandInCards(dict(enumerate(firstAnsweredValues))).fingerprint, lambda since: firstAnsweredValues)
+        self.assertEquals(hanziDailyStats(store.firstAnsweredValues(), 5), hanziDailyStats(firstAnsweredValues, 5))
+
+# Runs the action as if NumPy wasn't installed
+def withoutNumPy(action):
+    numpy, pinyin.statistics.numpy = pinyin.statistics.numpy, None
+    try:
+        return action()
+    finally:
+        pinyin.statistics.numpy = numpy
+
+"""
+Answered cards, mapping ids to (value, firstAnswered, created), which can be fingerprinted and fetched
+in the way that HanziStatsStore wants. Keeps a record of the times we were asked to fetch cards since.
+"""
+class StandInCards(object):
+    def __init__(self, cards):
+        self.cards = dict([(id, card + (0,)) for id, card in cards.items()])
+        self.modifications = 0
+        self.sinces = []
+    
+    def answer(self, id, value, firstAnswered):
+        self.modifications += 1
+        self.cards[id] = (value, firstAnswered, 1, self.modifications)
+    
+    def edit(self, id, value):
+        self.modifications += 1
+        _, firstAnswered, created, _ = self.cards[id]
+        self.cards[id] = (value, firstAnswered, created, self.modifications)
+    
+    def delete(self, id):
+        del self.cards[id]
+    
+    def fingerprint(self, until):
+        ids = [id for id, (_, firstAnswered, _, _) in self.cards.items() if firstAnswered <= until]
+        return len(ids), sum(ids), max([self.cards[id][3] for id in ids] or [None])
+    
+    def fetchanswered(self, since):
+        self.sinces.append(since)
+        return sorted([(value, firstAnswered, created) for value, firstAnswered, created, _ in self.cards.values() if since is None or firstAnswered >= since],
+                      key=lambda card: card[1])
+
 if __name__ == '__main__':
     unittest.main()
 
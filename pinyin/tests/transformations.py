@@ -60,7 +60,7 @@ class CharacterColorizerTest(unittest.TestCase):
     
     def testPunctuation(self):
         self.assertEqual(self.colorize(u'小小!'),
-            u'<span style="color:#00aa00">小</span><span style="color:#00aa00">小</span>!')
+            u'<span style="color:#00aa00">小小</span>!')
 
     def testUseSpokenToneRatherThanWrittenOne(self):
         self.assertEqual(flatten(colorize(colorlist, [Word(TonedCharacter(u"小", ToneInfo(written=3, spoken=2)))])),
@@ -135,6 +135,17 @@ class PinyinAudioReadingsTest(unittest.TestCase):
                  MediaPack("Bar", {"ma3.mp3" : "ma3.mp3", "ci2.mp3" : "ci2.mp3", "dian3.mp3" : "dian3.mp3"})]
         self.assertHasPartialReading(u"小马词典", ["ma3.mp3", "ci2.mp3", "dian3.mp3"], bestpackshouldbe=packs[1], mediapacks=packs)
 
+    def testCountRepeatedSyllables(self):
+        packs = [MediaPack("Foo", {"ma3.mp3" : "ma3.mp3"}),
+                 MediaPack("Bar", {"xiao3.mp3" : "xiao3.mp3", "ci2.mp3" : "ci2.mp3"})]
+        self.assertHasPartialReading(u"马马马小词", ["ma3.mp3", "ma3.mp3", "ma3.mp3"], bestpackshouldbe=packs[0], mediapacks=packs)
+
+    def testReuseCoverageBetweenReadings(self):
+        packs = [MediaPack("Foo", {"ni3.mp3" : "ni3.mp3"}), MediaPack("Bar", {"hao3.mp3" : "hao3.mp3"})]
+        audioreadings = PinyinAudioReadings(packs, [".mp3"])
+        self.assertEquals(audioreadings.audioreading(englishdict.reading(u"你你好")), (packs[0], ["ni3.mp3", "ni3.mp3"], True))
+        self.assertEquals(audioreadings.audioreading(englishdict.reading(u"好好你")), (packs[1], ["hao3.mp3", "hao3.mp3"], True))
+
     def testRandomizeBestPackOnTie(self):
         pack1 = MediaPack("Foo", {"ni3.mp3" : "PACK1.mp3"})
         pack2 = MediaPack("Bar", {"ni3.mp3" : "PACK2.mp3"})
@@ -220,31 +231,62 @@ class ToneSandhiTest(unittest.TestCase):
         # compound 饮料 - modified to take the new information into account:
         self.assertSandhi(*(englishdict.reading(u"酒水饮料") + ["jiu2 shui2 yin3 liao4"]))
     
-    # TODO: improve tone sandhi such that the following tests pass:
-    #
-    # def testYiFollowedByFour(self):
-    #     self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("ding4")), "yi2ding4")
-    # 
-    # def testYiFollowedByOther(self):
-    #     self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("tian1")), "yi4tian1")
-    #     self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("nian2")), "yi4nian2")
-    #     self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("qi3")), "yi4qi3")
-    # 
-    # def testYiBetweenTwoWords(self):
-    #     self.assertSandhi(Word(Pinyin.parse("kan4")), Word(Pinyin.parse("yi1")), Word(Pinyin.parse("kan4")), "kan4yikan4")
-    # 
-    # # NB: don't bother to implement yi1 sandhi that depends on context such as whether we are
-    # # counting sequentially or using yi1 as an ordinal number
-    # 
-    # def testBuFollowedByFourth(self):
-    #     self.assertSandhi(Word(Pinyin.parse("bu4")), Word(Pinyin.parse("shi4")), "bu2shi4")
-    # 
-    # def testBuBetweenTwoWords(self):
-    #     self.assertSandhi(Word(Pinyin.parse("shi4")), Word(Pinyin.parse("bu4")), Word(Pinyin.parse("shi4")), "shi4bushi4")
+    def testYiFollowedByFour(self):
+        self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("ding4")), "yi2ding4", characters=u"一定")
+        self.assertEquals(tonesandhi([Word(TonedCharacter(u"一", 1), TonedCharacter(u"定", 4))]),
+                          [Word(TonedCharacter(u"一", ToneInfo(written=1, spoken=2)), TonedCharacter(u"定", 4))])
+    
+    def testYiFollowedByOther(self):
+        self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("tian1")), "yi4tian1", characters=u"一天")
+        self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("nian2")), "yi4nian2", characters=u"一年")
+        self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("qi3")), "yi4qi3", characters=u"一起")
+    
+    def testYiBetweenTwoWords(self):
+        self.assertSandhi(Word(Pinyin.parse("kan4")), Word(Pinyin.parse("yi1")), Word(Pinyin.parse("kan4")), "kan4yikan4", characters=u"看一看")
+    
+    # NB: don't bother to implement yi1 sandhi that depends on context such as whether we are
+    # counting sequentially or using yi1 as an ordinal number, beyond spotting it inside numbers
+    
+    def testYiInNumbers(self):
+        self.assertSandhi(Word(Pinyin.parse("shi2"), Pinyin.parse("yi1")), Word(Pinyin.parse("yue4")), "shi2yi1yue4", characters=u"十一月")
+        self.assertSandhi(Word(Pinyin.parse("di4"), Pinyin.parse("yi1")), Word(Pinyin.parse("ci4")), "di4yi1ci4", characters=u"第一次")
+    
+    def testYiAtEnd(self):
+        self.assertSandhi(Word(Pinyin.parse("tong3")), Word(Pinyin.parse("yi1")), "tong3yi1", characters=u"统一")
+    
+    def testBuFollowedByFourth(self):
+        self.assertSandhi(Word(Pinyin.parse("bu4")), Word(Pinyin.parse("shi4")), "bu2shi4", characters=u"不是")
+        self.assertSandhi(Word(Pinyin.parse("bu4")), Word(Pinyin.parse("hao3")), "bu4hao3", characters=u"不好")
+    
+    def testBuBetweenTwoWords(self):
+        self.assertSandhi(Word(Pinyin.parse("shi4")), Word(Pinyin.parse("bu4")), Word(Pinyin.parse("shi4")), "shi4bushi4", characters=u"是不是")
+    
+    def testYiAndBuNeedTheCharacters(self):
+        self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("ding4")), "yi1ding4")
+        self.assertSandhi(Word(Pinyin.parse("bu4")), Word(Pinyin.parse("shi4")), "bu4shi4")
+        
+        # We can't tell which character is which if they don't line up with the syllables
+        self.assertSandhi(Word(Pinyin.parse("yi1")), Word(Pinyin.parse("ding4")), "yi1ding4", characters=u"一")
+    
+    def testHomophonesOfYiAndBu(self):
+        for expression in [u"医生", u"衣服", u"部分", u"布置", u"部队", u"步骤"]:
+            tones = [(token.toneinfo.written, token.toneinfo.spoken) for word in tonesandhi(englishdict.reading(expression), expression) for token in word if token.__class__ is not Text]
+            self.assertEquals([written for written, spoken in tones], [spoken for written, spoken in tones])
+    
+    def testYiAndBuFromTheDictionary(self):
+        self.assertSandhi(*(englishdict.reading(u"一定") + ["yi2 ding4"]), **{ "characters" : u"一定" })
+    
+    def testTextBlocksSandhi(self):
+        self.assertSandhi(Word(Pinyin.parse("bu4")), Word(Text(", ")), Word(Pinyin.parse("shi4")), "bu4, shi4", characters=u"不是")
+        self.assertSandhi(Word(Pinyin.parse("hen3"), Text("!")), Word(Pinyin.parse("hao3")), "hen3!hao3")
+    
+    def testKeepsHtmlAttrs(self):
+        self.assertEquals(tonesandhi([Word(Pinyin("hen", 3, { "color" : "red" })), Word(Pinyin.parse("hao3"))])[0],
+                          Word(Pinyin("hen", ToneInfo(written=3, spoken=2), { "color" : "red" })))
     
     # Test helpers
-    def assertSandhi(self, *args):
-        self.assertEquals(flatten(self.copySpokenToWritten(tonesandhi(args[:-1]))), args[-1])
+    def assertSandhi(self, *args, **kwargs):
+        self.assertEquals(flatten(self.copySpokenToWritten(tonesandhi(args[:-1], kwargs.get("characters")))), args[-1])
     
     def copySpokenToWritten(self, words):
         class CopySpokenToWrittenVisitor(TokenVisitor):
@@ -294,6 +336,15 @@ class MaskHanziTest(unittest.TestCase):
         self.assertEquals(maskhanzi(u"没有", "XXX", [Word(TonedCharacter(u"没", 2)), Word(TonedCharacter(u"没", 2)), Word(TonedCharacter(u"有", 2)), Word(TonedCharacter(u"有", 2)), Word(Text(u"没有 le he said 有 to me! 没有!"))]),
                           [Word(Text("XXX")), Word(Text("XXX")), Word(Text("XXX")), Word(Text("XXX")), Word(Text("XXX le he said XXX to me! XXX!"))])
 
+    def testMaskLongestSubstrings(self):
+        self.assertEquals(maskhanzi(u"我没有钱", "X", [Word(Text(u"有钱的人没有我的钱"))]), [Word(Text(u"X的人XX的X"))])
+    
+    def testMaskPartsOfExpression(self):
+        self.assertEquals(maskhanzi(u"你好, 世界", "X", [Word(Text(u"好世界 and 你, 好"))]), [Word(Text(u"XX and X, X"))])
+    
+    def testMaskKeepsHtmlAttrs(self):
+        self.assertEquals(maskhanzi(u"爱", "X", [Word(Text(u"H爱!", { "color" : "red" }))]), [Word(Text(u"HX!", { "color" : "red" }))])
+    
     def testDontMaskWesternForms(self):
         self.assertEquals(maskhanzi("1000AD", "XXX", [Word(Text(u"In 1000AD..."))]), [Word(Text(u"In 1000AD..."))])
 
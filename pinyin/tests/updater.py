@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import threading
 import unittest
 
+import pinyin.dictionaryonline
 from pinyin.config import *
 from pinyin.db import database
 from pinyin.updater import *
@@ -386,7 +388,58 @@ class FieldUpdaterFromExpressionTest(unittest.TestCase):
                     "audio" : u"[sound:" + os.path.join("Test", "hen2.mp3") + "]" +
                               u"[sound:" + os.path.join("Test", "hao3.mp3") + "]"
                   })
-    
+
+    def testFilledFieldsNeedNoLookups(self):
+        class NoDictionary(object):
+            def analyse(self, sentence):
+                raise AssertionError("Looked up %s even though every field was already filled" % sentence)
+
+        fact = { "reading" : "hen3 hao3", "meaning" : "very good", "mw" : "-", "audio" : "[sound:hen3.mp3]", "color" : "很好" }
+        updater = FieldUpdaterFromExpression(MockNotifier(), MockMediaManager([]), Config({ "dictlanguage" : "en", "meaninggeneration" : True, "detectmeasurewords" : True,
+                                                                                             "audiogeneration" : True, "mwaudiogeneration" : True, "colorizedcharactergeneration" : True }))
+        updater.dictionaries = lambda language: NoDictionary()
+        updater.updatefact(fact, u"很好")
+        self.assertEquals(fact, { "reading" : "hen3 hao3", "meaning" : "very good", "mw" : "-", "audio" : "[sound:hen3.mp3]", "color" : "很好" })
+
+    def testTranslationArrivingAfterMovingOn(self):
+        expression = u"你好，你是我的朋友吗"
+        
+        released, queries = threading.Event(), []
+        def lookup(query, destlanguage):
+            released.wait(5)
+            queries.append(query)
+            return [[model.Word(model.Text(u"Hello, you're my friend."))]]
+        
+        originalclient = pinyin.dictionaryonline.translationclient
+        pinyin.dictionaryonline.translationclient = pinyin.dictionaryonline.TranslationClient(lookup)
+        try:
+            arrived, arrivals = threading.Event(), []
+            updater = FieldUpdaterFromExpression(MockNotifier(), MockMediaManager([]), Config({ "dictlanguage" : "en", "meaninggeneration" : True, "fallbackongoogletranslate" : True }))
+            updater.translationarrived = lambda fact, expression: arrivals.append((fact, expression)) or arrived.set()
+            
+            # The user fills in one note, and moves on to another before Google answers
+            fact = { "expression" : expression, "meaning" : "" }
+            updater.updatefact(fact, expression)
+            self.assertEquals(fact["meaning"], "")
+            
+            otherfact = { "expression" : u"很好", "reading" : "" }
+            updater.updatefact(otherfact, u"很好")
+            
+            released.set()
+            arrived.wait(5)
+            self.assertEquals(len(arrivals), 1)
+            self.assertTrue(arrivals[0][0] is fact)
+            self.assertEquals(arrivals[0][1], expression)
+            
+            # Updating the saved copy of the note fills it in without asking Google again
+            storedfact = copy.deepcopy(fact)
+            updater.updatefact(storedfact, expression)
+            self.assertTrue(storedfact["meaning"].startswith(u"Hello, you're my friend."))
+            self.assertEquals(otherfact, { "expression" : u"很好", "reading" : u'<span style="color:#66cc66">hěn</span> <span style="color:#00aa00">hǎo</span>' })
+            self.assertEquals(queries, [expression])
+        finally:
+            pinyin.dictionaryonline.translationclient = originalclient
+
     # Test helpers
     def updatefact(self, *args, **kwargs):
         infos, fact = self.updatefactwithinfos(*args, **kwargs)
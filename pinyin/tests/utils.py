@@ -17,6 +17,13 @@ class ConcatTest(unittest.TestCase):
     def testConcat(self):
         self.assertEquals(concat([[1, 2], [3, 4], [], [5]]), [1, 2, 3, 4, 5])
 
+class ChunksTest(unittest.TestCase):
+    def testEmpty(self):
+        self.assertEquals(list(chunks([], 2)), [])
+    
+    def testChunks(self):
+        self.assertEquals(list(chunks([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
+
 class UrlEscapeTest(unittest.TestCase):
     def testEscapeUrlEncode(self):
         self.assertEquals(urlescape("Hello World"), "Hello%20World")
@@ -127,6 +134,36 @@ class ThunkTest(unittest.TestCase):
     def testTransparency(self):
         self.assertEquals(Thunk(lambda: "hello!").rstrip("!"), "hello")
 
+class ThreadLocalThunkTest(unittest.TestCase):
+    def testForcedOncePerThread(self):
+        import threading
+        
+        calls = []
+        thunk = ThreadLocalThunk(lambda: calls.append(threading.currentThread()) or len(calls))
+        self.assertEquals(thunk(), 1)
+        self.assertEquals(thunk(), 1)
+        
+        results = []
+        thread = threading.Thread(target=lambda: results.append((thunk(), thunk())))
+        thread.start()
+        thread.join()
+        self.assertEquals(results, [(2, 2)])
+        self.assertEquals(thunk(), 1)
+    
+    def testProxiesAttributes(self):
+        self.assertEquals(ThreadLocalThunk(lambda: "hello").upper(), "HELLO")
+    
+    def testForget(self):
+        calls, cleaned = [], []
+        thunk = ThreadLocalThunk(lambda: calls.append(None) or len(calls))
+        thunk.forget(cleaned.append)
+        self.assertEquals(cleaned, [])
+        
+        self.assertEquals(thunk(), 1)
+        thunk.forget(cleaned.append)
+        self.assertEquals(cleaned, [1])
+        self.assertEquals(thunk(), 2)
+
 class RegexParseTest(unittest.TestCase):
     def testParseSimple(self):
         self.assertEquals(self.parse(re.compile("foo"), "foo bar foo bar"),
@@ -166,6 +203,94 @@ class FactoryDictTest(unittest.TestCase):
         self.assertEquals(dict[2], "Hello")
         self.assertEquals(dict[3], "Bye")
 
+class LRUCacheTest(unittest.TestCase):
+    def testGet(self):
+        cache = LRUCache(2)
+        cache[1] = "one"
+        self.assertEquals(cache.get(1), "one")
+        self.assertEquals(cache.get(2), None)
+        self.assertEquals(cache.get(2, "default"), "default")
+    
+    def testCountsHitsAndMisses(self):
+        cache = LRUCache(2)
+        cache[1] = "one"
+        cache.get(1)
+        cache.get(1)
+        cache.get(2)
+        self.assertEquals((cache.hits, cache.misses), (2, 1))
+    
+    def testEvictsLeastRecentlyUsed(self):
+        cache = LRUCache(2)
+        cache[1] = "one"
+        cache[2] = "two"
+        cache.get(1)
+        cache[3] = "three"
+        self.assertEquals(len(cache), 2)
+        self.assertTrue(1 in cache)
+        self.assertFalse(2 in cache)
+        self.assertTrue(3 in cache)
+    
+    def testOverwriteDoesNotEvict(self):
+        cache = LRUCache(2)
+        cache[1] = "one"
+        cache[2] = "two"
+        cache[1] = "uno"
+        self.assertEquals((cache.get(1), cache.get(2)), ("uno", "two"))
+    
+    def testClear(self):
+        cache = LRUCache(2)
+        cache[1] = "one"
+        cache.get(1)
+        cache.clear()
+        self.assertEquals((len(cache), cache.hits, cache.misses), (0, 0, 0))
+    
+    def testSharedBetweenThreads(self):
+        import threading
+        
+        cache, errors = LRUCache(10), []
+        def hammer(offset):
+            try:
+                for n in range(20000):
+                    key = (n + offset) % 15
+                    if cache.get(key) is None:
+                        cache[key] = n
+            except Exception, e:
+                errors.append(e)
+        
+        threads = [threading.Thread(target=hammer, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEquals(errors, [])
+        self.assertEquals(len(cache), 10)
+        self.assertEquals(cache.hits + cache.misses, 80000)
+
+class IsHanziTest(unittest.TestCase):
+    def testUnifiedIdeographs(self):
+        self.assertTrue(isHanzi(u"一"))
+        self.assertTrue(isHanzi(u"\u9fa5"))
+        self.assertTrue(isHanzi(u"\u3400"))
+    
+    def testCompatibilityIdeographs(self):
+        self.assertTrue(isHanzi(u"\uf900"))
+        self.assertFalse(isHanzi(u"\ufa6e"))
+    
+    def testExtensions(self):
+        self.assertTrue(isHanzi(u"\U00020000"))
+        self.assertTrue(isHanzi(u"\U0002a6df"))
+        self.assertTrue(isHanzi(u"\U00030000"))
+        self.assertFalse(isHanzi(u"\U0002a6e0"))
+    
+    def testNotHanzi(self):
+        for char in [u"a", u"1", u"\n", u"，", u"ー", u"\u4dc0", u"\ua000", "bytes"[0]]:
+            self.assertFalse(isHanzi(char))
+    
+    def testFilterHanzi(self):
+        self.assertEquals(filterHanzi(u"Hello 你好, \U00020000 world！\uf900"), u"你好\U00020000\uf900")
+        self.assertEquals(filterHanzi(u"nothing here"), u"")
+
 class isMandarinModelTest(unittest.TestCase):
     def testCheck(self):
         self.assertTrue(ismandarinmodel("Mandarin"))
@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import copy
-import cStringIO
 import random
 import re
 
@@ -18,91 +17,137 @@ from utils import *
 Apply tone sandhi rules to rewrite the tones in the given string. For the rules
 see: <http://en.wikipedia.org/wiki/Standard_Mandarin#Tone_sandhi>
 
+The yi and bu sandhi only apply to the characters 一 and 不, not to anything else with the same
+reading (e.g. 医 or 部), so they only happen to pinyin if we are given the characters it is a
+reading of, one per syllable.
+
 NB: we don't implement this very well yet. Give it time..
 """
-def tonesandhi(words):
-    # 1) Gather the tone contour into a string
-    tonecontourio = cStringIO.StringIO()
-    gathervisitor = GatherToneContourVisitor(tonecontourio)
+def tonesandhi(words, characters=None):
+    # 1) Gather the written tones into an array with one entry per syllable, noting for each syllable
+    #    whether it starts a word and whether any (non-blank) text seperates it from the one before
+    tones, syllables, startsword, blocked = [], [], [], []
+    sawtext = False
     for word in words:
-        word.accept(gathervisitor)
-        tonecontourio.write("~")
-    tonecontour = tonecontourio.getvalue()
-    tonecontourio.close()
+        startofword = True
+        for token in word:
+            if token.__class__ is Text:
+                sawtext = sawtext or len(token.strip()) != 0
+                continue
+            
+            tones.append(token.toneinfo.written)
+            syllables.append(token.__class__ is Pinyin and token.word.lower() or unicode(token))
+            startsword.append(startofword)
+            blocked.append(sawtext)
+            startofword, sawtext = False, False
     
+    # If we know which character each syllable is, go by that rather than the pinyin. We can only
+    # line them up if there are as many characters as syllables, though.
+    if characters is not None:
+        characters = filterHanzi(characters)
+        if len(characters) == len(syllables):
+            syllables = list(characters)
     
-    # 2) Rewrite it (ewww!)
+    # 2) Rewrite it
+    spoken = sandhitones(tones, syllables, startsword, blocked)
     
-    log.info("Rewriting tone sandhi for contour %s", tonecontour)
+    # 3) Apply the new contour to the words, keeping any token whose spoken tone is already right
+    finalwords = []
+    n = 0
+    for word in words:
+        finaltokens = []
+        for token in word:
+            if token.__class__ is not Text:
+                if token.toneinfo.spoken != spoken[n]:
+                    token = withspokentone(token, spoken[n])
+                n += 1
+            finaltokens.append(token)
+        
+        finalwords.append(Word.fromtokens(finaltokens))
     
-    # NB: must match strings of ~ in the following in order to ignore words
-    # which consist entirely of blank space. Tian'a, this is unbelievably horrible!
+    return finalwords
+
+"""
+Works out the spoken tones for a tone contour in a single pass. The arguments all have one entry
+per syllable: the written tone, the syllable itself (its character if we know it, which is what we
+use to spot yi and bu), whether it starts a new word and whether some text stands between it and the
+previous syllable, which stops sandhi applying.
+"""
+def sandhitones(tones, syllables, startsword, blocked):
+    spoken = list(tones)
+    count = len(tones)
     
+    n = 0
+    while n < count:
+        tone = tones[n]
+        if tone == 3:
+            # Find the extent of this run of third tones
+            end = n + 1
+            while end < count and tones[end] == 3 and not blocked[end]:
+                end += 1
+            
+            sandhithirdtones(spoken, startsword, n, end)
+            n = end
+            continue
+        
+        follows = n + 1 < count and not blocked[n + 1]
+        precedes = n > 0 and not blocked[n]
+        if follows and ((tone == 1 and syllables[n] == u"一") or (tone == 4 and syllables[n] == u"不")):
+            nexttone = tones[n + 1]
+            if tone == 1 and precedes and (syllables[n - 1], tones[n - 1]) in numeralsyllables:
+                # Inside numbers (bai3 yi1 shi2) and ordinals (di4 yi1) yi keeps its tone
+                pass
+            elif precedes and syllables[n - 1] == syllables[n + 1] and tones[n - 1] == nexttone:
+                # Between two copies of the same syllable (kan4 yi1 kan4, shi4 bu4 shi4) they are unstressed
+                spoken[n] = 5
+            elif nexttone == 4:
+                # Before a fourth tone both become second tone
+                spoken[n] = 2
+            elif tone == 1 and nexttone in [1, 2, 3]:
+                # Before anything else, yi becomes fourth tone
+                spoken[n] = 4
+        
+        n += 1
+    
+    return spoken
+
+# Syllables after which yi is being read as part of a number, so doesn't undergo sandhi
+numeralsyllables = frozenset([(u"yi", 1), (u"er", 4), (u"san", 1), (u"si", 4), (u"wu", 3), (u"liu", 4), (u"qi", 1), (u"ba", 1), (u"jiu", 3),
+                              (u"shi", 2), (u"bai", 3), (u"qian", 1), (u"wan", 4), (u"ling", 2), (u"di", 4)]) | \
+                   frozenset((character, tone) for characters, tone in [(u"一七三八千", 1), (u"十零〇", 2), (u"五九百", 3), (u"二四六万萬第", 4)] for character in characters)
+
+def sandhithirdtones(spoken, startsword, start, end):
     # Top priority:
     #  33~3 -> 22~3
     #  3~33 -> 3~23
-    # (and the more general sandhi effect with strings of length > 3)
-    def dealWithThrees(match):
-        # a) Split the match into a list of strings of 3 per word
-        wordcontours = (match.group(1) or "").split("~")[:-1] + [match.group(2)]
-        
-        # b) Build the result
-        #   i) For everything but the last word, turn the tone into 2 if it is monosyllabic
-        maketwosifpoly = lambda what: len(what) == 1 and what or '2' * len(what)
-        #   ii) For the last word, always end with a sequence of 2s followed by a 3
-        makeprefixtwos = lambda what: '2' * (len(what) - 1) + '3'
-        replacement = "~".join([maketwosifpoly(wordcontour) for wordcontour in wordcontours[:-1]] + [makeprefixtwos(wordcontours[-1])])
-        
-        log.debug("Rewrote complex tone sandhi %s into %s", match.group(0), replacement)
-        return replacement
-    tonecontour = re.sub(r"((?:3+\~+)*)(3+)", dealWithThrees, tonecontour)
+    # (and the more general sandhi effect with strings of length > 3). Every word but the last in the run
+    # becomes all 2s if it is polysyllabic, and the last word becomes a sequence of 2s followed by a 3
+    wordstart = start
+    for n in range(start + 1, end + 1):
+        if n == end or startsword[n]:
+            if n == end:
+                spoken[wordstart:n - 1] = [2] * (n - 1 - wordstart)
+            elif n - wordstart > 1:
+                spoken[wordstart:n] = [2] * (n - wordstart)
+            wordstart = n
     
-    # Low priority (let others take effect first):
+    # Low priority (let others take effect first), working left to right through pairs:
     #  33  -> 23 (though this is already caught by the code above, actually)
     #  3~3 -> 2~3
-    tonecontour = re.sub(r"3(\~*)3", r"2\g<1>3", tonecontour)
-    
-    log.info("Final contour computed as %s", tonecontour)
-    
-    # 3) Apply the new contour to the words
-    finalwords = []
-    tonecontourqueue = list(tonecontour[::-1])
-    applyvisitor = ApplyToneContourVisitor(tonecontourqueue)
-    for word in words:
-        finalwords.append(word.map(applyvisitor))
-        p = tonecontourqueue.pop()
-        assert p == "~"
-    return finalwords
-
-class GatherToneContourVisitor(TokenVisitor):
-    def __init__(self, tonecontourio):
-        self.tonecontourio = tonecontourio
-
-    def visitText(self, text):
-        if len(text.strip()) != 0:
-            self.tonecontourio.write("_")
-
-    def visitPinyin(self, pinyin):
-        self.tonecontourio.write(str(pinyin.toneinfo.written))
-        
-    def visitTonedCharacter(self, tonedcharacter):
-        self.tonecontourio.write(str(tonedcharacter.toneinfo.written))
+    n = start
+    while n < end - 1:
+        if spoken[n] == 3 and spoken[n + 1] == 3:
+            spoken[n] = 2
+            n += 2
+        else:
+            n += 1
 
-class ApplyToneContourVisitor(TokenVisitor):
-    def __init__(self, tonecontourqueue):
-        self.tonecontourqueue = tonecontourqueue
-    
-    def visitText(self, text):
-        if len(text.strip()) != 0:
-            p = self.tonecontourqueue.pop()
-            assert p in "_"
-        return text
-
-    def visitPinyin(self, pinyin):
-        return Pinyin(pinyin.word, ToneInfo(written=pinyin.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
-    
-    def visitTonedCharacter(self, tonedcharacter):
-        return TonedCharacter(unicode(tonedcharacter), ToneInfo(written=tonedcharacter.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
+def withspokentone(token, spoken):
+    toneinfo = ToneInfo(written=token.toneinfo.written, spoken=spoken)
+    if token.__class__ is Pinyin:
+        return Pinyin(token.word, toneinfo, token.htmlattrs)
+    else:
+        return TonedCharacter(unicode(token), toneinfo, token.htmlattrs)
 
 """
 Remove all r5 characters from the supplied words.
@@ -189,47 +234,53 @@ Output audio reading corresponding to a textual reading.
 class PinyinAudioReadings(object):
     def __init__(self, mediapacks, audioextensions):
         self.mediapacks = mediapacks
-        self.audioextensions = audioextensions
+        self.audioextensions = tuple(audioextensions)
+        
+        # The coverage matrix: for each syllable we have been asked about (identified by the names of the files we
+        # would accept for it), the media each of the packs has for it, or None if a pack doesn't have any
+        self.coverage = FactoryDict(lambda possiblebases: [mediapack.mediaforany(possiblebases, self.audioextensions) for mediapack in self.mediapacks])
     
     def audioreading(self, tokens):
         log.info("Requested audio reading for %d tokens", len(tokens))
         
-        # Try possible packs to format the tokens. Basically, we
-        # don't want to use a mix of sounds from different packs
-        bestmediapacksoutputs, bestmediamissingcount = [], len(tokens) + 1
-        for mediapack in self.mediapacks:
-            log.info("Checking for reading in pack %s", mediapack.name)
-            output, mediamissingcount = audioreadingforpack(mediapack, self.audioextensions, trimerhua(tokens))
-            
-            # We will end up choosing one of the packs that minimizes the number of errors:
-            if mediamissingcount == bestmediamissingcount:
-                # Just as good as a previous pack, so this is an alternative
-                bestmediapacksoutputs.append((mediapack, output))
-            elif mediamissingcount < bestmediamissingcount:
-                # Strictly better than the previous ones, so this is the new best option
-                bestmediapacksoutputs = [(mediapack, output)]
-                bestmediamissingcount = mediamissingcount
-        
         # Did we get any result at all?
-        if len(bestmediapacksoutputs) != 0:
-            bestmediapack, bestoutput = random.choice(bestmediapacksoutputs)
-            return bestmediapack, bestoutput, (bestmediamissingcount != 0)
-        else:
+        if len(self.mediapacks) == 0:
             return None, [], True
+        
+        visitor = PinyinAudioReadingsVisitor()
+        for word in trimerhua(tokens):
+            word.accept(visitor)
+        
+        # Try possible packs to format the tokens. Basically, we don't want to use a mix of sounds from different
+        # packs, so count the syllables each pack is missing by running along the rows of the coverage matrix
+        mediamissingcounts = [0] * len(self.mediapacks)
+        for possiblebases in visitor.syllables:
+            for n, media in enumerate(self.coverage[possiblebases]):
+                if media is None:
+                    mediamissingcounts[n] += 1
+        
+        # We will end up choosing one of the packs that minimizes the number of errors
+        bestmediamissingcount = min(mediamissingcounts)
+        bestn = random.choice([n for n, mediamissingcount in enumerate(mediamissingcounts) if mediamissingcount == bestmediamissingcount])
+        bestmediapack = self.mediapacks[bestn]
+        
+        bestoutput = []
+        for possiblebases in visitor.syllables:
+            media = self.coverage[possiblebases][bestn]
+            if media:
+                bestoutput.append(media)
+            else:
+                log.warning("Couldn't find media for %s in %s", possiblebases[0], bestmediapack)
+        
+        return bestmediapack, bestoutput, (bestmediamissingcount != 0)
 
-# Simple wrapper around the PinyinAudioReadingsVisitor
-def audioreadingforpack(mediapack, audioextensions, words):
-    visitor = PinyinAudioReadingsVisitor(mediapack, audioextensions)
-    [word.accept(visitor) for word in trimerhua(words)]
-    return (visitor.output, visitor.mediamissingcount)
-
+"""
+Gathers the syllables of a reading that we want audio for, as tuples of the names of the files
+we would accept for each one (without extension), in order of preference.
+"""
 class PinyinAudioReadingsVisitor(TokenVisitor):
-    def __init__(self, mediapack, audioextensions):
-        self.mediapack = mediapack
-        self.audioextensions = audioextensions
-        
-        self.output = []
-        self.mediamissingcount = 0
+    def __init__(self):
+        self.syllables = []
     
     def visitText(self, text):
         pass
@@ -244,20 +295,8 @@ class PinyinAudioReadingsVisitor(TokenVisitor):
         elif substitutions is not None:
             # Typically u: is written as v in filenames
             possiblebases.extend([substitution + str(pinyin.toneinfo.spoken) for substitution in substitutions])
-    
-        # Find path to first suitable media in the possibilty list
-        for possiblebase in possiblebases:
-            media = self.mediapack.mediafor(possiblebase, self.audioextensions)
-            if media:
-                break
-    
-        if media:
-            # If we've managed to find some media, we can put it into the output:
-            self.output.append(media)
-        else:
-            # Otherwise, increment the count of missing media we use to determine optimality
-            log.warning("Couldn't find media for %s (%s) in %s", pinyin, pinyin.numericformat(tone="spoken"), self.mediapack)
-            self.mediamissingcount += 1
+        
+        self.syllables.append(tuple(possiblebases))
 
     def visitTonedCharacter(self, tonedcharacter):
         pass
@@ -266,19 +305,60 @@ class PinyinAudioReadingsVisitor(TokenVisitor):
 Replace occurences of the expression in the words with the masking character.
 """
 def maskhanzi(expression, maskingcharacter, words):
-    return [word.map(MaskHanziVisitor(expression, maskingcharacter)) for word in words]
+    visitor = MaskHanziVisitor(expression, maskingcharacter)
+    return [word.map(visitor) for word in words]
+
+# The masking tries for recently seen expressions: we get asked to mask each meaning of the same expression in turn
+hanzimaskingtries = LRUCache(100)
+
+"""
+Builds a trie of every Hanzi substring of the expression (i.e. of every suffix of each run of Hanzi in it)
+as nested dictionaries. Since every prefix of such a substring is also one, walking the trie as far as it
+goes from some position in a text finds the longest substring that can be masked there.
+"""
+def hanzimaskingtrie(expression):
+    trie = hanzimaskingtries.get(expression)
+    if trie is None:
+        trie = {}
+        for hanzirun in u"".join([isHanzi(c) and c or u" " for c in expression]).split():
+            for start in range(len(hanzirun)):
+                node = trie
+                for c in hanzirun[start:]:
+                    node = node.setdefault(c, {})
+        
+        hanzimaskingtries[expression] = trie
+    
+    return trie
 
 class MaskHanziVisitor(TokenVisitor):
     def __init__(self, expression, maskingcharacter):
         self.expression = expression
         self.maskingcharacter = maskingcharacter
+        self.trie = hanzimaskingtrie(expression)
     
     def visitText(self, text):
-        for substring in substrings(self.expression):
-            if all([isHanzi(c) for c in substring]):
-                text = text.replace(substring, self.maskingcharacter)
-
-        return Text(text)
+        # Scan the text once, replacing the longest maskable substring starting at each position
+        pieces, last, i, length = [], 0, 0, len(text)
+        while i < length:
+            node = self.trie.get(text[i])
+            if node is None:
+                i += 1
+                continue
+            
+            end = i + 1
+            while end < length and text[end] in node:
+                node = node[text[end]]
+                end += 1
+            
+            pieces.append(text[last:i])
+            pieces.append(self.maskingcharacter)
+            last = i = end
+        
+        if len(pieces) == 0:
+            return text
+        
+        pieces.append(text[last:])
+        return Text(u"".join(pieces), text.htmlattrs)
 
     def visitPinyin(self, pinyin):
         return pinyin
@@ -60,7 +60,7 @@ class FieldUpdaterFromAudio(object):
                 output += match.group(0)
             else:
                 # Process as if this non-sound tag were a reading, in order to turn it into some tags
-                output += generateaudio(self.notifier, self.mediamanager, self.config, [model.Word(*model.tokenize(match))])
+                output += generateaudio(self.notifier, self.mediamanager, self.config, [model.Word.fromtokens(model.tokenize(match))])
         
         return output
     
@@ -116,7 +116,7 @@ class FieldUpdaterFromReading(object):
     
         # Identify probable pinyin in the user's freeform input, reformat them according to the
         # current rules, and pop the result back into the field
-        fact['reading'] = preparetokens(self.config, [model.Word(*model.tokenize(reading))])
+        fact['reading'] = preparetokens(self.config, [model.Word.fromtokens(model.tokenize(reading))])
 
 class FieldUpdaterFromExpression(object):
     def __init__(self, notifier, mediamanager, config=getconfig()):
@@ -124,6 +124,11 @@ class FieldUpdaterFromExpression(object):
         self.mediamanager = mediamanager
         self.dictionaries = dictionary.PinyinDictionary.loadall()
         self.config = config
+        
+        # If this is set, we don't wait for Google Translate while updating a fact. Instead, this is called
+        # (on some other thread) with the fact and expression once the answer arrives, so that whoever
+        # owns the fact can update it again to fill in the fields that depend on the answer.
+        self.translationarrived = None
     
     dictionary = property(lambda self: self.dictionaries(self.config.dictlanguage))
     
@@ -195,8 +200,8 @@ class FieldUpdaterFromExpression(object):
         # with the current implementation, but better safe than sorry.
         return generateaudio(self.notifier, self.mediamanager, self.config, transformations.tonesandhi(dictreading))
     
-    def generatecoloredcharacters(self, expression):
-        return model.flatten(transformations.colorize(self.config.tonecolors, transformations.tonesandhi(self.dictionary.tonedchars(expression))))
+    def generatecoloredcharacters(self, analysis):
+        return model.flatten(transformations.colorize(self.config.tonecolors, transformations.tonesandhi(analysis.tonedchars())))
 
     # Future support will need to be dictionary-based and will require a lot more work
     # Will need to be a bit complex:
@@ -219,7 +224,7 @@ class FieldUpdaterFromExpression(object):
             glangcode="zh-CN"
         else:
             glangcode="zh-TW"
-        meanings = dictionaryonline.gTrans(expression, glangcode, False)
+        meanings = dictionaryonline.gTrans(expression, glangcode, False, offline=self.config.googletranslateofflineonly)
         
         if meanings == None or len(meanings) == 0:
             # No conversion, so give up and return the input expression
@@ -236,12 +241,17 @@ class FieldUpdaterFromExpression(object):
     # Core updater routines
     #
     
-    def getdictreading(self, expression):
+    def prefetch(self, expressions):
+        # Look up all the words in a batch of expressions at once, rather than going back to
+        # the dictionary for each of them as updatefact gets round to it
+        self.dictionary.prefetch([expression for expression in expressions if expression is not None])
+    
+    def getdictreading(self, expression, analysis):
         dictreadingsources = [
                 # Get the reading by considering the text as a (Western) number
                 lambda: numberutils.readingfromnumberlike(expression, self.dictionary),
                 # Use CEDICT to get reading (always succeeds)
-                lambda: self.dictionary.reading(expression)
+                lambda: analysis.reading()
             ]
         
         # Find the first source that returns a sensible reading
@@ -252,6 +262,52 @@ class FieldUpdaterFromExpression(object):
   
         raise AssertionError("The CEDICT reading lookup should always succeed, but it failed on %s" % expression)
     
+    def getdictmeaningssource(self, fact, expression, analysis):
+        dictmeaningssources = [
+                # Use CEDICT to get meanings
+                (None,
+                 lambda: analysis.meanings(self.config.prefersimptrad)),
+                # Interpret Hanzi as numbers. NB: only consult after CEDICT so that we
+                # handle curious numbers such as 'liang' using the dictionary
+                (None,
+                 lambda: (numberutils.meaningfromnumberlike(expression, self.dictionary), None))
+            ] + (self.config.shouldusegoogletranslate and [
+                # If the dictionary can't answer our question, ask Google Translate.
+                # If there is a long word followed by another word then this will be treated as a phrase.
+                # Phrases are also queried using googletranslate rather than the local dictionary.
+                # This helps deal with small dictionaries (for example French)
+                ('<br /><span style="color:gray"><small>[Google Translate]</small></span><span> </span>',
+                 lambda: (self.translate(fact, expression), None))
+            ] or [])
+        
+        # Find the first source that returns a sensible meaning
+        for dictmeaningssource, lookup in dictmeaningssources:
+            dictmeanings, dictmeasurewords = lookup()
+            if dictmeanings != None or dictmeasurewords != None:
+                break
+        
+        return dictmeanings, dictmeasurewords, dictmeaningssource
+    
+    def translate(self, fact, expression):
+        if self.translationarrived is None:
+            return dictionaryonline.gTrans(expression, self.config.dictlanguage, offline=self.config.googletranslateofflineonly)
+        else:
+            return dictionaryonline.gTransAsync(expression, self.config.dictlanguage, whenanswered=lambda: self.translationarrived(fact, expression), offline=self.config.googletranslateofflineonly)
+    
+    def getmeaning(self, fact, expression, dictmeanings, dictmeasurewords, dictmeaningssource):
+        # If the user wants the measure words to be folded into the definition or there
+        # is no MW field for us to split them out into, fold them in there
+        if not(self.config.detectmeasurewords) or "mw" not in fact:
+            dictmeanings = dictionary.combinemeaningsmws(dictmeanings, dictmeasurewords)
+        
+        # NB: expression only used for Hanzi masking here
+        meaning = self.generatemeanings(expression, dictmeanings)
+        if meaning and dictmeaningssource:
+            # Append attribution to the meaning if we have any
+            meaning = meaning + dictmeaningssource
+        
+        return meaning
+    
     def updatefact(self, fact, expression):
         # AutoBlanking Feature - If there is no expression, zeros relevant fields
         # DEBUG - add feature to store the text when a lookup is performed. When new text is entered then allow auto-blank any field that has not been edited
@@ -279,72 +335,49 @@ class FieldUpdaterFromExpression(object):
             # delay, but I'm not sure where the delay originates from, which worries me:
             return
         
+        # Everything that goes into the fields is only worked out when the first field that needs it is
+        # filled, and is then remembered for any other fields that need it too. In particular, we do no
+        # lookups at all if the fields we would fill from them already have something in them.
+        
+        # Segment the expression just once: the reading, meanings and colored characters all come from this
+        analysis = utils.Thunk(lambda: self.dictionary.analyse(expression))
+        
         # Apply tone sandhi: this information is needed both by the sound generation
         # and the colorisation, so we can't do it in generatereading
-        dictreading = self.getdictreading(expression)
-        dictreadingsandhi = transformations.tonesandhi(dictreading)
-  
-        # Preload the meaning, but only if we absolutely must
-        if self.config.needmeanings:
-            dictmeaningssources = [
-                    # Use CEDICT to get meanings
-                    (None,
-                     lambda: self.dictionary.meanings(expression, self.config.prefersimptrad)),
-                    # Interpret Hanzi as numbers. NB: only consult after CEDICT so that we
-                    # handle curious numbers such as 'liang' using the dictionary
-                    (None,
-                     lambda: (numberutils.meaningfromnumberlike(expression, self.dictionary), None))
-                ] + (self.config.shouldusegoogletranslate and [
-                    # If the dictionary can't answer our question, ask Google Translate.
-                    # If there is a long word followed by another word then this will be treated as a phrase.
-                    # Phrases are also queried using googletranslate rather than the local dictionary.
-                    # This helps deal with small dictionaries (for example French)
-                    ('<br /><span style="color:gray"><small>[Google Translate]</small></span><span> </span>',
-                     lambda: (dictionaryonline.gTrans(expression, self.config.dictlanguage), None))
-                ] or [])
-            
-            # Find the first source that returns a sensible meaning
-            for dictmeaningssource, lookup in dictmeaningssources:
-                dictmeanings, dictmeasurewords = lookup()
-                if dictmeanings != None or dictmeasurewords != None:
-                    break
-            
-            # If the user wants the measure words to be folded into the definition or there
-            # is no MW field for us to split them out into, fold them in there
-            if not(self.config.detectmeasurewords) or "mw" not in fact:
-                # NB: do NOT overwrite the old dictmeasurewords, because we still want to use the
-                # measure words for e.g. measure word audio generation
-                dictmeanings = dictionary.combinemeaningsmws(dictmeanings, dictmeasurewords)
-            
-            # NB: expression only used for Hanzi masking here
-            meaning = self.generatemeanings(expression, dictmeanings)
-            if meaning and dictmeaningssource:
-                # Append attribution to the meaning if we have any
-                meaning = meaning + dictmeaningssource
+        dictreading = utils.Thunk(lambda: self.getdictreading(expression, analysis()))
+        dictreadingsandhi = utils.Thunk(lambda: transformations.tonesandhi(dictreading(), expression))
+        
+        # NB: the measure words are needed for the measure word audio even if they have their own field
+        dictmeaningssource = utils.Thunk(lambda: self.getdictmeaningssource(fact, expression, analysis()))
+        dictmeasurewords = utils.Thunk(lambda: dictmeaningssource()[1])
+        meaning = utils.Thunk(lambda: self.getmeaning(fact, expression, *dictmeaningssource()))
 
         # Generate translations of the expression into simplified/traditional on-demand
         expressionviews = utils.FactoryDict(lambda simptrad: self.generateincharactersystem(expression, simptrad))
         
         # Update the expression is option is turned on and the preference simp/trad is different to expression (i.e. needs correcting)
-        expressionupdated = False
+        updatedexpression, expressionupdated, coloredanalysis = expression, False, analysis
         if self.config.forceexpressiontobesimptrad and (expression != expressionviews[self.config.prefersimptrad]):
-            expression = expressionviews[self.config.prefersimptrad]
+            updatedexpression = expressionviews[self.config.prefersimptrad]
             expressionupdated = True
+            
+            # The colored characters should reflect the new expression, so we need to segment it afresh
+            coloredanalysis = utils.Thunk(lambda: self.dictionary.analyse(updatedexpression))
 
         # Do the updates on the fields the user has requested:
         # NB: when adding an updater to this list, make sure that you have
         # added it to the updatecontrolflags dictionary in Config as well!
         updaters = {
-                'expression' : lambda: expression,
-                'reading'    : lambda: self.generatereading(dictreadingsandhi),
-                'meaning'    : lambda: meaning,
-                'mw'         : lambda: self.generatemeasureword(self.config.detectmeasurewords and dictmeasurewords or None),
-                'audio'      : lambda: self.generateaudio(dictreadingsandhi),
-                'mwaudio'    : lambda: self.generatemwaudio(dictreading, dictmeasurewords),
-                'color'      : lambda: self.generatecoloredcharacters(expression),
+                'expression' : lambda: updatedexpression,
+                'reading'    : lambda: self.generatereading(dictreadingsandhi()),
+                'meaning'    : meaning,
+                'mw'         : lambda: self.generatemeasureword(self.config.detectmeasurewords and dictmeasurewords() or None),
+                'audio'      : lambda: self.generateaudio(dictreadingsandhi()),
+                'mwaudio'    : lambda: self.generatemwaudio(dictreading(), dictmeasurewords()),
+                'color'      : lambda: self.generatecoloredcharacters(coloredanalysis()),
                 'trad'       : lambda: (expressionviews["trad"] != expressionviews["simp"]) and expressionviews["trad"] or None,
                 'simp'       : lambda: (expressionviews["trad"] != expressionviews["simp"]) and expressionviews["simp"] or None,
-                'weblinks'   : lambda: self.weblinkgeneration(expression)
+                'weblinks'   : lambda: self.weblinkgeneration(updatedexpression)
             }
 
         # Loop through each field, deciding whether to update it or not
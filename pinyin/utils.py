@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import bisect
+import collections
 import os
 import re
 import sys
 import string
+import threading
 import getpass
 import unicodedata
 
@@ -198,6 +201,39 @@ class Thunk(object):
     def __getattr__(self, name):
         return getattr(self.__call__(), name)
 
+"""
+Like a Thunk, except that every thread that forces it gets a value of its own. This is what
+we want for e.g. database connections, which may only be used by the thread that made them.
+"""
+class ThreadLocalThunk(object):
+    def __init__(self, function):
+        # Need to initialize all fields or __getattr__ gets a look at them!
+        self.__local = threading.local()
+        self.__function = function
+    
+    def __call__(self):
+        try:
+            return self.__local.result
+        except AttributeError:
+            self.__local.result = self.__function()
+            return self.__local.result
+    
+    # Forgets the result for this thread (if we have one), passing it to cleanup so it can be e.g. closed.
+    # The next time this thread forces the thunk it gets a new one.
+    def forget(self, cleanup=None):
+        try:
+            result = self.__local.result
+        except AttributeError:
+            return
+        
+        del self.__local.result
+        if cleanup is not None:
+            cleanup(result)
+    
+    # Transparent proxying of access onto the thing inside the thunk!
+    def __getattr__(self, name):
+        return getattr(self.__call__(), name)
+
 """
 Use the regex to parse the text, alternately yielding match objects and strings
 """
@@ -228,8 +264,8 @@ def regexparse(regex, text):
 """
 Returns the contents of a file: no muss, no fuss
 """
-def filecontents(filepath):
-    file = open(filepath, 'r')
+def filecontents(filepath, mode='r'):
+    file = open(filepath, mode)
     contents = file.read(-1)
     file.close()
     
@@ -372,6 +408,10 @@ def striphtml(what):
 def concat(what):
     return sum(what, [])
 
+def chunks(what, size):
+    for i in range(0, len(what), size):
+        yield what[i:i + size]
+
 def inplacefilter(pred, list):
     for i in range(len(list), 0, -1):
         if not pred(list[i - 1]):
@@ -494,18 +534,65 @@ def isosx():
 def islinux():
     return sys.platform.lower().startswith("linux")
 
+# The blocks of CJK ideographs, as inclusive codepoint ranges in ascending order: Extension A, the Unified
+# Ideographs, the Compatibility Ideographs, Extensions B to F, the Compatibility Supplement and Extension G
+hanziranges = [(0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFA6D), (0xFA70, 0xFAD9),
+               (0x20000, 0x2A6DF), (0x2A700, 0x2B73F), (0x2B740, 0x2B81F), (0x2B820, 0x2CEAF), (0x2CEB0, 0x2EBEF),
+               (0x2F800, 0x2FA1D), (0x30000, 0x3134F)]
+hanzirangestarts, hanzirangeends = [list(bounds) for bounds in zip(*hanziranges)]
+
 def isHanzi(char):
     # Originally based on anki.stats.isKanji
     if type(char) == str:
         return False
     
-    import unicodedata
+    if len(char) == 2 and u"\ud800" <= char[0] <= u"\udbff":
+        # Characters outside the BMP are surrogate pairs on narrow builds of Python
+        codepoint = 0x10000 + ((ord(char[0]) - 0xD800) << 10) + (ord(char[1]) - 0xDC00)
+    else:
+        codepoint = ord(char)
+    
+    # Nearly everything we see will be in the main block, so check that first
+    if 0x4E00 <= codepoint <= 0x9FFF:
+        return True
+    
+    n = bisect.bisect_right(hanzirangestarts, codepoint) - 1
+    return n >= 0 and codepoint <= hanzirangeends[n]
 
-    try:
-        return unicodedata.name(char).find('CJK UNIFIED IDEOGRAPH') >= 0
-    except ValueError:
-        # A control character
-        return False
+def hanziregexsource():
+    def codeunits(codepoint):
+        if codepoint < 0x10000 or sys.maxunicode > 0xFFFF:
+            return [unichr(codepoint)]
+        else:
+            codepoint -= 0x10000
+            return [unichr(0xD800 + (codepoint >> 10)), unichr(0xDC00 + (codepoint & 0x3FF))]
+    
+    alternatives = []
+    for start, end in hanziranges:
+        startunits, endunits = codeunits(start), codeunits(end)
+        if len(startunits) == 1:
+            alternatives.append(u"[%s-%s]" % (startunits[0], endunits[0]))
+        elif startunits[0] == endunits[0]:
+            alternatives.append(u"%s[%s-%s]" % (startunits[0], startunits[1], endunits[1]))
+        else:
+            # Spread the range out over the high surrogates it covers
+            alternatives.append(u"%s[%s-\udfff]" % (startunits[0], startunits[1]))
+            if ord(endunits[0]) - ord(startunits[0]) > 1:
+                alternatives.append(u"[%s-%s][\udc00-\udfff]" % (unichr(ord(startunits[0]) + 1), unichr(ord(endunits[0]) - 1)))
+            alternatives.append(u"%s[\udc00-%s]" % (endunits[0], endunits[1]))
+    
+    return u"|".join(alternatives)
+
+hanziregex = re.compile(hanziregexsource(), re.UNICODE)
+
+"""
+The batch form of isHanzi: returns just the Hanzi in the text, in the order they occur.
+"""
+def filterHanzi(text):
+    if type(text) == str:
+        return u""
+    
+    return u"".join(hanziregex.findall(text))
 
 class FactoryDict(dict):
     def __init__(self, factory, *args, **kwargs):
@@ -521,6 +608,70 @@ class FactoryDict(dict):
             self[key] = value
             return value
 
+"""
+A dictionary-like cache holding at most a fixed number of items: when it is full, the least
+recently used item is thrown away. Counts hits and misses so we can see if it is earning its keep.
+"""
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__items = collections.OrderedDict()
+        
+        # Caches are shared between the main thread and any workers (e.g. the bulk fill), and moving
+        # items around in the OrderedDict is not safe to do from two threads at once
+        self.__lock = threading.Lock()
+    
+    def __repr__(self):
+        return "LRUCache(%d/%d items, %d hits, %d misses)" % (len(self), self.maxsize, self.hits, self.misses)
+    
+    def __len__(self):
+        return len(self.__items)
+    
+    def __contains__(self, key):
+        self.__lock.acquire()
+        try:
+            return key in self.__items
+        finally:
+            self.__lock.release()
+    
+    def get(self, key, default=None):
+        self.__lock.acquire()
+        try:
+            try:
+                # Move the item to the most recently used end
+                value = self.__items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            
+            self.__items[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self.__lock.release()
+    
+    def __setitem__(self, key, value):
+        self.__lock.acquire()
+        try:
+            self.__items.pop(key, None)
+            self.__items[key] = value
+            
+            if len(self.__items) > self.maxsize:
+                self.__items.popitem(last=False)
+        finally:
+            self.__lock.release()
+    
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__items.clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.__lock.release()
+
 """
 Monadic bind in the Maybe monad (embedded into Python 'None's)
 """